@@ -0,0 +1,78 @@
+"""
+Benchmark for building records from database rows.
+
+Compares the previous way of hydrating records (calling the constructor, then
+clearing and re-setting every attribute) with `Base.from_rows`, and times
+loading every row of a 100k row table through a Query.
+
+    $ python benchmarks/hydration.py
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record
+
+ROWS = 100000
+
+
+class Entry(lazy_record.Base):
+    __attributes__ = {
+        "name": str,
+        "count": int,
+        "score": float,
+    }
+
+schema = """
+create table entries (
+  id integer primary key autoincrement,
+  name text,
+  count integer,
+  score real,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+"""
+
+
+def from_dict_via_init(cls, **kwargs):
+    # How records used to be built: run __init__, then undo it
+    obj = cls()
+    for attr in cls.__all_attributes__:
+        delattr(obj, "_" + attr)
+    del obj._id
+    for attr, val in kwargs.items():
+        setattr(obj, "_" + attr, val)
+    return obj
+
+
+def main():
+    lazy_record.connect_db()
+    lazy_record.load_schema(schema)
+    Entry.insert_many({"name": "entry {}".format(i), "count": i,
+                       "score": i / 7.0} for i in range(ROWS))
+    query = Entry.all()
+    columns = query.attributes
+    rows = query._do_query().fetchall()
+
+    def via_init():
+        return [from_dict_via_init(Entry, **dict(zip(columns, row)))
+                for row in rows]
+
+    def via_from_rows():
+        return Entry.from_rows(columns, rows)
+
+    def load_query():
+        return list(Entry.all())
+
+    for name, fun in [("hydrate via __init__", via_init),
+                      ("hydrate via from_rows", via_from_rows),
+                      ("load Entry.all()", load_query)]:
+        best = min(timeit.repeat(fun, number=1, repeat=3))
+        print("{:<24}{:>8.3f}s  ({:,.0f} rows/s)".format(name, best,
+                                                         ROWS / best))
+    lazy_record.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark for the memory used by loaded records.
+
+Loads 100k rows as records of a regular model and of the same model with
+`__compact__ = True`, and reports the bytes each record holds on to (the
+record itself plus its containers, not counting the column values, which the
+two share), both right after loading and after every attribute was read once,
+along with the growth in resident memory while holding each set of records
+(the rows themselves were already fetched, so compact records cost little more
+than the object itself).
+
+    $ python benchmarks/memory.py
+"""
+import gc
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record
+
+ROWS = 100000
+
+
+class Entry(lazy_record.Base):
+    __attributes__ = {
+        "name": str,
+        "count": int,
+        "score": float,
+    }
+
+
+class CompactEntry(lazy_record.Base):
+    __compact__ = True
+    __attributes__ = Entry.__attributes__
+
+schema = """
+create table entries (
+  id integer primary key autoincrement,
+  name text,
+  count integer,
+  score real,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+"""
+
+
+def record_size(record):
+    # The record and the containers it owns
+    size = sys.getsizeof(record)
+    state = getattr(record, "__dict__", None)
+    if state is not None:
+        owned = [state] + [value for value in state.values()
+                           if isinstance(value, (dict, list))]
+    else:
+        owned = [record._row]
+    return size + sum(sys.getsizeof(container) for container in owned)
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def read_all(records, columns):
+    for record in records:
+        for column in columns:
+            getattr(record, column)
+
+
+def main():
+    lazy_record.connect_db()
+    lazy_record.load_schema(schema)
+    Entry.insert_many({"name": "entry {}".format(i), "count": i,
+                       "score": i / 7.0} for i in range(ROWS))
+    query = Entry.all()
+    columns = query.attributes
+    rows = query._do_query().fetchall()
+    for model in (Entry, CompactEntry):
+        gc.collect()
+        before = resident_bytes()
+        records = model.from_rows(columns, rows)
+        loaded = record_size(records[0])
+        read_all(records, columns)
+        gc.collect()
+        grown = resident_bytes() - before
+        print("{:<14}{:>6} bytes/record loaded, {:>6} after reads, "
+              "{:>6.0f} bytes/record resident".format(
+                  model.__name__, loaded, record_size(records[0]),
+                  float(grown) / ROWS))
+        del records
+    lazy_record.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark for reading column values without building records.
+
+For every row of a 100k row table of a wide model, compares reading the id
+(and the id and name) from loaded records with reading them with `pluck`, and
+building a dictionary of every column from loaded records with `values`.
+
+    $ python benchmarks/pluck.py
+"""
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record
+
+ROWS = 100000
+COLUMNS = ["column_{}".format(i) for i in range(12)]
+
+
+class Entry(lazy_record.Base):
+    __attributes__ = dict([("name", str)] +
+                          [(column, int) for column in COLUMNS])
+
+schema = """
+create table entries (
+  id integer primary key autoincrement,
+  name text,
+  {columns},
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+""".format(columns=",\n  ".join("{} integer".format(column)
+                                 for column in COLUMNS))
+
+
+def main():
+    lazy_record.connect_db()
+    lazy_record.load_schema(schema)
+    Entry.insert_many(dict([("name", "entry {}".format(i))] +
+                           [(column, i) for column in COLUMNS])
+                      for i in range(ROWS))
+    columns = ["id", "name"] + COLUMNS
+    for name, fun in [
+            ("ids via records", lambda: [e.id for e in Entry.all()]),
+            ("ids via pluck", lambda: Entry.all().pluck("id")),
+            ("id, name via records",
+             lambda: [(e.id, e.name) for e in Entry.all()]),
+            ("id, name via pluck", lambda: Entry.all().pluck("id", "name")),
+            ("dicts via records",
+             lambda: [dict((column, getattr(e, column))
+                           for column in columns) for e in Entry.all()]),
+            ("dicts via values", lambda: Entry.all().values(*columns))]:
+        best = min(timeit.repeat(fun, number=1, repeat=3))
+        print("{:<24}{:>8.3f}s  ({:,.0f} rows/s)".format(name, best,
+                                                         ROWS / best))
+    lazy_record.close_db()
+
+
+if __name__ == "__main__":
+    main()
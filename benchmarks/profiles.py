@@ -0,0 +1,82 @@
+"""
+Benchmark for the connection tuning profiles.
+
+For each profile, times creating records one at a time (one transaction per
+record, so each waits on the journal and the disk), inserting many at once
+with `insert_many`, and loading every record, against a fresh database file.
+
+    $ python benchmarks/profiles.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record
+from lazy_record.profiles import PROFILES
+
+SINGLE_ROWS = 2000
+MANY_ROWS = 100000
+
+
+class Entry(lazy_record.Base):
+    __attributes__ = {
+        "name": str,
+        "count": int,
+        "score": float,
+    }
+
+schema = """
+create table entries (
+  id integer primary key autoincrement,
+  name text,
+  count integer,
+  score real,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+"""
+
+
+def rows(count):
+    return ({"name": "entry {}".format(i), "count": i, "score": i / 7.0}
+            for i in range(count))
+
+
+def create_each():
+    for row in rows(SINGLE_ROWS):
+        Entry.create(**row)
+
+
+def insert_many():
+    Entry.insert_many(rows(MANY_ROWS))
+
+
+def load_all():
+    for entry in Entry.all():
+        entry.name
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<12}{:>16}{:>16}{:>16}".format(
+            "profile", "create/s", "insert_many/s", "load/s"))
+        for profile in sorted(PROFILES):
+            path = os.path.join(directory, "{}.db".format(profile))
+            lazy_record.connect_db(path, profile=profile)
+            lazy_record.load_schema(schema)
+            created = timeit.timeit(create_each, number=1)
+            inserted = timeit.timeit(insert_many, number=1)
+            loaded = timeit.timeit(load_all, number=1)
+            lazy_record.close_db()
+            print("{:<12}{:>16.0f}{:>16.0f}{:>16.0f}".format(
+                profile, SINGLE_ROWS / created, MANY_ROWS / inserted,
+                (SINGLE_ROWS + MANY_ROWS) / loaded))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
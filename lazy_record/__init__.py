@@ -2,31 +2,138 @@ from query import Query
 from base import Base
 from errors import *
 from typecasts import *
+from lazy_record.statements import cache as statement_cache
+import lazy_record.profiles as profiles
+from lazy_record.events import on, off
+from lazy_record.slow_queries import log_slow_queries
+from lazy_record.n_plus_one import detect_n_plus_one
+from lazy_record.identity import identity_map
+from lazy_record.unit_of_work import session
+from lazy_record.retry import RetryPolicy
+import lazy_record.retry as retry
 
 
 __author__ = "Chase Conklin"
 
 
-def connect_db(database_name=":memory:"):
+def connect_db(database_name=":memory:", foreign_keys=False, pool_size=5,
+               pool_timeout=30.0, profile=None, retry_policy=None, readers=0,
+               replica=None, **settings):
     """
     Connect lazy_record to the database at the path specified in
-    +database_name+.
+    +database_name+. Pass +foreign_keys+ to have SQLite enforce the foreign
+    key constraints declared in the schema (including ON DELETE CASCADE).
+
+    Each thread gets a connection of its own from a pool of at most
+    +pool_size+ connections, waiting up to +pool_timeout+ seconds for one
+    when they are all in use. Threads keep their connection until they call
+    `release_db` (e.g. at the end of each request).
+
+    Pass the name of a tuning +profile+ (see `lazy_record.profiles`, e.g.
+    "throughput") and/or the +settings+ to use (journal_mode, synchronous,
+    cache_size, mmap_size, temp_store, busy_timeout, cached_statements) to
+    have them applied to every connection.
+
+    Saving, destroying, and writing in bulk are retried while they fail
+    because another connection holds the lock on the database (for longer
+    than the busy_timeout, in milliseconds), as +retry_policy+ (a
+    RetryPolicy) says.
+
+    Pass +readers+ to run queries on a separate pool of at most that many
+    read-only connections, to +replica+ (a copy of the database kept up to
+    date elsewhere) if given, leaving the pool of +pool_size+ connections to
+    writes. Threads writing (within a transaction, or while saving) read on
+    their writing connection, so that they see what they wrote. Readers of
+    the database itself need write-ahead logging (outside of it, a reader's
+    open cursor keeps the writer from committing), so journal_mode is set to
+    "WAL" unless given, and must not be set to anything else.
+
+    >>> lazy_record.connect_db("app.db", profile="throughput",
+    ...                        mmap_size=0, busy_timeout=2000, readers=8)
     """
-    db = repo.Repo.connect_db(database_name)
+    close_db()
+    if foreign_keys:
+        settings["foreign_keys"] = True
+    if readers and replica is None:
+        profile_settings = profiles.PROFILES.get(profile, {})
+        journal_mode = settings.get("journal_mode",
+                                    profile_settings.get("journal_mode"))
+        if journal_mode is None:
+            settings["journal_mode"] = "WAL"
+        elif journal_mode.upper() != "WAL":
+            raise ValueError("Readers need journal_mode WAL, not {}".format(
+                journal_mode))
+    statements, options = profiles.settings_for(profile, **settings)
+    db = repo.Repo.connect_db(database_name, pool_size=pool_size,
+                              pool_timeout=pool_timeout,
+                              statements=statements, options=options,
+                              readers=readers, replica=replica)
     base.Repo.db = db
     query.Repo.db = db
+    base.Repo.read_db = repo.Repo.read_db
+    query.Repo.read_db = repo.Repo.read_db
+    retry.policy = retry_policy or RetryPolicy()
+
+
+def release_db():
+    """
+    Return the current thread's connection to the pool opened in
+    `connect_db` (and its read-only connection, if any), rolling back
+    anything it left uncommitted.
+    """
+    for db in (repo.Repo.db, repo.Repo.read_db):
+        if db is not None:
+            db.release()
+
+
+def transaction(mode="DEFERRED"):
+    """
+    Start a transaction on the current thread's connection, committed when
+    the block ends (or rolled back if it raises). Records saved and destroyed
+    within it join it rather than committing on their own, and transactions
+    started within it are savepoints. +mode+ is "DEFERRED", "IMMEDIATE"
+    (take the write lock at once), or "EXCLUSIVE" (see `Transaction`).
+
+    >>> with lazy_record.transaction("IMMEDIATE"):
+    ...     for title in titles:
+    ...         Post.create(title=title)
+    """
+    return repo.Repo.db.transaction(mode)
+
+
+def pool_stats():
+    """
+    Statistics on the connection pool opened in `connect_db` (see
+    `Pool.stats`), for sizing it. Those of the read-only pool, if any, are
+    under "readers".
+    """
+    stats = repo.Repo.db.stats()
+    if repo.Repo.read_db is not None:
+        stats["readers"] = repo.Repo.read_db.stats()
+    return stats
+
+
+def retry_stats():
+    """
+    Statistics on the writes retried because the database was locked (see
+    `RetryPolicy.stats`), to see how much writers contend for it.
+    """
+    return retry.policy.stats()
 
 
 def close_db():
     """
-    Close the connection to the database opened in `connect_db`
+    Close the connections to the database opened in `connect_db`
     """
-    db = repo.Repo.db
-    if db is not None:
-        db.close()
+    for db in (repo.Repo.db, repo.Repo.read_db):
+        if db is not None:
+            db.close()
     repo.Repo.db = None
     base.Repo.db = None
     query.Repo.db = None
+    repo.Repo.read_db = None
+    base.Repo.read_db = None
+    query.Repo.read_db = None
 
 def load_schema(schema):
     """
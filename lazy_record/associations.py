@@ -1,6 +1,10 @@
 import query
 import repo
 from lazy_record.errors import *
+import lazy_record.metadata as metadata
+import lazy_record.n_plus_one as n_plus_one
+import lazy_record.identity as identity
+import lazy_record.unit_of_work as unit_of_work
 from inflector import Inflector, English
 
 inflector = Inflector(English)
@@ -9,9 +13,21 @@ models = {}
 associations = {}
 foreign_keys = {}
 scopes = {}
+reflections = {}
+class_names = {}
+singular_names = {}
 
 def model_from_name(parent_name):
-    return models[inflector.classify(parent_name)]
+    # Classifying the name is slow, and the names are few: remember them
+    if parent_name not in class_names:
+        class_names[parent_name] = inflector.classify(parent_name)
+    return models[class_names[parent_name]]
+
+def singular_name(table):
+    # As are singularizing table names, and the tables
+    if table not in singular_names:
+        singular_names[table] = inflector.singularize(table)
+    return singular_names[table]
 
 def _verify_type_match(record, association):
     associated_model = model_from_name(association)
@@ -25,10 +41,11 @@ def _verify_type_match(record, association):
             ))
 
 def model_has_foreign_key_for_table(table, model):
-    fk = foreign_keys_for(model).get(inflector.singularize(table), None)
+    compiled = model.__metadata__
+    fk = compiled.foreign_keys.get(singular_name(table), None)
     if fk is None:
         return True
-    return fk in model.__attributes__
+    return fk in compiled.attributes
 
 def foreign_keys_for(klass):
     if type(klass) == str:
@@ -51,6 +68,60 @@ def scopes_for(klass):
     scopes[klass_name] = scopes.get(klass_name, {})
     return scopes[klass_name]
 
+def reflections_for(klass):
+    if type(klass) == str:
+        klass_name = klass
+    else:
+        klass_name = klass.__name__
+    reflections[klass_name] = reflections.get(klass_name, {})
+    return reflections[klass_name]
+
+def preload(records, *paths):
+    """
+    Load the associations named in +paths+ for all of +records+ (which must
+    be of the same model) at once, so that accessing them on any of the
+    records does not query the database. Nested associations are separated
+    by dots.
+
+    ex)
+
+    >>> preload(posts, "author", "comments.author")
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split("."):
+            node = node.setdefault(name, {})
+    _preload_tree(list(records), tree)
+
+def _preload_tree(records, tree):
+    if not records:
+        return
+    model = records[0].__class__
+    for name, subtree in tree.items():
+        reflection = reflections_for(model).get(name)
+        if reflection is None:
+            raise QueryInvalid("'{}' has no association '{}'".format(
+                model.__name__, name))
+        _preload_tree(reflection.preload(records), subtree)
+
+def _preloaded(record):
+    return getattr(record, "_preloaded", {})
+
+def _in_chunks(values, size=500):
+    # Keep the number of parameters in each IN (...) below SQLite's limit
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _through_rows(q, table):
+    # Yields (parent id, child record) pairs for a query joined through
+    # +table+, whose ids are selected alongside the child's attributes
+    column = "{}.id".format(table)
+    for row in q._query_repo().select(*(list(q.attributes) + [column])):
+        args = dict(zip(q.attributes, row[:-1]))
+        yield row[-1], q.model.from_dict(**args)
+
 class belongs_to(object):
     """
     Decorator to establish this model as the child in a one-to-many
@@ -90,11 +161,27 @@ class belongs_to(object):
         foreign_keys_for(klass)[self.parent_name] = self.foreign_key
         # Add the relationship to the association list
         associations_for(klass)[self.parent_name] = None
+        reflections_for(klass)[self.parent_name] = self
 
         # Getter method for the parent record (e.g. comment.post)
         # Is added to the class as a property
         def parent_record_getter(wrapped_obj):
+            preloaded = _preloaded(wrapped_obj)
+            if self.parent_name in preloaded:
+                parent = preloaded[self.parent_name]
+                # Only use the preloaded parent if the foreign key still
+                # points to it
+                if getattr(parent, "id", None) == \
+                   getattr(wrapped_obj, self.foreign_key):
+                    return parent
             parent = model_from_name(self.parent_name)
+            identity_map = identity.current()
+            if identity_map is not None:
+                record = identity_map.get(
+                    parent, getattr(wrapped_obj, self.foreign_key))
+                if record is not None:
+                    return record
+            n_plus_one.loading(wrapped_obj, self.parent_name)
             # Not using parent.find() because it raises if it cannot find
             q = query.Query(parent)
             return q.where(id=getattr(wrapped_obj, self.foreign_key)).first()
@@ -105,6 +192,10 @@ class belongs_to(object):
                 _verify_type_match(new_parent, self.parent_name)
                 # We are setting a parent: grab it's id and use it
                 setattr(wrapped_obj, self.foreign_key, new_parent.id)
+                session = unit_of_work.current()
+                if new_parent.id is None and session is not None:
+                    # The session sets the id once it saves the parent
+                    session.link(wrapped_obj, self.foreign_key, new_parent)
             else:
                 # Un-setting a parent, set the foreign key to None
                 # Can't use new_parent.id since new_parent is None
@@ -119,8 +210,26 @@ class belongs_to(object):
         new_attributes = dict(klass.__attributes__)
         new_attributes[self.foreign_key] = int
         klass.__attributes__ = new_attributes
+        metadata.invalidate()
         return klass
 
+    def preload(self, records):
+        """
+        Load the parent of each of +records+ with one query, returning the
+        parents.
+        """
+        parent = model_from_name(self.parent_name)
+        ids = set(getattr(record, self.foreign_key) for record in records)
+        ids.discard(None)
+        parents = {}
+        for chunk in _in_chunks(ids):
+            for record in query.Query(parent).where(id=chunk):
+                parents[record.id] = record
+        for record in records:
+            record._preloaded[self.parent_name] = parents.get(
+                getattr(record, self.foreign_key))
+        return list(parents.values())
+
 
 # Currently exists only so that all models get registered
 class has_many(object):
@@ -129,14 +238,17 @@ class has_many(object):
     relationship or as one part of a many-to-many relationship
     """
     def __init__(self, child_name, scope=lambda query: query,
-                 foreign_key=None, through=None):
+                 foreign_key=None, through=None, on_delete_cascade=False):
         """
         +child_name+ is the child model (e.g. if a post has many comments:
         comments is the +child_name+). +foreign_key+ is the foreign key used in
         the child (this) record to hold the id of the parent record. By default
         it is the parent's model name, snake-cased, with "_id" appended
         (e.g. Post -> "post_id"). If this is a many-to-many relationship,
-        +through+ is the joining table.
+        +through+ is the joining table. Pass +on_delete_cascade+ when the
+        schema declares the foreign key "ON DELETE CASCADE" to leave deleting
+        the children to SQLite when the parent is destroyed (this requires
+        connecting with `connect_db(..., foreign_keys=True)`).
 
         Creates a getter property for child records and (if applicable the
         joining records).
@@ -150,6 +262,7 @@ class has_many(object):
         self.foreign_key = foreign_key
         self.through = through
         self.scope = scope
+        self.on_delete_cascade = on_delete_cascade
 
     def __call__(self, klass):
         self.klass = klass
@@ -178,6 +291,7 @@ class has_many(object):
             
         # Add the relationship to the association list
         associations_for(klass)[self.child_name] = self.through
+        reflections_for(klass)[self.child_name] = self
 
         # Add the child table (or joining table) to the classes dependents
         # so that if this record is destroyed, all related child records
@@ -201,18 +315,70 @@ class has_many(object):
                             repo.Repo.table_name(wrapped_obj.__class__)).where(
                             **{repo.Repo.table_name(wrapped_obj.__class__):
                             {'id': wrapped_obj.id}})
-                return self.scoping(result)
+                return self.with_preloaded(wrapped_obj, self.scoping(result))
         else:
             # Don't do a join
             def child_records_method(wrapped_obj):
                 child = model_from_name(self.child_name)
                 q = query.Query(child, record=wrapped_obj)
                 where_statement = {self.foreign_key: wrapped_obj.id}
-                return self.scoping(q.where(**where_statement))
+                return self.with_preloaded(
+                    wrapped_obj, self.scoping(q.where(**where_statement)))
 
         setattr(klass, self.child_name, property(child_records_method))
+        metadata.invalidate()
         return klass
 
+    def with_preloaded(self, record, query):
+        # Serve the records from the cache filled by `preload` if there is one
+        preloaded = _preloaded(record)
+        if self.child_name in preloaded:
+            return query.preloaded(preloaded[self.child_name])
+        # Reported when the query runs, as building or appending to it does
+        # not load anything
+        query._n_plus_one = (record, self.child_name)
+        return query
+
+    def preload(self, records):
+        """
+        Load the children of all of +records+ with one query, returning the
+        children.
+        """
+        child = model_from_name(self.child_name)
+        ids = set(record.id for record in records)
+        ids.discard(None)
+        children = {}
+        for chunk in _in_chunks(ids):
+            if self.through:
+                table = repo.Repo.table_name(self.klass)
+                q = self.scoping(query.Query(child).joins(table).where(
+                        **{table: {'id': chunk}}))
+                pairs = _through_rows(q, table)
+            else:
+                q = self.scoping(query.Query(child).where(
+                        **{self.foreign_key: chunk}))
+                pairs = ((getattr(record, self.foreign_key), record)
+                         for record in q)
+            for parent_id, record in pairs:
+                children.setdefault(parent_id, []).append(record)
+        for record in records:
+            record._preloaded[self.child_name] = children.get(record.id, [])
+        return [record for group in children.values() for record in group]
+
+    def dependents(self, parents):
+        """
+        Query for the children of all the records in the query +parents+, for
+        destroying them along with their parents.
+        """
+        child = model_from_name(self.child_name)
+        ids = parents._query_repo()
+        if self.through:
+            table = repo.Repo.table_name(self.klass)
+            q = query.Query(child).joins(table).where(**{table: {'id': ids}})
+        else:
+            q = query.Query(child).where(**{self.foreign_key: ids})
+        return self.scoping(q)
+
     def scoping(self, query):
         current = self.klass
         scopes = []
@@ -239,10 +405,12 @@ class has_one(object):
     Decorator to establish this model as the parent in a one-to-one
     relationship.
     """
-    def __init__(self, child_name, foreign_key=None, through=None):
+    def __init__(self, child_name, foreign_key=None, through=None,
+                 on_delete_cascade=False):
         self.child_name = child_name
         self.foreign_key = foreign_key
         self.through = through
+        self.on_delete_cascade = on_delete_cascade
         if str(self.through).endswith('s'):
             raise AssociationForbidden(
                 "Cannot have one '{}' through many '{}'".format(
@@ -257,6 +425,8 @@ class has_one(object):
         klass.__dependents__ = klass.__dependents__ + [self.child_name]
         # Add the relationship to the association list
         associations_for(klass)[self.child_name] = self.through
+        reflections_for(klass)[self.child_name] = self
+        self.klass = klass
         # Add the foreign key to the fk list
         foreign_keys_for(klass)[self.child_name] = self.foreign_key
         models[klass.__name__] = klass
@@ -268,6 +438,10 @@ class has_one(object):
         if self.through:
 
             def child_record_method(wrapped_obj):
+                preloaded = _preloaded(wrapped_obj)
+                if self.child_name in preloaded:
+                    return preloaded[self.child_name]
+                n_plus_one.loading(wrapped_obj, self.child_name)
                 child = model_from_name(self.child_name)
                 return query.Query(child, record=wrapped_obj).joins(
                           repo.Repo.table_name(wrapped_obj.__class__)).where(
@@ -276,6 +450,7 @@ class has_one(object):
 
             def set_child_record_method(wrapped_obj, new_value):
                 _verify_type_match(new_value, self.child_name)
+                _preloaded(wrapped_obj).pop(self.child_name, None)
                 child = model_from_name(self.child_name)
                 table = repo.Repo.table_name(wrapped_obj.__class__)
                 q = query.Query(child, record=wrapped_obj).joins(table
@@ -322,6 +497,10 @@ class has_one(object):
         else:
 
             def child_record_method(wrapped_obj):
+                preloaded = _preloaded(wrapped_obj)
+                if self.child_name in preloaded:
+                    return preloaded[self.child_name]
+                n_plus_one.loading(wrapped_obj, self.child_name)
                 child = model_from_name(self.child_name)
                 q = query.Query(child, record=wrapped_obj)
                 where_statement = {self.foreign_key: wrapped_obj.id}
@@ -329,6 +508,7 @@ class has_one(object):
 
             def set_child_record_method(wrapped_obj, child):
                 _verify_type_match(child, self.child_name)
+                _preloaded(wrapped_obj).pop(self.child_name, None)
                 # We are setting a child: set its foreign key to our id
                 if child is not None:
                     setattr(child, self.foreign_key, wrapped_obj.id)
@@ -341,4 +521,44 @@ class has_one(object):
 
         setattr(klass, self.child_name, property(child_record_method,
                                                  set_child_record_method))
+        metadata.invalidate()
         return klass
+
+    def preload(self, records):
+        """
+        Load the child of each of +records+ with one query, returning the
+        children.
+        """
+        child = model_from_name(self.child_name)
+        ids = set(record.id for record in records)
+        ids.discard(None)
+        children = {}
+        for chunk in _in_chunks(ids):
+            if self.through:
+                table = repo.Repo.table_name(self.klass)
+                q = query.Query(child).joins(table).where(
+                        **{table: {'id': chunk}})
+                pairs = _through_rows(q, table)
+            else:
+                q = query.Query(child).where(**{self.foreign_key: chunk})
+                pairs = ((getattr(record, self.foreign_key), record)
+                         for record in q)
+            for parent_id, record in pairs:
+                # Like `first`, keep only the first child found
+                children.setdefault(parent_id, record)
+        for record in records:
+            record._preloaded[self.child_name] = children.get(record.id)
+        return list(children.values())
+
+    def dependents(self, parents):
+        """
+        Query for the children of all the records in the query +parents+, for
+        destroying them along with their parents.
+        """
+        child = model_from_name(self.child_name)
+        ids = parents._query_repo()
+        if self.through:
+            table = repo.Repo.table_name(self.klass)
+            return query.Query(child).joins(table).where(
+                **{table: {'id': ids}})
+        return query.Query(child).where(**{self.foreign_key: ids})
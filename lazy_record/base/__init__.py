@@ -5,19 +5,30 @@ from query import Query
 from repo import Repo
 import datetime
 from lazy_record.errors import *
-import lazy_record.typecasts as typecasts
 from validations import Validations
 import lazy_record.associations as associations
+import lazy_record.metadata as metadata
+import lazy_record.identity as identity
+import lazy_record.unit_of_work as unit_of_work
+import lazy_record.retry as retry
 from itertools import chain
-from inflector import Inflector, English
 
-inflector = Inflector(English)
+
+# Bookkeeping of records of compact models, created when first needed
+compact_defaults = {
+    "_changes": dict,
+    "_related_records": list,
+    "_delete_related_records": list,
+    "_preloaded": dict,
+}
 
 
 class Base(Validations):
+    __slots__ = ()
     __attributes__ = {}
     __dependents__ = []
     __scopes__ = {}
+    __compact__ = False
 
     def __init__(self, **kwargs):
         """
@@ -27,17 +38,24 @@ class Base(Validations):
         if set(["id", "created_at", "updated_at"]) & set(kwargs):
             raise AttributeError("Cannot set 'id', 'created_at', "
                                  "or 'updated_at'")
+        if self.__compact__:
+            object.__setattr__(self, "_row", [])
+            object.__setattr__(self, "_layout", {})
         for attr in self.__class__.__all_attributes__:
             setattr(self, "_" + attr, None)
+        self._changes = {}
         self.update(**kwargs)
         self._id = None
-        self.__table = Repo.table_name(self.__class__)
         self._related_records = []
         self._delete_related_records = []
+        self._preloaded = {}
 
     def __getattr__(self, attr):
         """
         Get and cast +attr+ according to the __attributes__ class variable.
+        Columns are normally read through the descriptors the model's metadata
+        defines (see lazy_record.metadata.Attribute), which cache the cast
+        value, so this is only a fallback.
 
         ex)
         >>> class MyRecord(lazy_record.Base)
@@ -62,6 +80,11 @@ class Base(Validations):
                 raise MissingAttributeError(
                     "'{}' object has no attribute '{}'".format(
                     self.__class__.__name__, attr))
+        elif attr in compact_defaults and self.__compact__:
+            # Compact records only make their bookkeeping when first used
+            value = compact_defaults[attr]()
+            object.__setattr__(self, attr, value)
+            return value
         else:
             return self.__getattribute__(attr)
 
@@ -85,13 +108,59 @@ class Base(Validations):
             raise AttributeError("Cannot set '{}'".format(name))
         elif name in self.__class__.__attributes__:
             if value is not None:
-                setattr(self, "_" + name,
-                        self.__class__.__attributes__[name](value))
+                value = self.__class__.__attributes__[name](value)
+            self._track_change(name, value)
+            if self.__compact__:
+                super(Base, self).__setattr__("_" + name, value)
             else:
-                setattr(self, "_" + name, None)
+                state = self.__dict__
+                state["_" + name] = value
+                # Already cast: this is what reading the attribute returns
+                state[name] = value
         else:
+            column = name[1:]
+            if name[:1] == "_" and not self.__compact__ and (
+                    column == "id" or
+                    column in self.__class__.__all_attributes__):
+                # Forget the cast value read from the previous one
+                self.__dict__.pop(column, None)
             super(Base, self).__setattr__(name, value)
 
+    def _track_change(self, name, value):
+        # Remember the value +name+ had when last saved, forgetting the change
+        # if +value+ restores it
+        changes = self._changes
+        if name in changes:
+            original = changes[name][0]
+        else:
+            original = getattr(self, "_" + name, None)
+        if original == value:
+            changes.pop(name, None)
+        else:
+            changes[name] = (original, value)
+
+    @property
+    def changes(self):
+        """
+        Dictionary of the attributes changed since the record was last saved
+        (or loaded), mapped to (old value, new value) pairs.
+        """
+        return dict(self._changes)
+
+    @property
+    def changed(self):
+        """
+        Names of the attributes changed since the record was last saved.
+        """
+        return list(self._changes)
+
+    @property
+    def is_dirty(self):
+        """
+        True if any attribute was changed since the record was last saved.
+        """
+        return bool(self._changes)
+
     @classmethod
     def from_dict(cls, **kwargs):
         """
@@ -100,17 +169,81 @@ class Base(Validations):
         constructing objects already present in the database (i.e for use by
         methods such as find or within Query).
         """
-        # Create the object
-        obj = cls()
-        # By default, objects are initialized with attribute values of None
-        # We need to clear those out so that we get AttributeError on access
-        for attr in cls.__all_attributes__:
-            delattr(obj, "_" + attr)
-        del obj._id
-        # Set the attributes that were passed
-        for attr, val in kwargs.items():
-            setattr(obj, "_" + attr, val)
-        return obj
+        return cls.from_rows(list(kwargs), [list(kwargs.values())])[0]
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        """
+        Construct an object from each row in +rows+, whose values are those of
+        the attributes named in +columns+ (in order), ignoring all protections
+        of id and created_at. Attributes not in +columns+ are left unset, so
+        they raise MissingAttributeError on access. Intended for constructing
+        objects already present in the database (i.e. within Query).
+
+        The objects are built directly, without calling __init__ (so without
+        casting every attribute to None and looking up the table name for each
+        row), which makes loading many records much faster. Records of compact
+        models keep the row itself, along with a column layout shared by all
+        of +rows+.
+
+        >>> Entry.from_rows(["id", "name"], [(1, "foo"), (2, "bar")])
+        [Entry(id=1, name='foo'), Entry(id=2, name='bar')]
+        """
+        # Make sure the model's attributes are defined
+        metadata.metadata_for(cls)
+        new = object.__new__
+        records = []
+        if cls.__compact__:
+            layout = {column: index for index, column in enumerate(columns)}
+            assign = object.__setattr__
+            for row in rows:
+                record = new(cls)
+                assign(record, "_row", row)
+                assign(record, "_layout", layout)
+                records.append(record)
+            return records
+        layout = ["_" + column for column in columns]
+        for row in rows:
+            record = new(cls)
+            state = record.__dict__
+            state.update(zip(layout, row))
+            state["_changes"] = {}
+            state["_related_records"] = []
+            state["_delete_related_records"] = []
+            state["_preloaded"] = {}
+            records.append(record)
+        return records
+
+    @classmethod
+    @retry.retrying
+    def insert_many(cls, rows, return_ids=False, validate=False):
+        """
+        Insert every dictionary of attributes in +rows+ in a single
+        transaction, bypassing the per-record overhead of `save`. Attributes
+        are cast as in mass-assignment and timestamps are filled in, but
+        validations only run when +validate+ is True. Returns the ids of the
+        inserted records (in the order passed) if +return_ids+ is True.
+
+        >>> Entry.insert_many([{"name": "foo"}, {"name": "bar"}])
+        """
+        attributes = cls.__attributes__
+        today = datetime.datetime.today()
+        data = []
+        for row in rows:
+            if set(["id", "created_at", "updated_at"]) & set(row):
+                raise AttributeError("Cannot set 'id', 'created_at', "
+                                     "or 'updated_at'")
+            if validate:
+                cls(**row).validate()
+            values = {attr: (attributes[attr](val) if val is not None
+                             else None)
+                      for attr, val in row.items() if attr in attributes}
+            values["created_at"] = today
+            values["updated_at"] = today
+            data.append(values)
+        with Repo.db:
+            return Repo(Repo.table_name(cls)).insert_many(
+                data, return_ids=return_ids)
 
     def update(self, **kwargs):
         """
@@ -122,65 +255,93 @@ class Base(Validations):
                         list(associations.associations_for(self.__class__))):
                 setattr(self, attr, val)
 
+    @retry.retrying
     def delete(self):
         """
         Delete this record without deleting any dependent or child records.
         This can orphan records, so use with care.
         """
+        session = unit_of_work.current()
+        if session is not None:
+            session.delete(self, dependents=False)
+            return
         if self.id:
             with Repo.db:
-                Repo(self.__table).where(id=self.id).delete()
+                Repo(Repo.table_name(self.__class__)).where(
+                    id=self.id).delete()
+            identity_map = identity.current()
+            if identity_map is not None:
+                identity_map.discard(self)
 
     def _do_destroy(self):
-        Repo(self.__table).where(id=self.id).delete()
-        for dependent in set(self.__class__.__dependents__):
-            if dependent == inflector.singularize(dependent):
-                child = getattr(self, dependent)
-                if child:
-                    child._do_destroy()
-            else:
-                for record in (getattr(self, dependent) or []):
-                    record._do_destroy()
+        Query(self.__class__).where(id=self.id)._destroy_all()
 
+    @retry.retrying
     def destroy(self):
         """
-        Delete this record, while also destroying (i.e. calling destroy) on
-        all dependents and children.
+        Delete this record, while also destroying all dependents and children
+        (see `Query.destroy_all`).
         """
+        session = unit_of_work.current()
+        if session is not None:
+            session.delete(self)
+            return
         if self.id:
             with Repo.db:
                 self._do_destroy()
 
     def _do_save(self):
-        self.validate()
-        self._updated_at = datetime.datetime.today()
         if self.id:
-            attrs = list(self.__class__.__all_attributes__)
+            # Only write the changed columns, and only if there are any
+            if not self._changes:
+                return
+            self.validate()
+            self._updated_at = datetime.datetime.today()
+            attrs = list(self._changes) + ["updated_at"]
             data = {attr: getattr(self, "_" + attr) for attr in attrs}
-            Repo(self.__table).where(id=self.id).update(**data)
+            Repo(Repo.table_name(self.__class__)).where(
+                id=self.id).update(**data)
         else:
+            self.validate()
+            self._updated_at = datetime.datetime.today()
             attrs = list(self.__class__.__all_attributes__)
             self._created_at = datetime.datetime.today()
             data = {attr: getattr(self, "_" + attr) for attr in attrs}
-            self.__id = int(Repo(self.__table).insert(**data))
+            self.__id = int(Repo(Repo.table_name(self.__class__)).insert(
+                **data))
 
     def _finish_save(self):
         if not self.id:
             self._id = self.__id
+        self._changes = {}
         for record in self._related_records:
             if not record.id:
                 record._id = record.__id
+            record._changes = {}
+        identity_map = identity.current()
+        if identity_map is not None:
+            identity_map.add(self)
+            for record in self._related_records:
+                identity_map.add(record)
         self._related_records = []
+        # Associations loaded by `includes` may have changed
+        self._preloaded = {}
 
+    @retry.retrying
     def save(self):
         """
         Save a record to the database, creating it if needed, updating it
         otherwise. Also saves related records (children and dependents) as
-        needed.
+        needed. Inside a session (see `lazy_record.session`), the record is
+        only written when the session is flushed.
         """
+        session = unit_of_work.current()
+        if session is not None:
+            session.add(self)
+            return
         with Repo.db:
             self._do_save()
-            our_name = inflector.singularize(Repo.table_name(self.__class__))
+            our_name = self.__class__.__metadata__.singular_name
             for record in self._related_records:
                 if not self._id:
                     related_key = associations.foreign_keys_for(
@@ -234,6 +395,22 @@ class Base(Validations):
 
 
     class __metaclass__(type):
+        def __new__(mcs, name, bases, namespace):
+            # Records of compact models keep their values in a row (see
+            # lazy_record.metadata.CompactAttribute) and have no __dict__
+            compact_bases = [base for base in bases
+                             if getattr(base, "__compact__", False)]
+            if "__slots__" not in namespace and \
+               namespace.get("__compact__", bool(compact_bases)):
+                namespace["__compact__"] = True
+                if compact_bases:
+                    namespace["__slots__"] = ()
+                else:
+                    namespace["__slots__"] = (
+                        "_row", "_layout", "_Base__id", "__weakref__",
+                        ) + tuple(compact_defaults)
+            return type.__new__(mcs, name, bases, namespace)
+
         def get_scope(cls, scope_name):
             """
             Retrieve a scope method defined in __scopes__ and set the name
@@ -247,14 +424,17 @@ class Base(Validations):
             scope.__name__ = "<scope>{}".format(scope_name)
             return scope
 
+        @property
+        def __metadata__(cls):
+            """
+            The compiled metadata of the model (see lazy_record.metadata).
+            """
+            return metadata.metadata_for(cls)
+
         @property
         def __all_attributes__(cls):
-            attrs = dict(cls.__attributes__)
-            attrs.update({
-                "created_at": typecasts.datetime,
-                "updated_at": typecasts.datetime,
-            })
-            return attrs
+            # Shared by all records of the model: do not mutate
+            return metadata.metadata_for(cls).all_attributes
 
         def __len__(cls):
             return len(Query(cls).all())
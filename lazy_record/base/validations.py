@@ -2,6 +2,7 @@ from lazy_record.errors import *
 import lazy_record.validations as validators
 
 class Validations(object):
+    __slots__ = ()
     __validates__ = {}
 
     def is_valid(self, attrs = None):
@@ -18,3 +18,9 @@ class MissingAttributeError(Exception):
 
 class AssociationForbidden(Exception):
     pass
+
+class PoolTimeout(Exception):
+    pass
+
+class NPlusOneQuery(Exception):
+    pass
@@ -0,0 +1,179 @@
+"""
+Listeners for the statements lazy_record runs against the database.
+
+>>> def log(event):
+...     print event.operation, event.sql, event.duration
+>>> lazy_record.on("query", log)
+"""
+import time
+
+# Listeners of each event, as (listener, redact) pairs
+listeners = {
+    "query": [],
+}
+
+REDACTED = "?"
+
+
+def on(event, listener, redact=False):
+    """
+    Call +listener+ with a QueryEvent after each statement is run (for
+    selects, once all of their rows are fetched). Pass +redact+ to have the
+    listener receive "?" in place of each parameter.
+    """
+    if event not in listeners:
+        raise ValueError("Unknown event '{}' (expected one of {})".format(
+            event, ", ".join(sorted(listeners))))
+    listeners[event].append((listener, redact))
+
+
+def off(event, listener):
+    """
+    Stop calling +listener+ for +event+.
+    """
+    listeners[event][:] = [entry for entry in listeners[event]
+                           if entry[0] != listener]
+
+
+def model_for(table):
+    """
+    Get the model whose records are stored in +table+, if one was used.
+    """
+    import lazy_record.metadata as metadata
+    return metadata.models_by_table.get(table)
+
+
+class QueryEvent(object):
+    """
+    A statement that was run: its +sql+ and +params+ (a list of rows of
+    parameters for `executemany`), the +operation+ it performed ("select",
+    "count", "insert", "update", or "delete"), the +table+ and +model+ it
+    acted on, the number of +rows+ it returned (or changed), how long it took
+    in seconds (+duration+, including fetching the rows of a select), and
+    the +error+ it raised, if any.
+    """
+
+    def __init__(self, operation, table, sql, params, duration, rows,
+                 error=None):
+        self.operation = operation
+        self.table = table
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.rows = rows
+        self.error = error
+
+    @property
+    def model(self):
+        return model_for(self.table)
+
+    def redacted(self):
+        """
+        Copy of the event with each parameter replaced by "?".
+        """
+        def redact(params):
+            return [redact(value) if isinstance(value, (list, tuple))
+                    else REDACTED for value in params]
+        return QueryEvent(self.operation, self.table, self.sql,
+                          redact(self.params), self.duration, self.rows,
+                          self.error)
+
+    def __repr__(self):
+        return "<lazy_record.QueryEvent {} {!r} ({} rows, {:.6f}s)>".format(
+            self.operation, self.sql, self.rows, self.duration)
+
+
+def emit(event):
+    redacted = None
+    for listener, redact in list(listeners["query"]):
+        if redact:
+            if redacted is None:
+                redacted = event.redacted()
+            listener(redacted)
+        else:
+            listener(event)
+
+
+def execute(db, operation, table, sql, params, many=False):
+    """
+    Run +sql+ with +params+ on +db+ (using `executemany` if +many+),
+    emitting a QueryEvent for it. Selects (and counts) return a cursor that
+    emits the event once their rows are all fetched.
+    """
+    params = list(params or [])
+    started = time.time()
+    try:
+        if many:
+            cursor = db.executemany(sql, params)
+        else:
+            cursor = db.execute(sql, params)
+    except Exception as e:
+        emit(QueryEvent(operation, table, sql, params,
+                        time.time() - started, None, e))
+        raise
+    duration = time.time() - started
+    if operation in ("select", "count"):
+        return InstrumentedCursor(cursor, QueryEvent(
+            operation, table, sql, params, duration, 0))
+    emit(QueryEvent(operation, table, sql, params, duration,
+                    cursor.rowcount))
+    return cursor
+
+
+class InstrumentedCursor(object):
+    """
+    Wraps the cursor of a select, counting the rows fetched from it and the
+    time spent fetching them. Emits its event once the cursor is exhausted,
+    or when it is discarded before that.
+    """
+
+    def __init__(self, cursor, event):
+        self.cursor = cursor
+        self.event = event
+
+    def _fetched(self, started, rows, done):
+        event = self.event
+        if event is None:
+            return
+        event.duration += time.time() - started
+        event.rows += rows
+        if done:
+            self._emit()
+
+    def _emit(self):
+        event, self.event = self.event, None
+        if event is not None:
+            emit(event)
+
+    def fetchone(self):
+        started = time.time()
+        row = self.cursor.fetchone()
+        self._fetched(started, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.time()
+        if size is None:
+            size = self.cursor.arraysize
+        rows = self.cursor.fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.time()
+        rows = self.cursor.fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._emit()
+        self.cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __del__(self):
+        self._emit()
@@ -0,0 +1,118 @@
+"""
+Identity map: while one is started, every record loaded from the database is
+the same object as the other records of its model loaded with the same id.
+
+>>> with lazy_record.identity_map():
+...     [comment.post for comment in post.comments]  # a single Post object
+"""
+import weakref
+from lazy_record.thread_stack import ThreadStack
+
+maps = ThreadStack()
+
+
+def current():
+    """
+    The identity map started most recently in the current thread, if any.
+    """
+    return maps.current()
+
+
+def has_columns(record, columns):
+    # Whether +record+ holds a value for each of +columns+ (records loaded
+    # with `select` may not)
+    for column in columns:
+        try:
+            getattr(record, "_" + column)
+        except AttributeError:
+            return False
+    return True
+
+
+class IdentityMap(object):
+    """
+    Map of each model and id to the record loaded for them, for the current
+    thread while started (with `start` and `stop`, e.g. around a request, or
+    as a context manager). Records are held with weak references, so the map
+    keeps no record alive on its own.
+    """
+
+    def __init__(self):
+        self.records = weakref.WeakValueDictionary()
+
+    def get(self, model, id):
+        """
+        The record of +model+ with +id+ in the map, or None.
+        """
+        return self.records.get((model, id))
+
+    def add(self, record):
+        if record.id is not None:
+            self.records[(record.__class__, record.id)] = record
+
+    def discard(self, record):
+        if record.id is not None:
+            self.records.pop((record.__class__, record.id), None)
+
+    def forget(self, model):
+        """
+        Forget every record of +model+ (e.g. after they were written in bulk,
+        so those in the map may be out of date).
+        """
+        for key in list(self.records.keys()):
+            if key[0] is model:
+                self.records.pop(key, None)
+
+    def load(self, model, columns, rows):
+        """
+        Get the records of +model+ for +rows+ (holding the values of
+        +columns+), using the records in the map where there are some, and
+        building (and adding) the others with `from_rows`. Records that lack
+        some of +columns+ are replaced.
+        """
+        if "id" not in columns:
+            return model.from_rows(columns, rows)
+        position = list(columns).index("id")
+        records = [None] * len(rows)
+        missing = []
+        for index, row in enumerate(rows):
+            record = self.records.get((model, row[position]))
+            if record is not None and has_columns(record, columns):
+                records[index] = record
+            else:
+                missing.append(index)
+        if missing:
+            built = model.from_rows(columns, [rows[index]
+                                              for index in missing])
+            for index, record in zip(missing, built):
+                self.add(record)
+                records[index] = record
+        return records
+
+    def start(self):
+        maps.push(self)
+        return self
+
+    def stop(self):
+        """
+        Stop using the map, and forget its records.
+        """
+        maps.remove(self)
+        self.records.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __len__(self):
+        return len(self.records)
+
+
+def identity_map():
+    """
+    Start an identity map for the current thread. Use it as a context
+    manager, or call `stop` on the IdentityMap it returns.
+    """
+    return IdentityMap().start()
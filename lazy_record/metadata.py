@@ -0,0 +1,212 @@
+"""
+Compiled metadata about models (table name, columns, typecasts, foreign keys,
+dependents, and associations), built once per model rather than on every
+record or query.
+"""
+from inflector import Inflector, English
+import lazy_record.typecasts as typecasts
+from lazy_record.errors import MissingAttributeError
+
+inflector = Inflector(English)
+
+# Bumped whenever an association is declared, since that can change the
+# foreign keys, associations, and attributes of any model
+generation = 0
+
+# The model of each table, by the name of the table
+models_by_table = {}
+
+
+def invalidate():
+    """
+    Mark the metadata of every model as stale, so that it is compiled again
+    on next use. Called by the association decorators.
+    """
+    global generation
+    generation += 1
+
+
+def metadata_for(model):
+    """
+    Get the compiled Metadata of +model+, compiling it on first use or if it
+    is stale (i.e. associations were declared, or the model's __attributes__
+    or __dependents__ were replaced, since it was compiled).
+    """
+    # Look in the class' own dictionary, so that subclasses do not pick up
+    # the metadata of their parent
+    metadata = model.__dict__.get("_metadata")
+    if metadata is None or metadata.is_stale():
+        metadata = Metadata(model)
+        model._metadata = metadata
+        models_by_table[metadata.table_name] = model
+        install_attributes(model, metadata)
+    return metadata
+
+
+class Attribute(object):
+    """
+    Descriptor for reading the column +name+ of a model's records, which
+    holds its value (as loaded or assigned) under "_name". The first read
+    casts the value and stores the result in the record's own dictionary
+    under "name", where later reads find it without calling the descriptor
+    (so it must be cleared whenever "_name" is written; Base.__setattr__
+    takes care of that). Raises MissingAttributeError if the record has no
+    value for the column (e.g. it was left out by `select`).
+    """
+
+    def __init__(self, name, cast=None):
+        self.name = name
+        self.key = "_" + name
+        self.cast = cast
+
+    def __get__(self, record, model):
+        if record is None:
+            return self
+        state = record.__dict__
+        try:
+            value = state[self.key]
+        except KeyError:
+            raise MissingAttributeError(
+                "'{}' object has no attribute '{}'".format(
+                model.__name__, self.name))
+        if value is not None and self.cast is not None:
+            value = self.cast(value)
+        state[self.name] = value
+        return value
+
+
+class CompactAttribute(object):
+    """
+    Descriptor for reading the column +name+ of the records of a compact
+    model, which hold their values in a row (a tuple, or a list once a value
+    is assigned) along with a layout mapping each column to its position in
+    the row. Layouts are shared by all the records loaded by a query. To keep
+    records small, values are cast on every read rather than cached.
+    """
+
+    def __init__(self, name, cast=None):
+        self.name = name
+        self.cast = cast
+
+    def __get__(self, record, model):
+        if record is None:
+            return self
+        try:
+            value = record._row[record._layout[self.name]]
+        except KeyError:
+            raise MissingAttributeError(
+                "'{}' object has no attribute '{}'".format(
+                model.__name__, self.name))
+        if value is not None and self.cast is not None:
+            return self.cast(value)
+        return value
+
+
+class CompactValue(object):
+    """
+    Descriptor for the value of the column +name+ as stored in the row of a
+    record of a compact model (i.e. "_name", which is kept in the __dict__ of
+    records of other models).
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, record, model):
+        if record is None:
+            return self
+        try:
+            return record._row[record._layout[self.name]]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '_{}'".format(
+                model.__name__, self.name))
+
+    def __set__(self, record, value):
+        row = record._row
+        layout = record._layout
+        if self.name not in layout:
+            # The layout may be shared with other records: extend a copy
+            layout = dict(layout)
+            layout[self.name] = len(row)
+            object.__setattr__(record, "_layout", layout)
+            row = list(row) + [value]
+        else:
+            if type(row) is not list:
+                row = list(row)
+            row[layout[self.name]] = value
+        object.__setattr__(record, "_row", row)
+
+
+def install_attributes(model, metadata):
+    """
+    Define an Attribute on +model+ for each of its columns (or, for compact
+    models, a CompactAttribute and a CompactValue), removing those of columns
+    it no longer has. Leaves alone anything else the model (or its parents)
+    defines under a column's name.
+    """
+    casts = dict(metadata.all_attributes, id=None)
+    descriptors = {}
+    for name, cast in casts.items():
+        if model.__compact__:
+            descriptors[name] = CompactAttribute(name, cast)
+            descriptors["_" + name] = CompactValue(name)
+        else:
+            descriptors[name] = Attribute(name, cast)
+    kinds = (Attribute, CompactAttribute, CompactValue)
+    for name, value in list(model.__dict__.items()):
+        if isinstance(value, kinds) and name not in descriptors:
+            delattr(model, name)
+    for name, descriptor in descriptors.items():
+        existing = None
+        for klass in model.__mro__:
+            if name in klass.__dict__:
+                existing = klass.__dict__[name]
+                break
+        if existing is None or isinstance(existing, kinds):
+            setattr(model, name, descriptor)
+
+
+class Metadata(object):
+    """
+    Read-only description of a model, compiled from its class variables and
+    the association registries. The dictionaries it holds are shared by all
+    of the model's records and queries, so they must not be mutated.
+    """
+
+    def __init__(self, model):
+        # Imported here, as associations imports this module
+        import lazy_record.associations as associations
+        assign = super(Metadata, self).__setattr__
+        assign("model", model)
+        assign("generation", generation)
+        assign("source", (model.__attributes__, model.__dependents__))
+        assign("table_name", inflector.tableize(model.__name__))
+        assign("singular_name", inflector.singularize(self.table_name))
+        # The column other models refer to this one by, unless told otherwise
+        assign("foreign_key", inflector.foreignKey(model.__name__))
+        assign("attributes", dict(model.__attributes__))
+        all_attributes = dict(model.__attributes__)
+        all_attributes.update({
+            "created_at": typecasts.datetime,
+            "updated_at": typecasts.datetime,
+        })
+        assign("all_attributes", all_attributes)
+        assign("columns", tuple(["id"] + list(all_attributes)))
+        assign("foreign_keys", dict(associations.foreign_keys_for(model)))
+        assign("associations", dict(associations.associations_for(model)))
+        dependents = []
+        for dependent in model.__dependents__:
+            if dependent not in dependents:
+                dependents.append(dependent)
+        assign("dependents", tuple(dependents))
+
+    def is_stale(self):
+        return (self.generation != generation or
+                self.source[0] is not self.model.__attributes__ or
+                self.source[1] is not self.model.__dependents__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Model metadata is read-only")
+
+    def __repr__(self):
+        return "<lazy_record.Metadata {}>".format(self.model.__name__)
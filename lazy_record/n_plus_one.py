@@ -0,0 +1,128 @@
+"""
+Detection of N+1 queries: an association loaded one record at a time (e.g.
+in a loop) rather than for every record at once with `includes`.
+
+>>> with lazy_record.detect_n_plus_one(strict=True):
+...     for post in Post.all():
+...         post.author
+NPlusOneQuery: Post.author loaded for 2 records (at app.py:3 in index)
+"""
+import logging
+import os
+import sys
+from lazy_record.errors import NPlusOneQuery
+from lazy_record.thread_stack import ThreadStack
+
+logger = logging.getLogger("lazy_record.n_plus_one")
+
+detectors = ThreadStack()
+
+# Frames in this package are skipped when looking for the call site
+package = os.path.dirname(os.path.abspath(__file__))
+
+
+def loading(record, association):
+    """
+    Note that +association+ of +record+ is being loaded with a query of its
+    own. Called by the association getters.
+    """
+    for detector in detectors.items():
+        detector.record(record, association)
+
+
+def call_site():
+    # The innermost frame outside of lazy_record
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(package + os.sep):
+            return "{}:{} in {}".format(frame.f_code.co_filename,
+                                        frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+
+class NPlusOne(object):
+    """
+    An association (+association+ of +model+) loaded one record at a time
+    from +call_site+, for +count+ different records.
+    """
+
+    def __init__(self, model, association, call_site):
+        self.model = model
+        self.association = association
+        self.call_site = call_site
+        self.ids = set()
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def __str__(self):
+        return "{}.{} loaded for {} records (at {})".format(
+            self.model.__name__, self.association, self.count,
+            self.call_site)
+
+    def __repr__(self):
+        return "<lazy_record.NPlusOne {}>".format(self)
+
+
+class Detector(object):
+    """
+    Watches for associations loaded, from the same call site, for at least
+    +threshold+ different records of the same model, in the current thread
+    while the detector is started (with `start` and `stop`, e.g. around a
+    request, or as a context manager). When +strict+, raises NPlusOneQuery
+    as soon as that happens; otherwise logs a warning (to +logger+) for each
+    one found when stopped. Those found are kept in +found+.
+    """
+
+    def __init__(self, threshold=2, strict=False, logger=logger):
+        self.threshold = threshold
+        self.strict = strict
+        self.logger = logger
+        self.loads = {}
+
+    @property
+    def found(self):
+        return [load for load in self.loads.values()
+                if load.count >= self.threshold]
+
+    def record(self, record, association):
+        site = call_site()
+        key = (record.__class__, association, site)
+        load = self.loads.get(key)
+        if load is None:
+            load = self.loads[key] = NPlusOne(record.__class__, association,
+                                              site)
+        load.ids.add(record.id)
+        if self.strict and load.count == self.threshold:
+            raise NPlusOneQuery(str(load))
+
+    def start(self):
+        detectors.push(self)
+        return self
+
+    def stop(self):
+        """
+        Stop watching, logging the N+1 queries found (unless strict).
+        """
+        detectors.remove(self)
+        if not self.strict:
+            for load in self.found:
+                self.logger.warning("N+1 query: {}".format(load))
+        return self.found
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def detect_n_plus_one(threshold=2, strict=False, **options):
+    """
+    Start detecting N+1 queries in the current thread (see Detector). Use it
+    as a context manager, or call `stop` on the Detector it returns.
+    """
+    return Detector(threshold, strict, **options).start()
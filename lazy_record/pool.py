@@ -0,0 +1,335 @@
+"""
+Pool of sqlite3 connections, which hands each thread a connection of its own.
+"""
+import sqlite3
+import threading
+import time
+from lazy_record.errors import PoolTimeout
+
+
+class Pool(object):
+    """
+    Bounded pool of at most +size+ connections to +database+. Each thread
+    checks a connection out the first time it uses the pool, and keeps it
+    until it calls `release` (e.g. at the end of a request), so connections
+    are never shared between threads. The connections of threads that end
+    without releasing them are taken back (and rolled back) once another
+    thread needs one. Threads wait up to +timeout+ seconds
+    for a connection when all of them are checked out. The +statements+ (e.g.
+    PRAGMAs) are run on every connection when it is opened, and the
+    +options+ are passed to sqlite3.connect (e.g. cached_statements).
+
+    The pool stands in for a connection: `execute`, `executemany`,
+    `executescript`, `commit`, `rollback`, and `with pool:` all act on the
+    current thread's connection. Within a transaction started with
+    `transaction`, `with pool:` blocks join it as savepoints rather than
+    committing.
+
+    An in-memory database (":memory:") only exists within a single
+    connection, so its pool opens one connection that every thread shares.
+    """
+
+    # Seconds between looking for connections of ended threads while waiting
+    RECLAIM_INTERVAL = 0.05
+
+    def __init__(self, database=":memory:", size=5, timeout=30.0,
+                 statements=(), options={}):
+        self.database = database
+        self.shared = database == ":memory:"
+        self.size = 1 if self.shared else size
+        self.timeout = timeout
+        self.statements = list(statements)
+        self.options = dict(options)
+        self.idle = []
+        self.opened = []
+        # The connection checked out by each thread
+        self.owners = {}
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.reclaimed = 0
+
+    def connect(self):
+        """
+        Open a new connection to the database.
+        """
+        # Connections are only ever used by one thread at a time, but may be
+        # used by several threads over their life
+        connection = sqlite3.connect(self.database,
+                                     detect_types=sqlite3.PARSE_DECLTYPES,
+                                     check_same_thread=False,
+                                     **self.options)
+        for statement in self.statements:
+            connection.execute(statement)
+        return connection
+
+    def connection(self):
+        """
+        Get the current thread's connection, checking one out if the thread
+        does not have one.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.checkout()
+            self.local.connection = connection
+            if not self.shared:
+                with self.condition:
+                    self.owners[threading.current_thread()] = connection
+        return connection
+
+    def checkout(self):
+        """
+        Take a connection out of the pool, opening a new one if there is
+        room, or waiting for one to be released otherwise. Raises PoolTimeout
+        if none is released within the timeout.
+        """
+        with self.condition:
+            self.checkouts += 1
+            if self.shared and self.opened:
+                return self.opened[0]
+            if not self.idle and len(self.opened) >= self.size:
+                self.reclaim()
+            if not self.idle and len(self.opened) >= self.size:
+                self.waits += 1
+                started = time.time()
+                deadline = started + self.timeout
+                while not self.idle and len(self.opened) >= self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.wait_time += time.time() - started
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            "No connection available after {} seconds"
+                            .format(self.timeout))
+                    # Nothing tells us when a thread ends: look again now
+                    # and then
+                    self.condition.wait(min(remaining, self.RECLAIM_INTERVAL))
+                    self.reclaim()
+                self.wait_time += time.time() - started
+            if self.idle:
+                return self.idle.pop()
+            connection = self.connect()
+            self.opened.append(connection)
+            return connection
+
+    def reclaim(self):
+        """
+        Return the connections of threads that have ended to the pool,
+        rolling back anything they left uncommitted. Must be called with the
+        condition held.
+        """
+        for thread, connection in list(self.owners.items()):
+            if thread.is_alive():
+                continue
+            del self.owners[thread]
+            if connection not in self.opened:
+                continue
+            if connection.isolation_level is None:
+                # The thread ended within a transaction of its own
+                try:
+                    connection.execute("ROLLBACK")
+                except sqlite3.OperationalError:
+                    pass
+                connection.isolation_level = self.options.get(
+                    "isolation_level", "")
+            connection.rollback()
+            self.idle.append(connection)
+            self.reclaimed += 1
+
+    def release(self):
+        """
+        Return the current thread's connection (if it has one) to the pool,
+        rolling back anything it left uncommitted.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            return
+        transactions = self.transactions()
+        if transactions:
+            transactions[0].abandon(connection)
+            del transactions[:]
+        self.local.blocks = []
+        self.local.connection = None
+        if self.shared:
+            return
+        connection.rollback()
+        with self.condition:
+            self.owners.pop(threading.current_thread(), None)
+            if connection in self.opened:
+                self.idle.append(connection)
+                self.condition.notify()
+
+    def close(self):
+        """
+        Close every connection of the pool.
+        """
+        with self.condition:
+            for connection in self.opened:
+                connection.close()
+            self.opened = []
+            self.idle = []
+            self.owners = {}
+            self.local = threading.local()
+            self.condition.notify_all()
+
+    def stats(self):
+        """
+        Dictionary of the number of checkouts, how many of them had to wait
+        (and how long they waited in total), how many timed out, how many
+        connections were taken back from threads that ended without releasing
+        them, and how many connections are open, idle, and in use.
+        """
+        with self.condition:
+            return {
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "timeouts": self.timeouts,
+                "reclaimed": self.reclaimed,
+                "size": self.size,
+                "open": len(self.opened),
+                "idle": len(self.idle),
+                "in_use": len(self.opened) - len(self.idle),
+            }
+
+    def transaction(self, mode="DEFERRED"):
+        """
+        Transaction on the current thread's connection (see Transaction), to
+        be used as a context manager.
+        """
+        return Transaction(self, mode)
+
+    def transactions(self):
+        """
+        The transactions (and savepoints) open in the current thread,
+        outermost first.
+        """
+        transactions = getattr(self.local, "transactions", None)
+        if transactions is None:
+            transactions = self.local.transactions = []
+        return transactions
+
+    def writing(self):
+        """
+        Whether the current thread is within a transaction or a `with pool:`
+        block.
+        """
+        return bool(getattr(self.local, "blocks", None) or
+                    getattr(self.local, "transactions", None))
+
+    def in_transaction(self):
+        """
+        Whether the current thread has a transaction open.
+        """
+        return bool(getattr(self.local, "transactions", None))
+
+    def execute(self, *args):
+        return self.connection().execute(*args)
+
+    def executemany(self, *args):
+        return self.connection().executemany(*args)
+
+    def executescript(self, *args):
+        return self.connection().executescript(*args)
+
+    def commit(self):
+        self.connection().commit()
+
+    def rollback(self):
+        self.connection().rollback()
+
+    def __enter__(self):
+        # Within a transaction, the block is a savepoint of it
+        if self.in_transaction():
+            block = self.transaction()
+        else:
+            block = self.connection()
+        if getattr(self.local, "blocks", None) is None:
+            self.local.blocks = []
+        self.local.blocks.append(block)
+        return block.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.local.blocks.pop().__exit__(*exc_info)
+
+    def __repr__(self):
+        return "<lazy_record.Pool {!r}>".format(self.database)
+
+
+class Transaction(object):
+    """
+    Transaction on the current thread's connection of +pool+, committed when
+    its block ends, or rolled back if the block raises. +mode+ is how SQLite
+    locks the database for it: "DEFERRED" (when the transaction first reads,
+    then writes), "IMMEDIATE" (take the write lock at once, so the
+    transaction cannot fail to get it half way through), or "EXCLUSIVE"
+    (also keep readers out, outside of WAL mode).
+
+    Transactions started within another one are savepoints of it: rolling
+    one back only undoes what was done within it, and what it did is only
+    committed with the outermost transaction (whose mode applies).
+    """
+
+    MODES = ("DEFERRED", "IMMEDIATE", "EXCLUSIVE")
+
+    def __init__(self, pool, mode="DEFERRED"):
+        mode = mode.upper()
+        if mode not in self.MODES:
+            raise ValueError("Unknown mode '{}' (expected one of {})".format(
+                mode, ", ".join(self.MODES)))
+        self.pool = pool
+        self.mode = mode
+        self.savepoint = None
+        self.isolation_level = None
+
+    def __enter__(self):
+        connection = self.pool.connection()
+        transactions = self.pool.transactions()
+        if transactions:
+            self.savepoint = "lazy_record_{}".format(len(transactions))
+            connection.execute("SAVEPOINT " + self.savepoint)
+        else:
+            # sqlite3 begins (and commits) transactions of its own around
+            # statements unless the connection is in autocommit mode
+            self.isolation_level = connection.isolation_level
+            connection.isolation_level = None
+            try:
+                connection.execute("BEGIN " + self.mode)
+            except Exception:
+                connection.isolation_level = self.isolation_level
+                raise
+        transactions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.pool.connection()
+        self.pool.transactions().pop()
+        if self.savepoint is not None:
+            if exc_type is not None:
+                connection.execute("ROLLBACK TO " + self.savepoint)
+            connection.execute("RELEASE " + self.savepoint)
+            return False
+        if exc_type is not None:
+            self.abandon(connection)
+            return False
+        try:
+            connection.execute("COMMIT")
+        except Exception:
+            self.abandon(connection)
+            raise
+        connection.isolation_level = self.isolation_level
+        return False
+
+    def abandon(self, connection):
+        """
+        Roll the (outermost) transaction back on +connection+, if SQLite has
+        not already done so.
+        """
+        try:
+            connection.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            pass
+        connection.isolation_level = self.isolation_level
@@ -0,0 +1,73 @@
+"""
+Named sets of connection settings (PRAGMAs and sqlite3 connection options),
+applied to every connection of the pool opened by `connect_db`.
+"""
+
+# Settings run as "PRAGMA name = value" on each new connection
+PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size",
+           "temp_store", "foreign_keys", "busy_timeout")
+
+# Settings passed to sqlite3.connect
+CONNECT_OPTIONS = ("cached_statements",)
+
+PROFILES = {
+    # SQLite's own defaults
+    "default": {},
+    # Readers do not block the writer, and commits still wait for the disk
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+    },
+    # Commits only wait for the disk at checkpoints (a power loss may undo
+    # the last transactions, but cannot corrupt the database), with a 64MB
+    # page cache and 256MB of memory-mapped I/O
+    "throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "cached_statements": 500,
+    },
+    # For filling a database that can be rebuilt if the process crashes:
+    # nothing waits for the disk, and the journal is kept in memory
+    "bulk_load": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "cache_size": -256000,
+        "temp_store": "MEMORY",
+        "cached_statements": 500,
+    },
+}
+
+
+def settings_for(profile=None, **overrides):
+    """
+    Get the settings of the profile named +profile+ (if any) with the
+    settings in +overrides+ replacing its own, as a list of PRAGMA statements
+    and a dictionary of options for sqlite3.connect. Settings set to None are
+    left at SQLite's default.
+
+    >>> settings_for("safe", synchronous="NORMAL")
+    (['PRAGMA journal_mode = WAL', 'PRAGMA synchronous = NORMAL'], {})
+    """
+    if profile is not None and profile not in PROFILES:
+        raise ValueError("Unknown profile '{}' (expected one of {})".format(
+            profile, ", ".join(sorted(PROFILES))))
+    settings = dict(PROFILES.get(profile, {}))
+    settings.update(overrides)
+    pragmas, options = [], {}
+    for name in settings:
+        if name not in PRAGMAS + CONNECT_OPTIONS:
+            raise ValueError("Unknown connection setting '{}'".format(name))
+    for name in PRAGMAS:
+        value = settings.get(name)
+        if value is None:
+            continue
+        if value is True or value is False:
+            value = "ON" if value else "OFF"
+        pragmas.append("PRAGMA {} = {}".format(name, value))
+    for name in CONNECT_OPTIONS:
+        if settings.get(name) is not None:
+            options[name] = settings[name]
+    return pragmas, options
@@ -2,10 +2,10 @@ from repo import Repo
 import sys
 import os
 import types
+import sqlite3
+import lazy_record.retry as retry
 sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
-from inflector import Inflector, English
 
-inflector = Inflector(English)
 
 def does_not_mutate(func):
     """Prevents methods from mutating the receiver"""
@@ -39,6 +39,12 @@ class Query(object):
         self._order_with = {}
         self.group_column = None
         self.limit_count = None
+        self.batch_size = 500
+        self.include_paths = []
+        self._preloaded = None
+        # The record and association this query loads, if any, reported
+        # to N+1 detection whenever it is run
+        self._n_plus_one = None
         self.attributes = ["id"] + list(self.model.__all_attributes__)
         self.table = Repo.table_name(self.model)
 
@@ -50,7 +56,10 @@ class Query(object):
         q.join_args = list(self.join_args)
         q._order_with = dict(self._order_with)
         q.group_column = self.group_column
+        q.batch_size = self.batch_size
+        q.include_paths = list(self.include_paths)
         q.attributes = list(self.attributes)
+        q._n_plus_one = self._n_plus_one
         return q
 
     def all(self):
@@ -62,9 +71,20 @@ class Query(object):
     def find(self, id):
         """
         Find record by +id+, raising RecordNotFound if no record exists.
-        """
+        Unrestricted queries return the record in the identity map, if there
+        is one, without querying.
+        """
+        identity_map = identity.current()
+        if identity_map is not None and not self._is_restricted():
+            record = identity_map.get(self.model, id)
+            if record is not None:
+                return record
         return self.find_by(id=id)
 
+    def _is_restricted(self):
+        return bool(self.where_query or self.custom_where or self.join_args or
+                    self.group_column or self.having_args)
+
     def find_by(self, **kwargs):
         """
         Find first record subject to restrictions in +kwargs+, raising
@@ -89,9 +109,7 @@ class Query(object):
         if not records:
             return None
         if count == 1:
-            record = records[0]
-            args = dict(zip(self.attributes, record))
-            return self.model.from_dict(**args)
+            return self._records([records[0]])[0]
         return self
 
     @does_not_mutate
@@ -158,27 +176,25 @@ class Query(object):
                 #       {'table': 'threads', 'on': ['forum_id', 'id']}
                 #       {'table': 'posts', 'on': ['thread_id', 'id']}
                 #    ]
-                if table in associations.associations_for(model):
+                compiled = model.__metadata__
+                if table in compiled.associations:
                     # This to next: one-many (they have the fk)
-                    # If associations.associations_for(model)[table] is None, then this is
+                    # If compiled.associations[table] is None, then this is
                     # terminal (i.e. table is the FINAL association in the
                     # chain)
-                    next_level = associations.associations_for(model)[table] or table
+                    next_level = compiled.associations[table] or table
                     next_model = associations.model_from_name(next_level)
-                    foreign_key = associations.foreign_keys_for(model).get(
-                        next_level,
-                        inflector.foreignKey(model.__name__))
+                    foreign_key = compiled.foreign_keys.get(
+                        next_level, compiled.foreign_key)
                     yield {'table': next_level, 'on': [foreign_key, 'id']}
                 else:
                     # One-One or Many-One
-                    # singular table had better be in associations.associations_for(model)
-                    singular = inflector.singularize(table)
-                    next_level = associations.associations_for(model)[singular] or singular
+                    # singular table had better be in compiled.associations
+                    singular = associations.singular_name(table)
+                    next_level = compiled.associations[singular] or singular
                     next_model = associations.model_from_name(next_level)
-                    this_table_name = Repo.table_name(model)
-                    foreign_key = associations.foreign_keys_for(model).get(
-                        next_level,
-                        inflector.foreignKey(model.__name__))
+                    foreign_key = compiled.foreign_keys.get(
+                        next_level, compiled.foreign_key)
                     if associations.model_has_foreign_key_for_table(table,
                                                                     model):
                         # we have the foreign key
@@ -186,7 +202,8 @@ class Query(object):
                     else:
                         # They have the foreign key
                         order = [foreign_key, 'id']
-                    yield {'table': inflector.pluralize(next_level), 'on': order}
+                    yield {'table': next_model.__metadata__.table_name,
+                           'on': order}
                 model = next_model
 
         self.join_args = list(do_join(table, self.model))
@@ -212,6 +229,41 @@ class Query(object):
         self.having_args.append(tuple(conditions))
         return self
 
+    @does_not_mutate
+    def includes(self, *associations):
+        """
+        Eager load the passed +associations+ of the records in the query,
+        running one query per association for each batch of records rather
+        than one per record. Nested associations are separated by dots.
+
+        >>> Post.all().includes("author", "comments.author")
+        """
+        self.include_paths.extend(associations)
+        return self
+
+    @does_not_mutate
+    def preloaded(self, records):
+        """
+        Use +records+ (already loaded from the database) as the result of the
+        query. Intended for use by associations: any further refinement of
+        the query queries the database as normal.
+        """
+        self._preloaded = list(records)
+        return self
+
+    @does_not_mutate
+    def stream(self, batch_size=1000):
+        """
+        Iterate over the records of the query fetching +batch_size+ rows from
+        the database at a time, so that memory use does not grow with the
+        size of the result. Records are streamed in id order; queries with
+        another order, a grouping, or a limit are read at once instead.
+        """
+        if batch_size < 1:
+            raise QueryInvalid("Batch size must be positive.")
+        self.batch_size = batch_size
+        return self
+
     @does_not_mutate
     def select(self, *fields):
         """
@@ -221,6 +273,243 @@ class Query(object):
         self.attributes = fields
         return self
 
+    def pluck(self, *columns):
+        """
+        Get the values of +columns+ for each record in the query, without
+        building the records: a list of values when given one column, or a
+        list of tuples otherwise. Values are cast as they are for records.
+
+        >>> Post.where(author_id=7).pluck("id")
+        [3, 8, 11]
+        >>> Post.where(author_id=7).pluck("id", "title")
+        [(3, "First"), (8, "Second"), (11, "Third")]
+        """
+        rows = self._column_values(columns)
+        if len(columns) == 1:
+            return [row[0] for row in rows]
+        return rows
+
+    def values(self, *columns):
+        """
+        Get the values of +columns+ (or of the selected columns, if none are
+        passed) for each record in the query as a dictionary, without
+        building the records.
+
+        >>> Post.where(author_id=7).values("id", "title")
+        [{"id": 3, "title": "First"}, ...]
+        """
+        columns = columns or tuple(self.attributes)
+        return [dict(zip(columns, row))
+                for row in self._column_values(columns)]
+
+    def sum(self, column):
+        """
+        Sum of the values of +column+ in the query, computed by the database
+        (see `count` for grouped queries).
+        """
+        return self._aggregate("sum", column)
+
+    def average(self, column):
+        """
+        Average of the values of +column+ in the query (see `sum`).
+        """
+        return self._aggregate("avg", column)
+
+    def minimum(self, column):
+        """
+        Smallest value of +column+ in the query (see `sum`).
+        """
+        return self._aggregate("min", column, cast=True)
+
+    def maximum(self, column):
+        """
+        Largest value of +column+ in the query (see `sum`).
+        """
+        return self._aggregate("max", column, cast=True)
+
+    def count(self, column="*", distinct=False):
+        """
+        Number of records in the query (or of non-null values of +column+,
+        each counted once if +distinct+). When the query is grouped (see
+        `group`), this and the other aggregates return a dictionary of each
+        group to its result.
+
+        >>> Order.all().group("date(created_at)").sum("price")
+        {u"2016-01-07": 120.5, u"2016-01-08": 98.0}
+        >>> Order.all().count("customer_id", distinct=True)
+        12
+        """
+        return self._aggregate("count", column, distinct=distinct)
+
+    def _aggregate(self, function, column, distinct=False, cast=False):
+        # Aggregates ignore the order and limit of the query
+        self._loading()
+        repo = self._query_repo()
+        repo.order_clause = ""
+        repo.limit_value = []
+        cursor = repo.aggregate(function, column, distinct=distinct)
+        convert = self.model.__all_attributes__.get(column) if cast else None
+        if convert is None:
+            convert = lambda value: value
+
+        def result(value):
+            return convert(value) if value is not None else None
+        if self.group_column:
+            return {group: result(value) for group, value in cursor.fetchall()}
+        return result(cursor.fetchone()[0])
+
+    def _column_values(self, columns):
+        # Rows of the values of +columns+, cast a column at a time
+        if not columns:
+            raise QueryInvalid("Must get at least one column")
+        if self._preloaded is not None:
+            return [tuple(getattr(record, column) for column in columns)
+                    for record in self._preloaded]
+        self._loading()
+        rows = self._query_repo().select(*columns).fetchall()
+        casts = self.model.__all_attributes__
+        cast_columns = [(index, casts[column])
+                        for index, column in enumerate(columns)
+                        if casts.get(column) is not None]
+        if not rows or not cast_columns:
+            return rows
+        data = [list(values) for values in zip(*rows)]
+        for index, cast in cast_columns:
+            data[index] = [cast(value) if value is not None else None
+                           for value in data[index]]
+        return zip(*data)
+
+    def in_batches(self, batch_size=1000):
+        """
+        Yields the records of the query as lists of at most +batch_size+
+        records, paging by id (`WHERE id > last_id ORDER BY id LIMIT n`)
+        rather than by offset so that every batch is equally cheap to fetch.
+        Each batch is read with its own query, so no cursor is held open
+        between batches. A limit on the query limits the records yielded in
+        all. Raises QueryInvalid if the query has a custom order.
+        """
+        if self._order_with:
+            raise QueryInvalid("Cannot batch a query with a custom order")
+        if batch_size < 1:
+            raise QueryInvalid("Batch size must be positive.")
+        id_column = "{}.id".format(self.table)
+        batches = self.order_by(**{id_column: "asc"})
+        if "id" not in batches.attributes:
+            batches.attributes = ["id"] + list(batches.attributes)
+        # Records left to yield, if the query is limited
+        remaining = self.limit_count
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batches.limit_count = size
+        position = batches.attributes.index("id")
+        batch = batches
+        while True:
+            rows = batch._do_query().fetchall()
+            if not rows:
+                return
+            yield batches._records(rows)
+            if len(rows) < size:
+                return
+            if remaining is not None:
+                remaining -= len(rows)
+                if not remaining:
+                    return
+                size = min(batch_size, remaining)
+            batch = batches.where("{} > ?".format(id_column),
+                                  rows[-1][position])
+            batch.limit_count = size
+
+    def find_each(self, batch_size=1000):
+        """
+        Yields each record of the query, fetching them from the database
+        +batch_size+ at a time (see `in_batches`).
+        """
+        for batch in self.in_batches(batch_size):
+            for record in batch:
+                yield record
+
+    @retry.retrying
+    def update_all(self, **attributes):
+        """
+        Sets +attributes+ on every record in the query with a single UPDATE,
+        without loading the records or running validations (nor touching
+        updated_at, unless passed). Returns the number of records updated.
+
+        >>> Post.where(author_id=7).update_all(published=False)
+        12
+        """
+        attrs = self.model.__all_attributes__
+        for attr in attributes:
+            if attr not in attrs:
+                raise AttributeError("Cannot set '{}'".format(attr))
+        data = {attr: (attrs[attr](value) if value is not None else None)
+                for attr, value in attributes.items()}
+        with Repo.db:
+            self._forget_records()
+            return self._mass_repo().update(**data)
+
+    @retry.retrying
+    def delete_all(self):
+        """
+        Deletes every record in the query with a single DELETE, without
+        loading the records or destroying their dependents (see `delete` on
+        records). Returns the number of records deleted.
+        """
+        with Repo.db:
+            self._forget_records()
+            return self._mass_repo().delete()
+
+    @retry.retrying
+    def destroy_all(self):
+        """
+        Deletes every record in the query along with its dependents (and
+        theirs, and so on), using one DELETE per model in the dependency tree
+        rather than one per record, all in a single transaction. Returns the
+        number of records in the query that were deleted.
+
+        >>> Forum.where(archived=True).destroy_all()
+        3
+        """
+        with Repo.db:
+            return self._destroy_all()
+
+    def _destroy_all(self):
+        # Dependents are deleted first, while the subqueries that find them
+        # can still see the records they depend on
+        self._destroy_dependents()
+        self._forget_records()
+        return self._mass_repo().delete()
+
+    def _destroy_dependents(self):
+        reflections = associations.reflections_for(self.model)
+        for dependent in self.model.__metadata__.dependents:
+            reflection = reflections[dependent]
+            dependents = reflection.dependents(self)
+            if reflection.on_delete_cascade:
+                # SQLite deletes these itself, but the schema may not
+                # declare ON DELETE CASCADE for their own dependents, which
+                # still have to be destroyed
+                dependents._destroy_dependents()
+                dependents._forget_records()
+            else:
+                dependents._destroy_all()
+
+    def _forget_records(self):
+        # Records in the identity map are out of date after writing in bulk
+        identity_map = identity.current()
+        if identity_map is not None:
+            identity_map.forget(self.model)
+
+    def _mass_repo(self):
+        # Repo restricted to the records of the query, for writing to all of
+        # them at once. UPDATE and DELETE cannot join, group, or limit, so
+        # those queries are matched by id against a subquery instead.
+        if self.join_args or self.group_column or self.limit_count:
+            return Repo(self.table).where(id=self._query_repo())
+        repo = Repo(self.table)
+        if self.where_query or self.custom_where:
+            repo = repo.where(self.custom_where, **self.where_query)
+        return repo
+
     def _query_repo(self):
         repo = Repo(self.table)
         if self.where_query or self.custom_where:
@@ -238,18 +527,107 @@ class Query(object):
         return repo
 
     def _do_query(self):
+        self._loading()
         return self._query_repo().select(*self.attributes)
 
+    def _loading(self):
+        if self._n_plus_one is not None:
+            n_plus_one.loading(*self._n_plus_one)
+
+    def _batches(self):
+        # Yields the rows of the query in lists of at most +batch_size+, so
+        # that only one batch is held in memory at once.
+        if not self._resumable():
+            # A rollback resets open cursors, and only queries in id order
+            # can be resumed where they left off (see below), so the rows of
+            # the others are read at once
+            yield self._do_query().fetchall()
+            return
+        id_column = "{}.id".format(self.table)
+        query = self
+        if not self._order_with:
+            query = self.order_by(**{id_column: "asc"})
+        cursor = query._do_query()
+        rows = cursor.fetchmany(self.batch_size)
+        if len(rows) < self.batch_size:
+            # Everything fit in the first batch: the cursor is done
+            yield rows
+            return
+        # The caller may write to the database between batches while the
+        # cursor is still open. SQLite then shows the cursor rows inserted
+        # after it started (which can make iteration run away), so rows newer
+        # than the newest one at the start are skipped.
+        ceiling = Repo(self.table).max_id()
+        position = self.attributes.index("id")
+        while rows:
+            yield [row for row in rows if row[position] <= ceiling]
+            if len(rows) < self.batch_size:
+                return
+            last_id = rows[-1][position]
+            try:
+                rows = cursor.fetchmany(self.batch_size)
+            except sqlite3.InterfaceError:
+                # A rollback reset the cursor: carry on from the last id
+                # read. The old cursor must be closed first, or it would
+                # share its statement with the new one.
+                cursor.close()
+                cursor = query.where("{} > ?".format(id_column),
+                                     last_id)._do_query()
+                rows = cursor.fetchmany(self.batch_size)
+
+    def _resumable(self):
+        # Whether the query can be read in id order (it has the ids, and no
+        # other order, grouping, or limit), so that it can be resumed from
+        # the last id read
+        return ("id" in self.attributes and not self.group_column and
+                not self.limit_count and
+                self._order_with in ({}, {"id": "asc"},
+                                     {"{}.id".format(self.table): "asc"}))
+
+    def _records(self, rows):
+        # Builds records from +rows+ (or takes them from the identity map),
+        # eager loading the included associations
+        identity_map = identity.current()
+        if identity_map is not None:
+            records = identity_map.load(self.model, self.attributes, rows)
+        else:
+            records = self.model.from_rows(self.attributes, rows)
+        if self.include_paths:
+            associations.preload(records, *self.include_paths)
+        return records
+
     def __iter__(self):
-        result = self._do_query().fetchall()
-        for record in result:
-            args = dict(zip(self.attributes, record))
-            yield self.model.from_dict(**args)
+        if self._preloaded is not None:
+            for record in self._preloaded:
+                yield record
+            return
+        for rows in self._batches():
+            for record in self._records(rows):
+                yield record
 
     def __len__(self):
+        if self._preloaded is not None:
+            return len(self._preloaded)
+        self._loading()
         result = self._query_repo().count()
         return result.fetchone()[0]
 
+    def exists(self):
+        """
+        Whether the query has any records, checked with a query that stops at
+        the first one (rather than counting or loading them). Also used for
+        the truthiness of queries.
+
+        >>> if post.comments:
+        ...     pass  # SELECT 1 FROM comments WHERE ... LIMIT 1
+        """
+        if self._preloaded is not None:
+            return bool(self._preloaded)
+        self._loading()
+        return self._query_repo().exists()
+
+    __nonzero__ = exists
+
     def __repr__(self):
         return "<{name} {records}>".format(
             name="lazy_record.Query",
@@ -265,6 +643,24 @@ class Query(object):
         record.save()
         return record
 
+    def create_many(self, rows, return_ids=False, validate=False):
+        """
+        Creates a record for each dictionary of attributes in +rows+, subject
+        to the restrictions in the query, in a single bulk insert (see
+        `Base.insert_many`). Cannot be used on queries with joins, as the
+        intermediate (join table) records cannot be built in bulk.
+        """
+        if self.join_args:
+            raise QueryInvalid("Cannot create records in bulk through a join")
+        restrictions = record_args(self.where_query)
+        data = []
+        for row in rows:
+            build_args = dict(restrictions)
+            build_args.update(row)
+            data.append(build_args)
+        return self.model.insert_many(data, return_ids=return_ids,
+                                      validate=validate)
+
     def build(self, **kwargs):
         """
         Builds a new record subject to the restrictions in the query.
@@ -378,8 +774,8 @@ class Query(object):
                     # this is a belongs_to, so the entry will be singular,
                     # whereas the table name is plural (we need to remove the
                     # 's' at the end)
-                    key = associations.foreign_keys_for(self.model
-                            )[inflector.singularize(final_table)]
+                    key = self.model.__metadata__.foreign_keys[
+                        associations.singular_name(final_table)]
                     # Set the foreign key to None to deassociate
                     setattr(record, key, None)
             else:
@@ -396,9 +792,9 @@ class Query(object):
         # With that, we can look into the related class description for
         # the correct foreign key, which is set to the passed record's
         # id.
-        record_class_name = inflector.singularize(Repo.table_name(record.__class__))
+        record_class_name = record.__class__.__metadata__.singular_name
         related_args = self.where_query.get(Repo.table_name(related_class), {})
-        related_key = associations.foreign_keys_for(related_class)[record_class_name]
+        related_key = related_class.__metadata__.foreign_keys[record_class_name]
         related_args[related_key] = record.id
         return related_args
 
@@ -432,10 +828,8 @@ class Query(object):
 
 
 def foreign_key(local, foreign):
-    local_class = local.__class__
-    foreign_class = foreign.__class__
-    return associations.foreign_keys_for(local_class
-        )[inflector.singularize(Repo.table_name(foreign_class))]
+    return local.__class__.__metadata__.foreign_keys[
+        foreign.__class__.__metadata__.singular_name]
 
 def record_args(arg_dict):
     return {key: value
@@ -445,3 +839,5 @@ def record_args(arg_dict):
 # Here to prevent circular import loop
 from lazy_record.errors import *
 import lazy_record.associations as associations
+import lazy_record.identity as identity
+import lazy_record.n_plus_one as n_plus_one
@@ -1,7 +1,9 @@
 import re
-import sqlite3
 from itertools import chain
 from inflector import Inflector, English
+import lazy_record.statements as statements
+import lazy_record.pool as pool
+import lazy_record.events as events
 
 inflector = Inflector(English)
 
@@ -15,6 +17,8 @@ class Repo(object):
     Wrapper object around the database.
     """
     db = None
+    # Pool of read-only connections for selects, if any
+    read_db = None
 
     def __init__(self, table_name):
         """
@@ -22,10 +26,12 @@ class Repo(object):
         updating, or destroying records in that table.
         """
         self.table_name = table_name
-        self.where_clause = ""
+        self.where_shape = ()
         self.where_values = []
+        self.where_subqueries = []
         self.inner_joins = []
         self.order_clause = ""
+        self.group_column = None
         self.group_clause = ""
         self.having_clause = ""
         self.having_values = []
@@ -35,9 +41,10 @@ class Repo(object):
         """
         Analog to SQL "WHERE". Does not perform a query until `select` is
         called. Returns a repo object. Options selected through keyword
-        arguments are assumed to use == unles the value is a list, tuple, or
-        dictionary. List or tuple values translate to an SQL `IN` over those
-        values, and a dictionary looks up under a different table when joined.
+        arguments are assumed to use == unles the value is a list, tuple,
+        dictionary, or Repo. List or tuple values translate to an SQL `IN` over
+        those values, a Repo translates to an `IN` over the ids it selects, and
+        a dictionary looks up under a different table when joined.
 
         ex)
 
@@ -47,70 +54,80 @@ class Repo(object):
         SELECT foos.* FROM foos WHERE foos.id > 12
         >>> Repo("foos").where(id=[1,2,3]).select("*")
         SELECT foos.* FROM foos WHERE foos.id IN (1, 2, 3)
+        >>> Repo("foos").where(id=Repo("foos").where(name="a")).select("*")
+        SELECT foos.* FROM foos WHERE foos.id IN (SELECT foos.id FROM foos
+        WHERE foos.name == "a")
         """
-        # Generate the SQL pieces and the relevant values
-        standard_names, standard_values = self._standard_items(restrictions)
-        custom_names, custom_values = self._custom_items(custom_restrictions)
-        in_names, in_values = self._in_items(restrictions)
-        query_names = standard_names + custom_names + in_names
-        # Stitch them into a clause with values
-        if query_names:
+        # Only work out the shape of the clause (its columns, custom
+        # restrictions, and how many values each IN takes) and its values:
+        # the SQL is compiled once per shape (see `where_clause`)
+        standard, standard_values = [], []
+        ins, in_values, subqueries = [], [], []
+        for table, column, value in self._build_where(restrictions):
+            if is_subquery(value):
+                key, values = value._select_key("id")
+                ins.append((table, column, key))
+                in_values.extend(values)
+                subqueries.append(value)
+            elif type(value) in (tuple, list):
+                ins.append((table, column, len(value)))
+                in_values.extend(value)
+            else:
+                standard.append((table, column))
+                standard_values.append(value)
+        custom = tuple(restriction[0] for restriction in custom_restrictions)
+        custom_values = list(chain(
+            *[restriction[1:] for restriction in custom_restrictions]))
+        if standard or custom or ins:
+            self.where_shape = (tuple(standard), custom, tuple(ins))
             self.where_values = standard_values + custom_values + in_values
-            self.where_clause = "where {query} ".format(
-                query=" and ".join(query_names))
+            self.where_subqueries = subqueries
         return self
 
-    def _in_items(self, restrictions):
-        """Generate argument pairs for queries like where(id=[1, 2])"""
-        def build_in(table, name, value):
-            return "{}.{} IN ({})".format(table, name,
-                                          ", ".join(["?"] * len(value)))
-
-        in_items = self._build_where(restrictions, for_in=True)
-        names = [build_in(*restriction) for restriction in in_items]
-        values = list(chain(*[item[2] for item in in_items]))
-        return (names, values)
-
-    def _custom_items(self, restrictions):
-        """Generate argument pairs for queries like where("id > ?", 7)"""
-        def scope_name(query, table):
-            # The first entry in the query is the column
-            # If the column already has a ".", that means that the table has
-            # already been chosen
-            for splitter in (" and ", " or "):
-                split_query = re.split(splitter, query, re.IGNORECASE)
-                query = splitter.join("{}.{}".format(table, entry)
-                                      if "." not in entry else entry
-                                      for entry in split_query)
-            return query
-
-        names = [scope_name(restriction[0], self.table_name)
-                 for restriction in restrictions]
-        values = list(chain(
-            *[restriction[1:] for restriction in restrictions]))
-        return (names, values)
-
-    def _standard_items(self, restrictions):
-        """Generate argument pairs for queries like where(id=2)"""
-        standard_items = self._build_where(restrictions, for_in=False)
-        names = ["{}.{} == ?".format(pair[0], pair[1])
-                 for pair in standard_items]
-        values = [item[2] for item in standard_items]
-        return (names, values)
-
-    def _build_where(self, where_query, for_in):
+    @property
+    def where_clause(self):
+        """
+        SQL for the restrictions passed to `where`.
+        """
+        if not self.where_shape:
+            return ""
+        standard, custom, ins = self.where_shape
+        subqueries = iter(self.where_subqueries)
+        names = ["{}.{} == ?".format(table, column)
+                 for table, column in standard]
+        names.extend(self._scope_name(query) for query in custom)
+        for table, column, size in ins:
+            if type(size) is tuple:
+                # Subquery: it selects the ids to match against
+                values = next(subqueries)._select_statement("id")[0]
+            else:
+                values = ", ".join(["?"] * size)
+            names.append("{}.{} IN ({})".format(table, column, values))
+        return "where {query} ".format(query=" and ".join(names))
+
+    def _scope_name(self, query):
+        # The first entry in the query is the column
+        # If the column already has a ".", that means that the table has
+        # already been chosen
+        for splitter in (" and ", " or "):
+            split_query = re.split(splitter, query, re.IGNORECASE)
+            query = splitter.join("{}.{}".format(self.table_name, entry)
+                                  if "." not in entry else entry
+                                  for entry in split_query)
+        return query
+
+    def _build_where(self, where_query):
         # Recursively loops through the where query to produce a list of
         # 3-tuples that contain the (table name, column, value)
-        def builder(where_dict, default_table, for_in):
+        def builder(where_dict, default_table):
             for key, value in where_dict.items():
-                use_in = type(value) in (tuple, list)
                 if type(value) is dict:
-                    for entry in builder(value, key, for_in):
+                    for entry in builder(value, key):
                         yield entry
-                elif (use_in and for_in or not (use_in or for_in)):
+                else:
                     yield (default_table, key, value)
 
-        return list(builder(where_query, self.table_name, for_in))
+        return list(builder(where_query, self.table_name))
 
     def inner_join(self, *joiners):
         """
@@ -156,6 +173,7 @@ class Repo(object):
 
     def group_by(self, column):
         if column:
+            self.group_column = column
             self.group_clause = "GROUP BY {} ".format(column)
         return self
 
@@ -203,14 +221,62 @@ class Repo(object):
 
         >>> Repo("foos").select("name", "id")
         SELECT foos.name, foos.id FROM foos
+        >>> Repo("foos").inner_join({'table': 'bars', 'on': ['foo_id', 'id']}
+        ...     ).select("name", "bars.id")
+        SELECT foos.name, bars.id FROM foos INNER JOIN bars ...
+        """
+        cmd, values = self._select_statement(*attributes)
+        return self._execute("select", cmd, values)
+
+    def _execute(self, operation, cmd, values=None, many=False, db=None):
+        if db is None:
+            db = Repo.db_for(operation)
+        # Statements are only timed when someone is listening for them
+        if events.listeners["query"]:
+            return events.execute(db, operation, self.table_name, cmd,
+                                  values, many=many)
+        if many:
+            return db.executemany(cmd, values)
+        if values is None:
+            return db.execute(cmd)
+        return db.execute(cmd, values)
+
+    @staticmethod
+    def db_for(operation):
+        """
+        Get the pool to run an +operation+ on: the read-only pool for selects
+        and counts (if there is one), unless the current thread is writing
+        (so that it sees what it wrote), and the writer otherwise.
         """
+        if (operation in ("select", "count") and Repo.read_db is not None and
+                not Repo.db.writing()):
+            return Repo.read_db
+        return Repo.db
+
+    def _select_statement(self, *attributes):
+        # Gets the SQL for `select` along with the values for its
+        # placeholders, so that it can also be used as a subquery
+        key, values = self._select_key(*attributes)
+        return (statements.cache.get(
+            key, lambda: self._compile_select(attributes)), values)
+
+    def _select_key(self, *attributes):
+        # The shape of the select statement, and the values for it
+        key = ("select", self.table_name, attributes, self.where_shape,
+               tuple(self.inner_joins), self.order_clause, self.group_clause,
+               self.having_clause, bool(self.limit_value))
+        return (key, self.where_values + self.having_values + self.limit_value)
+
+    def _compile_select(self, attributes):
+        # Attributes that already have a table chosen are left as they are
         namespaced_attributes = [
             "{table}.{attr}".format(table=self.table_name, attr=attr)
+            if "." not in attr else attr
             for attr in attributes
         ]
-        cmd = ('select {attrs} from {table} '
-               '{join_clause}{where_clause}{order_clause}'
-               '{group_clause}{having_clause}{limit_clause}').format(
+        return ('select {attrs} from {table} '
+                '{join_clause}{where_clause}{order_clause}'
+                '{group_clause}{having_clause}{limit_clause}').format(
             table=self.table_name,
             attrs=", ".join(namespaced_attributes),
             where_clause=self.where_clause,
@@ -220,43 +286,162 @@ class Repo(object):
             having_clause=self.having_clause,
             limit_clause=self.limit_clause,
         ).rstrip()
-        return Repo.db.execute(cmd, self.where_values + self.having_values + \
-                               self.limit_value)
 
     def count(self):
         """
         Count the number of records in the table, subject to the query.
         """
-        cmd = ("select COUNT(*) from {table} "
-               "{join_clause}{where_clause}{order_clause}").format(
-                    table=self.table_name,
-                    where_clause=self.where_clause,
-                    join_clause=self.join_clause,
-                    order_clause=self.order_clause).rstrip()
-        return Repo.db.execute(cmd, self.where_values)
+        def compile():
+            return ("select COUNT(*) from {table} "
+                    "{join_clause}{where_clause}{order_clause}").format(
+                        table=self.table_name,
+                        where_clause=self.where_clause,
+                        join_clause=self.join_clause,
+                        order_clause=self.order_clause).rstrip()
+
+        key = ("count", self.table_name, self.where_shape,
+               tuple(self.inner_joins), self.order_clause)
+        return self._execute("count", statements.cache.get(key, compile),
+                             self.where_values)
+
+    def aggregate(self, function, column, distinct=False):
+        """
+        Apply the SQL aggregate +function+ (e.g. "sum") to +column+ over the
+        rows matching the query, counting each value once if +distinct+.
+        Selects a row of the group and its result for each group when
+        grouped, and a single row with the result otherwise.
+
+        ex)
+
+        >>> Repo("foos").group_by("kind").aggregate("sum", "price")
+        SELECT kind, sum(foos.price) FROM foos GROUP BY kind
+        """
+        def compile():
+            # Only bare column names are scoped to the table
+            target = column
+            if re.match(r"^\w+$", column):
+                target = "{}.{}".format(self.table_name, column)
+            if distinct:
+                target = "DISTINCT " + target
+            selected = "{}({})".format(function, target)
+            if self.group_clause:
+                selected = "{}, {}".format(self.group_column, selected)
+            return ("select {selected} from {table} {join_clause}"
+                    "{where_clause}{group_clause}{having_clause}").format(
+                        selected=selected,
+                        table=self.table_name,
+                        join_clause=self.join_clause,
+                        where_clause=self.where_clause,
+                        group_clause=self.group_clause,
+                        having_clause=self.having_clause).rstrip()
+
+        key = ("aggregate", self.table_name, function, column, distinct,
+               self.where_shape, tuple(self.inner_joins), self.group_clause,
+               self.having_clause)
+        return self._execute("select", statements.cache.get(key, compile),
+                             self.where_values + self.having_values)
+
+    def exists(self):
+        """
+        Whether any record in the table matches the query, stopping at the
+        first one found.
+
+        ex)
+
+        >>> Repo("foos").where(name="bar").exists()
+        SELECT 1 FROM foos WHERE foos.name == "bar" LIMIT 1
+        """
+        def compile():
+            return ("select 1 from {table} {join_clause}{where_clause}"
+                    "{group_clause}{having_clause}LIMIT 1").format(
+                        table=self.table_name,
+                        join_clause=self.join_clause,
+                        where_clause=self.where_clause,
+                        group_clause=self.group_clause,
+                        having_clause=self.having_clause)
+
+        key = ("exists", self.table_name, self.where_shape,
+               tuple(self.inner_joins), self.group_clause, self.having_clause)
+        cursor = self._execute("select", statements.cache.get(key, compile),
+                               self.where_values + self.having_values)
+        return cursor.fetchone() is not None
+
+    def max_id(self):
+        """
+        Get the largest id in the table, ignoring any restrictions.
+        """
+        cmd = "select max(id) from {table}".format(table=self.table_name)
+        return self._execute("select", cmd).fetchone()[0]
 
     def insert(self, **data):
         """
         Insert the passed +data+ into the table. Raises Invalid if a where
         clause is present (i.e. no INSERT INTO table WHERE)
         """
-        if self.where_clause:
+        if self.where_shape:
             raise Invalid("Cannot insert with 'where' clause.")
         # Ensure that order is preserved
         data = data.items()
-        cmd = "insert into {table} ({attrs}) values ({values})".format(
-            table=self.table_name,
-            attrs=", ".join(entry[0] for entry in data),
-            values=", ".join(["?"] * len(data)),
-        )
-        handle = Repo.db.execute(cmd, [entry[1] for entry in data])
+        columns = tuple(entry[0] for entry in data)
+        cmd = statements.cache.get(("insert", self.table_name, columns),
+                                   lambda: self._compile_insert(columns))
+        handle = self._execute("insert", cmd, [entry[1] for entry in data])
         # Return the id of the added row
         return handle.lastrowid
 
+    def insert_many(self, rows, return_ids=False, chunk_size=500):
+        """
+        Insert each dictionary in +rows+ into the table using `executemany`.
+        Rows are grouped by the set of columns they define, and each group is
+        sent to the database in chunks of +chunk_size+ rows. Does not manage
+        the transaction, so wrap the call in one to insert all rows at once.
+
+        When +return_ids+ is True, returns the ids assigned to the rows in the
+        order they were passed. This relies on SQLite handing out consecutive
+        rowids to a single `executemany` inside a write transaction.
+
+        ex)
+
+        >>> Repo("foos").insert_many([{"name": "a"}, {"name": "b"}])
+        INSERT INTO foos (name) VALUES (?) -- executed with [("a",), ("b",)]
+        """
+        if self.where_shape:
+            raise Invalid("Cannot insert with 'where' clause.")
+        # Group the rows (remembering their position) by their columns
+        groups = {}
+        for index, row in enumerate(rows):
+            columns = tuple(sorted(row))
+            groups.setdefault(columns, []).append(index)
+        ids = [None] * len(rows)
+        for columns, indices in groups.items():
+            cmd = self._compile_insert(columns)
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                self._execute("insert", cmd, [[rows[index][column]
+                                               for column in columns]
+                                              for index in chunk], many=True)
+                if return_ids:
+                    last_id = self._execute(
+                        "select", "select last_insert_rowid()",
+                        db=Repo.db).fetchone()[0]
+                    first_id = last_id - len(chunk) + 1
+                    for offset, index in enumerate(chunk):
+                        ids[index] = first_id + offset
+        if return_ids:
+            return ids
+
+    def _compile_insert(self, columns):
+        return "insert into {table} ({attrs}) values ({values})".format(
+            table=self.table_name,
+            attrs=", ".join(columns),
+            values=", ".join(["?"] * len(columns)),
+        )
+
     def update(self, **data):
         """
         Update records in the table with +data+. Often combined with `where`,
-        as it acts on all records in the table unless restricted.
+        as it acts on all records in the table unless restricted. Returns the
+        number of records updated.
 
         ex)
 
@@ -264,38 +449,104 @@ class Repo(object):
         UPDATE foos SET name = "bar"
         """
         data = data.items()
-        update_command_arg = ", ".join("{} = ?".format(entry[0])
-                                       for entry in data)
-        cmd = "update {table} set {update_command_arg} {where_clause}".format(
-            update_command_arg=update_command_arg,
-            where_clause=self.where_clause,
-            table=self.table_name).rstrip()
-        Repo.db.execute(cmd, [entry[1] for entry in data] + self.where_values)
+        columns = tuple(entry[0] for entry in data)
+
+        def compile():
+            update_command_arg = ", ".join("{} = ?".format(column)
+                                           for column in columns)
+            return "update {table} set {update_command_arg} {where_clause}" \
+                .format(update_command_arg=update_command_arg,
+                        where_clause=self.where_clause,
+                        table=self.table_name).rstrip()
+
+        cmd = statements.cache.get(
+            ("update", self.table_name, columns, self.where_shape), compile)
+        return self._execute("update", cmd, [entry[1] for entry in data] +
+                             self.where_values).rowcount
+
+    def update_many(self, columns, rows):
+        """
+        Update many records of the table at once using `executemany`, setting
+        +columns+ to the values at the start of each of +rows+, and matching
+        the record by the id at its end.
+
+        ex)
+
+        >>> Repo("foos").update_many(["name"], [["a", 1], ["b", 2]])
+        UPDATE foos SET name = ? WHERE foos.id == ? -- executed for each row
+        """
+        columns = tuple(columns)
+
+        def compile():
+            return "update {table} set {columns} where {table}.id == ?".format(
+                table=self.table_name,
+                columns=", ".join("{} = ?".format(column)
+                                  for column in columns))
+
+        cmd = statements.cache.get(("update_many", self.table_name, columns),
+                                   compile)
+        return self._execute("update", cmd, rows, many=True).rowcount
 
     def delete(self):
         """
         Remove entries from the table. Often combined with `where`, as it acts
-        on all records in the table unless restricted.
+        on all records in the table unless restricted. Returns the number of
+        records deleted.
         """
-        cmd = "delete from {table} {where_clause}".format(
-            table=self.table_name,
-            where_clause=self.where_clause
-        ).rstrip()
-        Repo.db.execute(cmd, self.where_values)
+        def compile():
+            return "delete from {table} {where_clause}".format(
+                table=self.table_name,
+                where_clause=self.where_clause
+            ).rstrip()
+
+        cmd = statements.cache.get(
+            ("delete", self.table_name, self.where_shape), compile)
+        return self._execute("delete", cmd, self.where_values).rowcount
 
     @staticmethod
     def table_name(model):
         """
         Get a model's table name. (e.g. MyModel => "my_models")
         """
+        # Models keep theirs in their compiled metadata
+        compiled = getattr(model, "__metadata__", None)
+        if compiled is not None:
+            return compiled.table_name
         return inflector.tableize(model.__name__)
 
     @classmethod
-    def connect_db(Repo, database=":memory:"):
+    def connect_db(Repo, database=":memory:", pool_size=5, pool_timeout=30.0,
+                   statements=(), options={}, readers=0, replica=None):
         """
         Connect Repo to a database with path +database+ so all instances can
-        interact with the database.
+        interact with the database, through a pool of at most +pool_size+
+        connections (see `Pool`), running the +statements+ on and passing the
+        +options+ to each of them.
+
+        With +readers+, selects are run on a separate pool of at most that
+        many read-only connections, to +replica+ if given (a copy of the
+        database kept up to date elsewhere), or to +database+ otherwise.
         """
-        Repo.db = sqlite3.connect(database,
-                                  detect_types=sqlite3.PARSE_DECLTYPES)
+        if replica is not None and not readers:
+            readers = pool_size
+        if readers and replica is None and database == ":memory:":
+            raise ValueError("An in-memory database cannot have readers "
+                             "of its own")
+        Repo.db = pool.Pool(database, size=pool_size, timeout=pool_timeout,
+                            statements=statements, options=options)
+        Repo.read_db = None
+        if readers:
+            # sqlite3 cannot open connections read-only in Python 2 (it
+            # has no uri=True to pass mode=ro), so the connections refuse
+            # to write instead
+            Repo.read_db = pool.Pool(
+                database if replica is None else replica, size=readers,
+                timeout=pool_timeout, options=options,
+                statements=list(statements) + ["PRAGMA query_only = ON"])
         return Repo.db
+
+
+def is_subquery(value):
+    # This module is imported both as "repo" and as "lazy_record.repo", so
+    # subqueries may be instances of either Repo class
+    return hasattr(type(value), "_select_statement")
@@ -0,0 +1,134 @@
+"""
+Retrying writes that fail because another connection (e.g. in another
+process) holds the lock on the database.
+
+>>> lazy_record.connect_db("app.db", busy_timeout=2000,
+...                        retry_policy=lazy_record.RetryPolicy(attempts=8))
+>>> lazy_record.retry_stats()
+{'retries': 3, 'failures': 0, 'lock_wait': 0.42}
+"""
+import functools
+import random
+import sqlite3
+import threading
+import time
+
+local = threading.local()
+
+
+def is_busy(error):
+    """
+    Whether +error+ means that the database was locked by another
+    connection (after waiting for the busy timeout).
+    """
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+
+class RetryPolicy(object):
+    """
+    Runs writes up to +attempts+ times while they fail because the database
+    is locked, sleeping between attempts for a random time of up to
+    +base_delay+ seconds, doubled after each attempt (but at most
+    +max_delay+). The randomness keeps writers that collided from colliding
+    again on their next attempt.
+
+    Writes within a transaction started with `lazy_record.transaction` are
+    not retried on their own: the error ends the transaction, which has to
+    be run again as a whole.
+    """
+
+    def __init__(self, attempts=5, base_delay=0.01, max_delay=1.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.failures = 0
+        self.lock_wait = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self, attempt):
+        """
+        Seconds to sleep after failed attempt number +attempt+ (from 0).
+        """
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call +function+ with +args+ and +kwargs+, retrying while it fails
+        because the database is locked.
+        """
+        # Calls made within a write that is itself retried are not
+        if getattr(local, "depth", 0):
+            return function(*args, **kwargs)
+        local.depth = 1
+        try:
+            attempt = 0
+            while True:
+                started = time.time()
+                try:
+                    return function(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if not is_busy(e):
+                        raise
+                    waited = time.time() - started
+                    if (attempt + 1 >= self.attempts or
+                            not self.abandon()):
+                        self.record(waited, retried=False)
+                        raise
+                    delay = self.delay(attempt)
+                    self.record(waited + delay, retried=True)
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            local.depth = 0
+
+    def abandon(self):
+        # Roll back what the failed attempt left of its transaction. Returns
+        # False if it ran within a transaction of the caller's, which cannot
+        # be retried from here.
+        import lazy_record.repo as repo
+        db = repo.Repo.db
+        if db is None or db.in_transaction():
+            return False
+        db.rollback()
+        return True
+
+    def record(self, waited, retried):
+        with self.lock:
+            self.lock_wait += waited
+            if retried:
+                self.retries += 1
+            else:
+                self.failures += 1
+
+    def stats(self):
+        """
+        Dictionary of the number of retries, the number of writes that still
+        failed (after their last attempt), and the seconds spent waiting for
+        the lock (in failed attempts, and sleeping between them).
+        """
+        with self.lock:
+            return {
+                "retries": self.retries,
+                "failures": self.failures,
+                "lock_wait": self.lock_wait,
+            }
+
+
+# The policy used by connect_db's connections
+policy = RetryPolicy()
+
+
+def retrying(method):
+    """
+    Decorator retrying +method+ under the current policy while it fails
+    because the database is locked.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return policy.call(method, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,145 @@
+"""
+Log of statements that take longer than a threshold, with the query plan
+SQLite chose for them.
+
+>>> slow_log = lazy_record.log_slow_queries(threshold=0.25)
+>>> slow_log.entries[-1].full_scan
+True
+"""
+import collections
+import logging
+import sqlite3
+import threading
+import time
+import lazy_record.events as events
+
+logger = logging.getLogger("lazy_record.slow_queries")
+
+
+class SlowQuery(object):
+    """
+    A statement that was slower than the threshold: its QueryEvent, the
+    +plan+ (the details of each step of its EXPLAIN QUERY PLAN output), and
+    whether that plan scans a whole table (+full_scan+).
+    """
+
+    def __init__(self, event, plan):
+        self.event = event
+        self.plan = plan
+        self.full_scan = any(is_full_scan(detail) for detail in plan)
+
+    def __repr__(self):
+        return "<lazy_record.SlowQuery {!r} ({:.3f}s{})>".format(
+            self.event.sql, self.event.duration,
+            ", full scan" if self.full_scan else "")
+
+
+def is_full_scan(detail):
+    # e.g. "SCAN books" or "SCAN TABLE books", but not "SCAN books USING
+    # INDEX ..." or "SCAN CONSTANT ROW"
+    return (detail.startswith("SCAN ") and "USING" not in detail and
+            "CONSTANT ROW" not in detail)
+
+
+def explain(event):
+    """
+    Get the details of each step of the query plan of the statement of
+    +event+. Inserts, statements that failed, and statements that can no
+    longer be explained (e.g. their table was dropped) have none.
+    """
+    # Imported here, as repo imports events
+    import lazy_record.repo as repo
+    if event.error is not None or event.operation == "insert":
+        return []
+    # The plan does not depend on the values bound to the statement
+    params = [None] * len(event.params)
+    try:
+        rows = repo.Repo.db.execute("EXPLAIN QUERY PLAN " + event.sql,
+                                    params).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[-1] for row in rows]
+
+
+class SlowQueryLog(object):
+    """
+    Query listener that logs (as warnings, to +logger+) each statement that
+    takes more than +threshold+ seconds, along with its query plan, flagging
+    those that scan a whole table. At most +limit+ statements are logged per
+    +interval+ seconds; the rest are only counted, and the count is reported
+    with the next statement logged. Parameters are left out of the log
+    unless +log_params+ is set. The latest +keep+ slow statements are kept
+    in +entries+.
+    """
+
+    def __init__(self, threshold=0.1, limit=10, interval=60.0, logger=logger,
+                 log_params=False, keep=100):
+        self.threshold = threshold
+        self.limit = limit
+        self.interval = interval
+        self.logger = logger
+        self.log_params = log_params
+        self.entries = collections.deque(maxlen=keep)
+        self.logged = 0
+        self.suppressed = 0
+        self.window_start = None
+        self.window_count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if event.duration < self.threshold:
+            return
+        now = time.time()
+        with self.lock:
+            if (self.window_start is None or
+                    now - self.window_start >= self.interval):
+                self.window_start = now
+                self.window_count = 0
+            if self.window_count >= self.limit:
+                self.suppressed += 1
+                return
+            self.window_count += 1
+            self.logged += 1
+            suppressed, self.suppressed = self.suppressed, 0
+        # Explaining the statement runs another query, so it is only done for
+        # the statements that make it into the log
+        slow_query = SlowQuery(event, explain(event))
+        self.entries.append(slow_query)
+        self.logger.warning(self.format(slow_query, suppressed))
+
+    def format(self, slow_query, suppressed=0):
+        event = slow_query.event
+        model = event.model
+        lines = ["Slow {operation}{model} ({duration:.3f}s{scan}): {sql}"
+                 .format(operation=event.operation,
+                         model=(" on " + model.__name__ if model is not None
+                                else ""),
+                         duration=event.duration,
+                         scan=", FULL SCAN" if slow_query.full_scan else "",
+                         sql=event.sql)]
+        if self.log_params:
+            lines.append("  params: {!r}".format(event.params))
+        lines.extend("  plan: " + detail for detail in slow_query.plan)
+        if suppressed:
+            lines.append("  ({} slow statements were not logged)".format(
+                suppressed))
+        return "\n".join(lines)
+
+    def start(self):
+        events.on("query", self)
+        return self
+
+    def stop(self):
+        """
+        Stop logging slow statements.
+        """
+        events.off("query", self)
+
+
+def log_slow_queries(threshold=0.1, **options):
+    """
+    Start logging statements slower than +threshold+ seconds (see
+    SlowQueryLog for the +options+). Returns the SlowQueryLog, whose `stop`
+    ends the logging.
+    """
+    return SlowQueryLog(threshold, **options).start()
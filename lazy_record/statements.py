@@ -0,0 +1,64 @@
+"""
+Cache of compiled SQL statements, keyed by the shape of the statement (its
+tables, columns, and clause structure) rather than by the values bound to it.
+"""
+import threading
+from collections import OrderedDict
+
+
+class StatementCache(object):
+    """
+    Least recently used cache of at most +size+ compiled statements, counting
+    its hits and misses. Safe to share between threads.
+    """
+
+    def __init__(self, size=500):
+        self.size = size
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compile):
+        """
+        Get the statement cached under +key+, calling +compile+ to build (and
+        cache) it if there is none.
+        """
+        statements = self.statements
+        with self.lock:
+            statement = statements.pop(key, None)
+            if statement is not None:
+                self.hits += 1
+                statements[key] = statement
+                return statement
+            self.misses += 1
+        statement = compile()
+        with self.lock:
+            while len(statements) >= self.size > 0:
+                statements.popitem(last=False)
+            if self.size > 0:
+                statements[key] = statement
+        return statement
+
+    def clear(self):
+        """
+        Forget all cached statements and reset the counters.
+        """
+        with self.lock:
+            self.statements.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Dictionary of the hits, misses, and number of cached statements.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.statements),
+            "max_size": self.size,
+        }
+
+
+cache = StatementCache()
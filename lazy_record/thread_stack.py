@@ -0,0 +1,52 @@
+"""
+Stacks of the objects (N+1 detectors, identity maps, sessions) started in
+each thread.
+"""
+import threading
+
+
+class ThreadStack(object):
+    """
+    The objects started (with `push`) and not yet stopped (with `remove`) in
+    each thread, most recent last. Also counts those started in any thread,
+    so that looking for them costs nothing more than checking that count
+    when none are.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def items(self):
+        """
+        The objects started in the current thread, oldest first.
+        """
+        if not self.active:
+            return ()
+        return getattr(self.local, "items", ())
+
+    def current(self):
+        """
+        The object started most recently in the current thread, if any.
+        """
+        items = self.items()
+        if items:
+            return items[-1]
+        return None
+
+    def push(self, item):
+        items = getattr(self.local, "items", None)
+        if items is None:
+            items = self.local.items = []
+        if item not in items:
+            items.append(item)
+            with self.lock:
+                self.active += 1
+
+    def remove(self, item):
+        items = getattr(self.local, "items", ())
+        if item in items:
+            items.remove(item)
+            with self.lock:
+                self.active -= 1
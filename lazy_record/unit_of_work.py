@@ -0,0 +1,250 @@
+"""
+Sessions: collect the records saved and destroyed within a block, and write
+them all at once, in a single transaction, when it ends.
+
+>>> with lazy_record.session():
+...     post = Post(title="Hello")
+...     post.save()
+...     comment = Comment(body="First!")
+...     comment.post = post  # resolved once the post has an id
+...     comment.save()
+"""
+import datetime
+import lazy_record.retry as retry
+from lazy_record.thread_stack import ThreadStack
+
+sessions = ThreadStack()
+
+
+def current():
+    """
+    The session started most recently in the current thread, if any.
+    """
+    return sessions.current()
+
+
+def dependency_order(models, links=()):
+    """
+    Sort +models+ so that every model comes after the models it belongs to
+    (i.e. those its foreign keys point to, and those given for it in +links+,
+    as (model, parent model) pairs). Models that depend on each other are
+    left in the order they were given.
+    """
+    models = list(models)
+    parents = {}
+    for model in models:
+        parents[model] = set()
+        for parent_name, foreign_key in \
+                associations.foreign_keys_for(model).items():
+            if foreign_key not in model.__attributes__:
+                # Not a parent, but a child pointing back at the model
+                continue
+            try:
+                parent = associations.model_from_name(parent_name)
+            except KeyError:
+                continue
+            if parent is not model and parent in models:
+                parents[model].add(parent)
+    for model, parent in links:
+        if parent is not model and model in parents and parent in models:
+            parents[model].add(parent)
+    ordered = []
+    while len(ordered) < len(models):
+        ready = [model for model in models if model not in ordered and
+                 not parents[model] - set(ordered)]
+        if not ready:
+            # A cycle: take the next model as it was given
+            ready = [model for model in models if model not in ordered][:1]
+        ordered.extend(ready)
+    return ordered
+
+
+class Session(object):
+    """
+    Unit of work for the current thread while started (with `start` and
+    `stop`, e.g. around a request, or as a context manager). While it is,
+    `save`, `destroy`, and `delete` on records only add them to the session,
+    which writes them when it is flushed (at the latest, when it stops,
+    unless an exception was raised). Flushing writes everything in one
+    transaction: new records first, inserted model by model with
+    `executemany` (parents before the records that belong to them), then
+    changed records, then destroyed and deleted records.
+    """
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+        # Deleted without their dependents (see Base.delete)
+        self.deleted_alone = []
+        # (record, foreign key, parent) for parents without ids yet
+        self.links = []
+
+    def add(self, record):
+        """
+        Add +record+ to be saved, along with its related records (e.g. the
+        joining records built with it).
+        """
+        records = self.new if record.id is None else self.dirty
+        if not any(other is record for other in records):
+            records.append(record)
+        for related in record._related_records:
+            if record.id is None:
+                our_name = record.__class__.__metadata__.singular_name
+                foreign_key = associations.foreign_keys_for(
+                    related.__class__)[our_name]
+                self.link(related, foreign_key, record)
+            self.add(related)
+        for related in record._delete_related_records:
+            self.delete(related)
+
+    def delete(self, record, dependents=True):
+        """
+        Add +record+ to be destroyed (along with its dependents, unless
+        +dependents+ is False).
+        """
+        records = self.deleted if dependents else self.deleted_alone
+        if record.id is None:
+            self.new = [other for other in self.new if other is not record]
+        elif not any(other is record for other in records):
+            records.append(record)
+
+    def link(self, record, foreign_key, parent):
+        """
+        Set +foreign_key+ of +record+ to the id of +parent+ once it is
+        inserted (adding +parent+ to be saved).
+        """
+        self.links.append((record, foreign_key, parent))
+        if not any(other is parent for other in self.new):
+            self.add(parent)
+
+    @retry.retrying
+    def flush(self):
+        """
+        Write the records in the session to the database in one transaction,
+        assigning ids to the new ones, and empty the session.
+        """
+        if not (self.new or self.dirty or self.deleted or
+                self.deleted_alone):
+            return
+        try:
+            with repo.Repo.db:
+                saved = (self._insert(repo.Repo) +
+                         self._update(repo.Repo))
+                self._destroy()
+        except Exception:
+            # Nothing was written, so the new records have no ids after all
+            for record in self.new:
+                record._id = None
+            for record, foreign_key, _ in self.links:
+                setattr(record, foreign_key, None)
+            raise
+        for record in saved:
+            record._finish_save()
+        self._clear()
+
+    def _insert(self, Repo):
+        by_model = {}
+        for record in self.new:
+            by_model.setdefault(record.__class__, []).append(record)
+        links = [(record.__class__, parent.__class__)
+                 for record, _, parent in self.links]
+        for model in dependency_order(by_model, links):
+            records = by_model[model]
+            for record, foreign_key, parent in self.links:
+                if record.__class__ is model:
+                    setattr(record, foreign_key, parent.id)
+            now = datetime.datetime.today()
+            attributes = list(model.__all_attributes__)
+            rows = []
+            for record in records:
+                record.validate()
+                record._created_at = now
+                record._updated_at = now
+                rows.append({attr: getattr(record, "_" + attr)
+                             for attr in attributes})
+            ids = Repo(Repo.table_name(model)).insert_many(rows,
+                                                           return_ids=True)
+            for record, record_id in zip(records, ids):
+                # Records belonging to this one need its id
+                record._id = record_id
+        # Records saved before may have been linked to new ones too: they
+        # are updated with the foreign key (as a change) along with the rest
+        new = set(id(record) for record in self.new)
+        for record, foreign_key, parent in self.links:
+            if id(record) not in new:
+                setattr(record, foreign_key, parent.id)
+        return self.new
+
+    def _update(self, Repo):
+        # Records changing the same columns are updated together
+        groups = {}
+        for record in self.dirty:
+            if record._changes:
+                columns = tuple(sorted(record._changes)) + ("updated_at",)
+                groups.setdefault((record.__class__, columns),
+                                  []).append(record)
+        now = datetime.datetime.today()
+        for (model, columns), records in groups.items():
+            rows = []
+            for record in records:
+                record.validate()
+                record._updated_at = now
+                rows.append([getattr(record, "_" + column)
+                             for column in columns] + [record.id])
+            Repo(Repo.table_name(model)).update_many(columns, rows)
+        return self.dirty
+
+    def _destroy(self):
+        by_model = {}
+        alone_by_model = {}
+        for record in self.deleted:
+            by_model.setdefault(record.__class__, []).append(record.id)
+        for record in self.deleted_alone:
+            alone_by_model.setdefault(record.__class__, []).append(record.id)
+        models = list(by_model) + [model for model in alone_by_model
+                                   if model not in by_model]
+        for model in reversed(dependency_order(models)):
+            if model in by_model:
+                query.Query(model).where(id=by_model[model])._destroy_all()
+            if model in alone_by_model:
+                records = query.Query(model).where(id=alone_by_model[model])
+                records._forget_records()
+                records._mass_repo().delete()
+
+    def start(self):
+        sessions.push(self)
+        return self
+
+    def stop(self, flush=True):
+        """
+        Stop collecting records, flushing those collected unless +flush+ is
+        False (in which case they are discarded).
+        """
+        sessions.remove(self)
+        if flush:
+            self.flush()
+        else:
+            self._clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(flush=exc_type is None)
+
+
+def session():
+    """
+    Start a session for the current thread. Use it as a context manager, or
+    call `stop` on the Session it returns.
+    """
+    return Session().start()
+
+# Here to prevent circular import loop
+import associations
+import query
+import repo
@@ -25,7 +25,8 @@ def unique(record, name):
     model = record.__class__
     others = model.where("id IS NOT ?", record.id
                  ).where("{} == ?".format(name), getattr(record, name))
-    return len(list(others)) == 0
+    # Checking for existence stops at the first conflicting record
+    return not others
 
 def length(within):
     @validation
@@ -8,13 +8,22 @@ sys.path.insert(0, os.path.join(
     "lazy_record"))
 from lazy_record.associations import *
 import lazy_record
+import lazy_record.metadata as metadata
 
 
 class Base(object):
     __dependents__ = []
     __attributes__ = {}
+    __compact__ = False
+
+    class __metaclass__(type):
+        @property
+        def __metadata__(cls):
+            return metadata.metadata_for(cls)
+
     def __init__(self):
         self._related_records = []
+        self._preloaded = {}
 
 
 @has_many("comments")
@@ -158,6 +167,32 @@ class TestBelongsTo(unittest.TestCase):
     def test_adds_entry_to_relationships(self, query):
         self.assertIn("post", associations_for(Comment))
 
+    def test_uses_preloaded_parent(self, query):
+        post = Post()
+        post.id = 1
+        self.comment._preloaded["post"] = post
+        self.assertEqual(self.comment.post, post)
+        self.assertEqual(query.Query.call_count, 0)
+
+    def test_ignores_preloaded_parent_for_other_key(self, query):
+        post = Post()
+        post.id = 2
+        self.comment._preloaded["post"] = post
+        self.comment.post
+        query.Query.assert_called_with(Post)
+
+    def test_preloads_parents_with_one_query(self, query):
+        post = Post()
+        post.id = 1
+        query.Query.return_value.where.return_value = [post]
+        other = Comment()
+        other.post_id = None
+        self.assertEqual(reflections_for(Comment)["post"].preload(
+            [self.comment, other]), [post])
+        query.Query.return_value.where.assert_called_once_with(id=[1])
+        self.assertEqual(self.comment._preloaded["post"], post)
+        self.assertEqual(other._preloaded["post"], None)
+
 
 @mock.patch("lazy_record.associations.query")
 class TestHasMany(unittest.TestCase):
@@ -212,6 +247,26 @@ class TestHasMany(unittest.TestCase):
     def test_adds_associations_for_child(self, query):
         self.assertIn("tag", associations_for(AnotherThing))
         self.assertEqual(None, associations_for(AnotherThing)['tag'])
+
+    def test_uses_preloaded_children(self, query):
+        comment = Comment()
+        self.post._preloaded["comments"] = [comment]
+        q = query.Query.return_value.where.return_value
+        self.assertEqual(self.post.comments, q.preloaded.return_value)
+        q.preloaded.assert_called_once_with([comment])
+
+    def test_preloads_children_with_one_query(self, query):
+        comment = Comment()
+        comment.post_id = 11
+        query.Query.return_value.where.return_value = [comment]
+        other = Post()
+        other.id = 12
+        reflections_for(Post)["comments"].preload([self.post, other])
+        query.Query.assert_called_once_with(Comment)
+        query.Query.return_value.where.assert_called_once_with(
+            post_id=[11, 12])
+        self.assertEqual(self.post._preloaded["comments"], [comment])
+        self.assertEqual(other._preloaded["comments"], [])
         
 
 @mock.patch("lazy_record.associations.query")
@@ -309,6 +364,12 @@ class TestHasOne(unittest.TestCase):
         self.assertIn("thing", foreign_keys_for(OtherThang))
         self.assertEqual("thingId", foreign_keys_for(OtherThang)["thing"])
 
+    def test_uses_preloaded_child(self, query):
+        other_thang = OtherThang()
+        self.thing._preloaded["other_thang"] = other_thang
+        self.assertEqual(self.thing.other_thang, other_thang)
+        self.assertEqual(query.Query.call_count, 0)
+
 
 @mock.patch("lazy_record.associations.query")
 class TestHasOneThroughOne(unittest.TestCase):
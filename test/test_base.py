@@ -24,6 +24,16 @@ class MyModel(Base):
 class MyOtherModel(Base):
     pass
 
+class MyCompactModel(Base):
+    __compact__ = True
+    __attributes__ = {
+        "name": str,
+        "count": int,
+    }
+
+class MySubCompactModel(MyCompactModel):
+    pass
+
 @mock.patch("base.datetime")
 @mock.patch("base.Repo")
 @mock.patch("base.Query")
@@ -62,9 +72,78 @@ class TestBase(unittest.TestCase):
         repo.where.assert_called_with(id=3)
         where = repo.where.return_value
         today = datetime.datetime.today.return_value
-        where.update.assert_called_with(name="foo",
-                                        created_at=today,
-                                        updated_at=today)
+        where.update.assert_called_with(name="foo", updated_at=today)
+
+    def test_updates_only_changed_attributes(self, Query, Repo, datetime):
+        Repo.table_name.return_value = "my_model"
+        my_record = MyModel.from_dict(id=3, name="foo", other="bar")
+        my_record.name = "baz"
+        my_record.save()
+        where = Repo.return_value.where.return_value
+        today = datetime.datetime.today.return_value
+        where.update.assert_called_once_with(name="baz", updated_at=today)
+
+    def test_does_not_update_clean_records(self, Query, Repo, datetime):
+        Repo.table_name.return_value = "my_model"
+        my_record = MyModel.from_dict(id=3, name="foo")
+        my_record.save()
+        self.assertEqual(Repo.return_value.where.return_value.update.call_count,
+                         0)
+        self.assertFalse(hasattr(my_record, "_updated_at"))
+
+    def test_does_not_update_records_changed_back(self, Query, Repo, dt):
+        Repo.table_name.return_value = "my_model"
+        my_record = MyModel.from_dict(id=3, name="foo")
+        my_record.name = "bar"
+        my_record.name = "foo"
+        my_record.save()
+        self.assertEqual(Repo.return_value.where.return_value.update.call_count,
+                         0)
+
+    def test_saving_cleans_record(self, Query, Repo, datetime):
+        Repo.table_name.return_value = "my_model"
+        my_record = MyModel.from_dict(id=3, name="foo")
+        my_record.name = "bar"
+        my_record.save()
+        my_record.save()
+        self.assertEqual(Repo.return_value.where.return_value.update.call_count,
+                         1)
+        self.assertFalse(my_record.is_dirty)
+
+    def test_tracks_changes(self, Query, Repo, datetime):
+        my_record = MyModel.from_dict(id=3, name="foo")
+        self.assertFalse(my_record.is_dirty)
+        my_record.name = 5
+        self.assertTrue(my_record.is_dirty)
+        self.assertEqual(my_record.changed, ["name"])
+        self.assertEqual(my_record.changes, {"name": ("foo", "5")})
+
+    def test_inserts_many_records(self, Query, Repo, datetime):
+        Repo.table_name.return_value = "my_model"
+        MyModel.insert_many([{"name": 1}, {"name": "bar"}])
+        Repo.assert_called_with("my_model")
+        today = datetime.datetime.today.return_value
+        Repo.return_value.insert_many.assert_called_once_with(
+            [{"name": "1", "created_at": today, "updated_at": today},
+             {"name": "bar", "created_at": today, "updated_at": today}],
+            return_ids=False)
+
+    def test_insert_many_returns_ids(self, Query, Repo, datetime):
+        Repo.return_value.insert_many.return_value = [4, 5]
+        self.assertEqual(MyModel.insert_many([{"name": "foo"},
+                                              {"name": "bar"}],
+                                             return_ids=True), [4, 5])
+
+    def test_insert_many_forbids_setting_id(self, Query, Repo, datetime):
+        with self.assertRaises(AttributeError):
+            MyModel.insert_many([{"name": "foo", "id": 3}])
+        self.assertEqual(Repo.return_value.insert_many.call_count, 0)
+
+    def test_insert_many_validates_when_asked(self, Query, Repo, datetime):
+        with self.assertRaises(base.RecordInvalid):
+            MyModel.insert_many([{"name": "foo"}, {"name": "invalid"}],
+                                validate=True)
+        self.assertEqual(Repo.return_value.insert_many.call_count, 0)
 
     def test_does_not_create_invalid_records(self, Query, Repo, datetime):
         Repo.table_name.return_value = "my_model"
@@ -142,6 +221,55 @@ class TestBase(unittest.TestCase):
         self.assertEqual(m.name, "foo")
         self.assertEqual(m.created_at, datetime.datetime.today.return_value)
 
+    def test_creates_from_rows(self, Query, Repo, datetime):
+        records = MyModel.from_rows(["id", "name"], [(1, "foo"), (2, "bar")])
+        self.assertEqual([(m.id, m.name) for m in records],
+                         [(1, "foo"), (2, "bar")])
+
+    def test_from_rows_does_not_call_init(self, Query, Repo, datetime):
+        with mock.patch.object(MyModel, "__init__") as init:
+            MyModel.from_rows(["id"], [(1,), (2,)])
+        self.assertEqual(init.call_count, 0)
+
+    def test_from_rows_looks_up_metadata_once(self, Query, Repo, dt):
+        with mock.patch("base.metadata.metadata_for") as metadata_for:
+            MyModel.from_rows(["id"], [(1,), (2,), (3,)])
+        metadata_for.assert_called_once_with(MyModel)
+
+    def test_records_from_rows_are_independent(self, Query, Repo, dt):
+        first, second = MyModel.from_rows(["id", "name"],
+                                          [(1, "foo"), (2, "bar")])
+        first.name = "baz"
+        self.assertEqual(first.changed, ["name"])
+        self.assertEqual(second.changed, [])
+        self.assertIsNot(first._related_records, second._related_records)
+
+    def test_casts_attribute_once(self, Query, Repo, datetime):
+        cast = mock.Mock(return_value="cast")
+        with mock.patch.object(MyModel, "__attributes__", {"name": cast}):
+            m = MyModel.from_dict(id=1, name="foo")
+            self.assertEqual(m.name, "cast")
+            self.assertEqual(m.name, "cast")
+        cast.assert_called_once_with("foo")
+
+    def test_reads_attributes_without_getattr(self, Query, Repo, datetime):
+        m = MyModel.from_dict(id=1, name="foo")
+        with mock.patch.object(MyModel, "__getattr__") as getattr_:
+            self.assertEqual((m.id, m.name), (1, "foo"))
+        self.assertEqual(getattr_.call_count, 0)
+
+    def test_setting_attribute_updates_cached_value(self, Query, Repo, dt):
+        m = MyModel.from_dict(id=1, name="foo")
+        m.name
+        m.name = 7
+        self.assertEqual(m.name, "7")
+
+    def test_setting_stored_value_clears_cached_value(self, Query, Repo, dt):
+        m = MyModel.from_dict(id=1, name="foo")
+        m.id
+        m._id = 2
+        self.assertEqual(m.id, 2)
+
     def test_forbids_setting_of_id(self, Query, Repo, datetime):
         m = MyModel()
         with self.assertRaises(AttributeError):
@@ -284,6 +412,7 @@ class TestBase(unittest.TestCase):
         self.assertEqual(MyModel.create(), record)
 
 
+@mock.patch("base.Query")
 @mock.patch("base.Repo")
 class TestBaseDestroy(unittest.TestCase):
 
@@ -291,28 +420,77 @@ class TestBaseDestroy(unittest.TestCase):
         self.my_model = MyModel(name="hi")
         self.my_model._id = 5
 
-    def test_deletes_without_dependents(self, Repo):
-        self.my_model.destroy()
-        Repo.assert_called_once_with("my_models")
-        repo = Repo.return_value
-        repo.where.assert_called_once_with(id=5)
-        where = repo.where.return_value
-        where.delete.assert_called_once_with()
-
-    @mock.patch.object(MyModel, "__dependents__", new=["my_childs"])
-    def test_deletes_dependents(self, Repo):
-        my_childs = mock.PropertyMock()
-        type(self.my_model).my_childs = my_childs
-        child = mock.Mock()
-        my_childs.return_value.__iter__.return_value = [child]
+    def test_destroys_through_query(self, Repo, Query):
         self.my_model.destroy()
-        my_childs.assert_called_with()
-        child._do_destroy.assert_called_with()
-        Repo.assert_called_with("my_models")
-        repo = Repo.return_value
-        repo.where.assert_called_with(id=5)
-        where = repo.where.return_value
-        where.delete.assert_called_with()
+        Query.assert_called_once_with(MyModel)
+        query = Query.return_value
+        query.where.assert_called_once_with(id=5)
+        query.where.return_value._destroy_all.assert_called_once_with()
+
+    def test_does_not_destroy_unsaved_records(self, Repo, Query):
+        MyModel(name="hi").destroy()
+        self.assertEqual(Query.call_count, 0)
 
 if __name__ == '__main__':
     unittest.main()
+
+
+@mock.patch("base.datetime")
+@mock.patch("base.Repo")
+class TestCompactBase(unittest.TestCase):
+
+    def test_records_have_no_dict(self, Repo, datetime):
+        m = MyCompactModel.from_dict(id=1, name="foo")
+        self.assertFalse(hasattr(m, "__dict__"))
+        self.assertFalse(hasattr(MySubCompactModel(), "__dict__"))
+
+    def test_keeps_loaded_row(self, Repo, datetime):
+        row = (1, "foo", "7")
+        m = MyCompactModel.from_rows(["id", "name", "count"], [row])[0]
+        self.assertIs(m._row, row)
+        self.assertEqual((m.id, m.name, m.count), (1, "foo", 7))
+
+    def test_records_share_layout(self, Repo, datetime):
+        first, second = MyCompactModel.from_rows(["id"], [(1,), (2,)])
+        self.assertIs(first._layout, second._layout)
+
+    def test_raises_for_attributes_not_loaded(self, Repo, datetime):
+        m = MyCompactModel.from_rows(["id"], [(1,)])[0]
+        with self.assertRaises(lazy_record.MissingAttributeError):
+            m.name
+
+    def test_setting_attribute_does_not_change_other_records(self, Repo, dt):
+        first, second = MyCompactModel.from_rows(["id", "name"],
+                                                 [(1, "foo"), (2, "bar")])
+        first.name = "baz"
+        first.count = "3"
+        self.assertEqual((first.name, first.count), ("baz", 3))
+        self.assertEqual(second.name, "bar")
+        self.assertEqual(first.changes, {"name": ("foo", "baz"),
+                                         "count": (None, 3)})
+        self.assertEqual(second.changes, {})
+
+    def test_builds_new_records(self, Repo, datetime):
+        m = MyCompactModel(name="foo")
+        self.assertEqual((m.id, m.name, m.count), (None, "foo", None))
+
+    def test_saves_new_records(self, Repo, datetime):
+        Repo.table_name.return_value = "my_compact_models"
+        Repo.return_value.insert.return_value = 4
+        m = MyCompactModel(name="foo")
+        m.save()
+        today = datetime.datetime.today.return_value
+        Repo.return_value.insert.assert_called_with(
+            name="foo", count=None, created_at=today, updated_at=today)
+        self.assertEqual(m.id, 4)
+
+    def test_updates_changed_attributes(self, Repo, datetime):
+        Repo.table_name.return_value = "my_compact_models"
+        m = MyCompactModel.from_dict(id=3, name="foo")
+        m.name = "bar"
+        m.save()
+        today = datetime.datetime.today.return_value
+        Repo.return_value.where.assert_called_with(id=3)
+        Repo.return_value.where.return_value.update.assert_called_with(
+            name="bar", updated_at=today)
+        self.assertFalse(m.is_dirty)
@@ -0,0 +1,87 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.events as events
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = mock.Mock()
+        events.on("query", self.listener)
+        self.db = mock.Mock()
+
+    def tearDown(self):
+        events.off("query", self.listener)
+
+    def event(self):
+        return self.listener.call_args[0][0]
+
+    def test_reports_writes(self):
+        self.db.execute.return_value.rowcount = 3
+        events.execute(self.db, "update", "books", "update books set x = ?",
+                       [5])
+        self.db.execute.assert_called_once_with("update books set x = ?",
+                                                [5])
+        event = self.event()
+        self.assertEqual((event.operation, event.table, event.sql,
+                          event.params, event.rows),
+                         ("update", "books", "update books set x = ?", [5],
+                          3))
+        self.assertGreaterEqual(event.duration, 0)
+
+    def test_reports_executemany(self):
+        events.execute(self.db, "insert", "books", "insert", [[1], [2]],
+                       many=True)
+        self.db.executemany.assert_called_once_with("insert", [[1], [2]])
+        self.assertEqual(self.event().params, [[1], [2]])
+
+    def test_reports_selects_once_rows_are_fetched(self):
+        cursor = self.db.execute.return_value
+        cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)]]
+        handle = events.execute(self.db, "select", "books", "select", [])
+        self.assertEqual(handle.fetchmany(2), [(1,), (2,)])
+        self.assertEqual(self.listener.call_count, 0)
+        self.assertEqual(handle.fetchmany(2), [(3,)])
+        self.assertEqual(self.event().rows, 3)
+        del handle
+        self.assertEqual(self.listener.call_count, 1)
+
+    def test_reports_discarded_selects(self):
+        self.db.execute.return_value.fetchone.return_value = (1,)
+        handle = events.execute(self.db, "select", "books", "select", [])
+        handle.fetchone()
+        del handle
+        self.assertEqual(self.event().rows, 1)
+
+    def test_reports_errors(self):
+        self.db.execute.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            events.execute(self.db, "delete", "books", "delete", [])
+        self.assertIsInstance(self.event().error, ValueError)
+        self.assertIsNone(self.event().rows)
+
+    def test_redacts_parameters(self):
+        redacted = mock.Mock()
+        events.on("query", redacted, redact=True)
+        try:
+            events.execute(self.db, "insert", "books", "insert", [["a", 1]],
+                           many=True)
+        finally:
+            events.off("query", redacted)
+        self.assertEqual(redacted.call_args[0][0].params, [["?", "?"]])
+        self.assertEqual(self.event().params, [["a", 1]])
+
+    def test_off_removes_listener(self):
+        events.off("query", self.listener)
+        events.execute(self.db, "delete", "books", "delete", [])
+        self.assertEqual(self.listener.call_count, 0)
+
+    def test_rejects_unknown_events(self):
+        with self.assertRaises(ValueError):
+            events.on("commit", self.listener)
+
+if __name__ == '__main__':
+    unittest.main()
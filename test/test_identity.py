@@ -0,0 +1,73 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.identity as identity
+
+
+class Post(object):
+
+    def __init__(self, **attributes):
+        for name, value in attributes.items():
+            setattr(self, "_" + name, value)
+
+    @property
+    def id(self):
+        return self._id
+
+    @classmethod
+    def from_rows(Post, columns, rows):
+        return [Post(**dict(zip(columns, row))) for row in rows]
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def test_loads_records_once(self):
+        with identity.identity_map() as identity_map:
+            first = identity_map.load(Post, ["id", "title"], [(1, "a")])
+            second = identity_map.load(Post, ["id", "title"],
+                                       [(2, "b"), (1, "a")])
+        self.assertIs(second[1], first[0])
+        self.assertEqual(second[0]._title, "b")
+
+    def test_builds_only_missing_records(self):
+        identity_map = identity.IdentityMap()
+        records = identity_map.load(Post, ["id"], [(1,)])
+        with mock.patch.object(Post, "from_rows",
+                               wraps=Post.from_rows) as from_rows:
+            identity_map.load(Post, ["id"], [(1,), (2,)])
+        from_rows.assert_called_once_with(["id"], [(2,)])
+
+    def test_replaces_records_missing_columns(self):
+        identity_map = identity.IdentityMap()
+        [partial] = identity_map.load(Post, ["id"], [(1,)])
+        [full] = identity_map.load(Post, ["id", "title"], [(1, "a")])
+        self.assertIsNot(full, partial)
+        self.assertIs(identity_map.get(Post, 1), full)
+
+    def test_does_not_map_records_without_id(self):
+        identity_map = identity.IdentityMap()
+        identity_map.load(Post, ["title"], [("a",)])
+        self.assertEqual(len(identity_map), 0)
+
+    def test_holds_records_weakly(self):
+        identity_map = identity.IdentityMap()
+        identity_map.load(Post, ["id"], [(1,)])
+        self.assertIsNone(identity_map.get(Post, 1))
+
+    def test_forgets_records_of_model(self):
+        identity_map = identity.IdentityMap()
+        records = identity_map.load(Post, ["id"], [(1,), (2,)])
+        identity_map.forget(Post)
+        self.assertEqual(len(identity_map), 0)
+
+    def test_is_current_while_started(self):
+        self.assertIsNone(identity.current())
+        with identity.identity_map() as identity_map:
+            self.assertIs(identity.current(), identity_map)
+        self.assertIsNone(identity.current())
+        self.assertEqual(identity.maps.active, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from lazy_record.associations import *
+import lazy_record
+import lazy_record.metadata as metadata
+
+
+@has_many("pamphlet_pages")
+class Pamphlet(lazy_record.Base):
+    __attributes__ = {
+        "title": str,
+    }
+
+
+@belongs_to("pamphlet")
+class PamphletPage(lazy_record.Base):
+    pass
+
+
+class SpecialPamphlet(Pamphlet):
+    pass
+
+
+class TestMetadata(unittest.TestCase):
+
+    def test_compiles_model_information(self):
+        compiled = Pamphlet.__metadata__
+        self.assertEqual(compiled.table_name, "pamphlets")
+        self.assertEqual(compiled.singular_name, "pamphlet")
+        self.assertEqual(compiled.attributes, {"title": str})
+        self.assertEqual(set(compiled.columns),
+                         set(["id", "title", "created_at", "updated_at"]))
+        self.assertEqual(compiled.dependents, ("pamphlet_pages",))
+        self.assertEqual(compiled.foreign_keys,
+                         {"pamphlet_pages": "pamphlet_id"})
+        self.assertEqual(compiled.associations, {"pamphlet_pages": None})
+        self.assertEqual(compiled.foreign_key, "pamphlet_id")
+
+    def test_includes_foreign_keys_in_attributes(self):
+        self.assertEqual(PamphletPage.__metadata__.attributes,
+                         {"pamphlet_id": int})
+
+    def test_is_compiled_once(self):
+        self.assertIs(Pamphlet.__metadata__, Pamphlet.__metadata__)
+
+    def test_all_attributes_are_shared(self):
+        self.assertIs(Pamphlet.__all_attributes__,
+                      Pamphlet.__all_attributes__)
+
+    def test_subclasses_have_their_own_metadata(self):
+        Pamphlet.__metadata__
+        self.assertEqual(SpecialPamphlet.__metadata__.table_name,
+                         "special_pamphlets")
+
+    def test_is_recompiled_when_associations_change(self):
+        compiled = PamphletPage.__metadata__
+        metadata.invalidate()
+        self.assertIsNot(PamphletPage.__metadata__, compiled)
+
+    def test_is_recompiled_when_attributes_are_replaced(self):
+        compiled = Pamphlet.__metadata__
+        with mock.patch.object(Pamphlet, "__attributes__", {"name": str}):
+            self.assertEqual(Pamphlet.__metadata__.attributes,
+                             {"name": str})
+        self.assertEqual(Pamphlet.__metadata__.attributes, {"title": str})
+
+    def test_is_read_only(self):
+        with self.assertRaises(AttributeError):
+            Pamphlet.__metadata__.table_name = "turnips"
+
+    def test_repo_uses_table_name(self):
+        with mock.patch.object(lazy_record.repo.inflector,
+                               "tableize") as tableize:
+            self.assertEqual(lazy_record.repo.Repo.table_name(Pamphlet),
+                             "pamphlets")
+        self.assertEqual(tableize.call_count, 0)
+
+    def test_defines_attributes_for_columns(self):
+        Pamphlet.__metadata__
+        self.assertIsInstance(Pamphlet.__dict__["title"], metadata.Attribute)
+        self.assertIsInstance(Pamphlet.__dict__["id"], metadata.Attribute)
+
+    def test_removes_attributes_of_removed_columns(self):
+        with mock.patch.object(Pamphlet, "__attributes__", {"name": str}):
+            Pamphlet.__metadata__
+            self.assertNotIn("title", Pamphlet.__dict__)
+        Pamphlet.__metadata__
+        self.assertIn("title", Pamphlet.__dict__)
+
+    def test_does_not_replace_other_class_attributes(self):
+        class Leaflet(lazy_record.Base):
+            __attributes__ = {"fold": int}
+            fold = "kept"
+        Leaflet.__metadata__
+        self.assertEqual(Leaflet.fold, "kept")
+
+    def test_joins_use_compiled_names(self):
+        # Once the names are known, joining does not inflect them again
+        PamphletPage.joins("pamphlets")
+        Pamphlet.joins("pamphlet_pages")
+        inflector = lazy_record.associations.inflector
+        with mock.patch.object(inflector, "singularize") as singularize, \
+                mock.patch.object(inflector, "pluralize") as pluralize:
+            self.assertEqual(PamphletPage.joins("pamphlets").join_args,
+                             [{"table": "pamphlets",
+                               "on": ["id", "pamphlet_id"]}])
+            self.assertEqual(Pamphlet.joins("pamphlet_pages").join_args,
+                             [{"table": "pamphlet_pages",
+                               "on": ["pamphlet_id", "id"]}])
+        self.assertEqual(singularize.call_count, 0)
+        self.assertEqual(pluralize.call_count, 0)
@@ -0,0 +1,62 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.n_plus_one as n_plus_one
+from lazy_record.errors import NPlusOneQuery
+
+
+class Post(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock()
+
+    def load(self, *ids):
+        for id in ids:
+            n_plus_one.loading(Post(id), "comments")
+
+    def test_finds_association_loaded_for_many_records(self):
+        with n_plus_one.detect_n_plus_one(logger=self.logger) as detector:
+            self.load(1, 2, 3)
+        [found] = detector.found
+        self.assertEqual((found.model, found.association, found.count),
+                         (Post, "comments", 3))
+        self.assertIn("test_n_plus_one.py", found.call_site)
+        self.assertIn("in load", found.call_site)
+        self.logger.warning.assert_called_once_with(
+            "N+1 query: {}".format(found))
+
+    def test_ignores_reloading_same_record(self):
+        with n_plus_one.detect_n_plus_one(logger=self.logger) as detector:
+            self.load(1, 1)
+        self.assertEqual(detector.found, [])
+        self.assertEqual(self.logger.warning.call_count, 0)
+
+    def test_uses_threshold(self):
+        with n_plus_one.detect_n_plus_one(threshold=4,
+                                          logger=self.logger) as detector:
+            self.load(1, 2, 3)
+        self.assertEqual(detector.found, [])
+
+    def test_strict_mode_raises(self):
+        with self.assertRaises(NPlusOneQuery):
+            with n_plus_one.detect_n_plus_one(strict=True):
+                self.load(1, 2)
+        self.assertEqual(n_plus_one.detectors.active, 0)
+
+    def test_only_watches_while_started(self):
+        detector = n_plus_one.detect_n_plus_one(logger=self.logger)
+        detector.stop()
+        self.load(1, 2)
+        self.assertEqual(detector.found, [])
+        self.assertEqual(n_plus_one.detectors.active, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+import unittest
+import mock
+import sys
+import os
+import threading
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from lazy_record.pool import Pool
+from lazy_record.errors import PoolTimeout
+
+
+@mock.patch("lazy_record.pool.sqlite3")
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = Pool("my_db", size=2, timeout=0.01)
+
+    def in_thread(self, function):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function()))
+        thread.start()
+        thread.join()
+        return result[0] if result else None
+
+    def test_connects_lazily(self, sqlite3):
+        self.assertEqual(sqlite3.connect.call_count, 0)
+        self.pool.execute("select 1")
+        sqlite3.connect.assert_called_once_with(
+            "my_db", detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False)
+
+    def test_runs_statements_on_new_connections(self, sqlite3):
+        pool = Pool("my_db", statements=["PRAGMA foreign_keys = ON"])
+        pool.connection()
+        sqlite3.connect.return_value.execute.assert_called_once_with(
+            "PRAGMA foreign_keys = ON")
+
+    def test_passes_options_to_connect(self, sqlite3):
+        Pool("my_db", options={"cached_statements": 500}).connection()
+        sqlite3.connect.assert_called_once_with(
+            "my_db", detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False, cached_statements=500)
+
+    def test_thread_keeps_its_connection(self, sqlite3):
+        self.assertIs(self.pool.connection(), self.pool.connection())
+        self.assertEqual(self.pool.stats()["checkouts"], 1)
+
+    def test_threads_get_their_own_connection(self, sqlite3):
+        sqlite3.connect.side_effect = lambda *args, **kwargs: mock.Mock()
+        mine = self.pool.connection()
+        theirs = self.in_thread(self.pool.connection)
+        self.assertIsNot(mine, theirs)
+        self.assertEqual(self.pool.stats()["open"], 2)
+
+    def test_release_returns_connection_to_pool(self, sqlite3):
+        connection = self.pool.connection()
+        self.pool.release()
+        connection.rollback.assert_called_once_with()
+        self.assertEqual(self.pool.stats()["idle"], 1)
+        self.assertIs(self.in_thread(self.pool.connection), connection)
+        self.assertEqual(sqlite3.connect.call_count, 1)
+
+    def hold_in_thread(self):
+        # Check a connection out in a thread that stays alive until the
+        # returned event is set
+        started = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            self.pool.connection()
+            started.set()
+            done.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        started.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+        return done
+
+    def test_times_out_when_exhausted(self, sqlite3):
+        self.pool.connection()
+        self.hold_in_thread()
+        with self.assertRaises(PoolTimeout):
+            self.pool.checkout()
+        stats = self.pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["in_use"], 2)
+
+    def test_reclaims_connections_of_ended_threads(self, sqlite3):
+        sqlite3.connect.side_effect = lambda *args, **kwargs: mock.Mock()
+        self.pool.connection()
+        theirs = self.in_thread(self.pool.connection)
+        self.assertIs(self.pool.checkout(), theirs)
+        theirs.rollback.assert_called_once_with()
+        stats = self.pool.stats()
+        self.assertEqual(stats["reclaimed"], 1)
+        self.assertEqual(stats["waits"], 0)
+
+    def test_reclaims_connections_while_waiting(self, sqlite3):
+        sqlite3.connect.side_effect = lambda *args, **kwargs: mock.Mock()
+        self.pool.timeout = 5
+        self.pool.connection()
+        done = self.hold_in_thread()
+        threading.Timer(0.01, done.set).start()
+        self.pool.checkout()
+        stats = self.pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertEqual(stats["reclaimed"], 1)
+
+    def test_rolls_back_transactions_of_ended_threads(self, sqlite3):
+        sqlite3.connect.side_effect = lambda *args, **kwargs: mock.Mock(
+            isolation_level="")
+
+        def begin():
+            connection = self.pool.connection()
+            connection.isolation_level = None
+            return connection
+        self.pool.connection()
+        theirs = self.in_thread(begin)
+        self.pool.checkout()
+        theirs.execute.assert_called_with("ROLLBACK")
+        self.assertEqual(theirs.isolation_level, "")
+
+    def test_waits_for_released_connection(self, sqlite3):
+        self.pool.timeout = 5
+        self.pool.connection()
+        connections = []
+        started = threading.Event()
+        released = threading.Event()
+
+        def hold():
+            connections.append(self.pool.connection())
+            started.set()
+            released.wait()
+            self.pool.release()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        started.wait()
+        waiter = threading.Thread(
+            target=lambda: connections.append(self.pool.connection()))
+        waiter.start()
+        while not self.pool.stats()["waits"]:
+            time.sleep(0.001)
+        released.set()
+        waiter.join()
+        holder.join()
+        self.assertIs(connections[1], connections[0])
+        self.assertEqual(self.pool.stats()["waits"], 1)
+
+    def test_shares_in_memory_database(self, sqlite3):
+        sqlite3.connect.side_effect = lambda *args, **kwargs: mock.Mock()
+        pool = Pool(":memory:", size=5)
+        self.assertIs(pool.connection(), self.in_thread(pool.connection))
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_close_closes_connections(self, sqlite3):
+        connection = self.pool.connection()
+        self.pool.close()
+        connection.close.assert_called_once_with()
+        self.assertEqual(self.pool.stats()["open"], 0)
+
+    def test_acts_as_current_connection(self, sqlite3):
+        connection = self.pool.connection()
+        with self.pool:
+            self.pool.executemany("insert", [[1]])
+        connection.__enter__.assert_called_once_with()
+        connection.__exit__.assert_called_once_with(None, None, None)
+        connection.executemany.assert_called_once_with("insert", [[1]])
+
+
+@mock.patch("lazy_record.pool.sqlite3")
+class TestTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = Pool("my_db")
+
+    def statements(self, connection):
+        return [c[0][0] for c in connection.execute.call_args_list]
+
+    def test_begins_and_commits(self, sqlite3):
+        connection = self.pool.connection()
+        connection.isolation_level = ""
+        with self.pool.transaction("immediate"):
+            self.assertIsNone(connection.isolation_level)
+            self.pool.execute("insert")
+        self.assertEqual(self.statements(connection),
+                         ["BEGIN IMMEDIATE", "insert", "COMMIT"])
+        self.assertEqual(connection.isolation_level, "")
+
+    def test_rolls_back_on_error(self, sqlite3):
+        connection = self.pool.connection()
+        with self.assertRaises(ValueError):
+            with self.pool.transaction():
+                raise ValueError
+        self.assertEqual(self.statements(connection),
+                         ["BEGIN DEFERRED", "ROLLBACK"])
+        self.assertFalse(self.pool.in_transaction())
+
+    def test_nests_savepoints(self, sqlite3):
+        connection = self.pool.connection()
+        with self.pool.transaction():
+            with self.assertRaises(ValueError):
+                with self.pool.transaction():
+                    raise ValueError
+            with self.pool.transaction():
+                pass
+        self.assertEqual(self.statements(connection), [
+            "BEGIN DEFERRED",
+            "SAVEPOINT lazy_record_1",
+            "ROLLBACK TO lazy_record_1",
+            "RELEASE lazy_record_1",
+            "SAVEPOINT lazy_record_1",
+            "RELEASE lazy_record_1",
+            "COMMIT",
+        ])
+
+    def test_blocks_join_transaction(self, sqlite3):
+        connection = self.pool.connection()
+        with self.pool.transaction():
+            with self.pool:
+                pass
+        self.assertFalse(connection.__enter__.called)
+        self.assertEqual(self.statements(connection), [
+            "BEGIN DEFERRED",
+            "SAVEPOINT lazy_record_1",
+            "RELEASE lazy_record_1",
+            "COMMIT",
+        ])
+
+    def test_release_rolls_back_transaction(self, sqlite3):
+        connection = self.pool.connection()
+        self.pool.transaction().__enter__()
+        self.pool.release()
+        self.assertEqual(self.statements(connection),
+                         ["BEGIN DEFERRED", "ROLLBACK"])
+        self.assertFalse(self.pool.in_transaction())
+
+    def test_writing_within_blocks_and_transactions(self, sqlite3):
+        self.assertFalse(self.pool.writing())
+        with self.pool:
+            self.assertTrue(self.pool.writing())
+        with self.pool.transaction():
+            self.assertTrue(self.pool.writing())
+        self.assertFalse(self.pool.writing())
+
+    def test_rejects_unknown_mode(self, sqlite3):
+        with self.assertRaises(ValueError):
+            self.pool.transaction("LAZY")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from lazy_record.profiles import settings_for
+
+
+class TestProfiles(unittest.TestCase):
+
+    def test_default_changes_nothing(self):
+        self.assertEqual(settings_for(), ([], {}))
+        self.assertEqual(settings_for("default"), ([], {}))
+
+    def test_gets_pragmas_of_profile(self):
+        pragmas, options = settings_for("throughput")
+        self.assertEqual(pragmas, ["PRAGMA journal_mode = WAL",
+                                   "PRAGMA synchronous = NORMAL",
+                                   "PRAGMA cache_size = -64000",
+                                   "PRAGMA mmap_size = 268435456",
+                                   "PRAGMA temp_store = MEMORY"])
+        self.assertEqual(options, {"cached_statements": 500})
+
+    def test_overrides_replace_profile_settings(self):
+        pragmas, options = settings_for("throughput", synchronous="FULL",
+                                        mmap_size=None,
+                                        cached_statements=50)
+        self.assertIn("PRAGMA synchronous = FULL", pragmas)
+        self.assertNotIn("PRAGMA mmap_size = 268435456", pragmas)
+        self.assertEqual(options, {"cached_statements": 50})
+
+    def test_converts_booleans(self):
+        self.assertEqual(settings_for(foreign_keys=True),
+                         (["PRAGMA foreign_keys = ON"], {}))
+
+    def test_sets_busy_timeout(self):
+        self.assertEqual(settings_for(busy_timeout=2000),
+                         (["PRAGMA busy_timeout = 2000"], {}))
+
+    def test_rejects_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            settings_for("fastest")
+
+    def test_rejects_unknown_setting(self):
+        with self.assertRaises(ValueError):
+            settings_for(page_size=4096)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,8 @@ import query
 class TunaCasserole(object):
     __all_attributes__ = {"my_attr": int, "created_at": int, "updated_at":int}
     __scopes__ = {}
+    __metadata__ = mock.Mock(singular_name="tuna_casserole", foreign_keys={},
+                             dependents=())
 
     def __init__(self, **kwargs):
         self._related_records = []
@@ -23,6 +25,11 @@ class TunaCasserole(object):
     def from_dict(TunaCasserole, **kwargs):
         return kwargs
 
+    @classmethod
+    def from_rows(TunaCasserole, columns, rows):
+        return [TunaCasserole.from_dict(**dict(zip(columns, row)))
+                for row in rows]
+
 class MyRelations(object):
     pass
 
@@ -39,15 +46,14 @@ class TestQuery(unittest.TestCase):
         Repo.table_name.return_value = "tuna_casseroles"
         list(Query(TunaCasserole).all())
         repo = Repo.return_value
-        repo.select.assert_called_with("id", "created_at",
-                                       "updated_at", "my_attr")
+        repo.order_by.return_value.select.assert_called_with(
+            "id", "created_at", "updated_at", "my_attr")
 
     def test_constructs_object_with_information(self, Repo):
         repo = Repo.return_value
-        fetchall_return = [(2, 33, 15)]
-        fetchall = mock.Mock(return_value=fetchall_return)
-        select_mock = mock.Mock(fetchall=fetchall)
-        repo.select.return_value = mock.Mock(fetchall=fetchall)
+        fetchmany = mock.Mock(return_value=[(2, 33, 15)])
+        repo.order_by.return_value.select.return_value = mock.Mock(
+            fetchmany=fetchmany)
         self.assertEqual(list(Query(TunaCasserole).all())[0],
             {"id": 2, "updated_at": 15, "created_at": 33})
 
@@ -55,28 +61,32 @@ class TestQuery(unittest.TestCase):
         list(Query(TunaCasserole).where(my_attr=5))
         repo = Repo.return_value
         repo.where.assert_called_with([], my_attr=5)
-        repo.where.return_value.select.assert_called_with(
+        order = repo.where.return_value.order_by.return_value
+        order.select.assert_called_with(
             "id", "created_at", "updated_at", "my_attr")
 
     def test_where_allows_all_after(self, Repo):
         list(Query(TunaCasserole).where(my_attr=5).all())
         repo = Repo.return_value
         repo.where.assert_called_with([], my_attr=5)
-        repo.where.return_value.select.assert_called_with(
+        order = repo.where.return_value.order_by.return_value
+        order.select.assert_called_with(
             "id", "created_at", "updated_at", "my_attr")
 
     def test_where_allows_chaining(self, Repo):
         list(Query(TunaCasserole).where(my_attr=5).where(id=7))
         repo = Repo.return_value
         repo.where.assert_called_with([], my_attr=5, id=7)
-        repo.where.return_value.select.assert_called_with(
+        order = repo.where.return_value.order_by.return_value
+        order.select.assert_called_with(
             "id", "created_at", "updated_at", "my_attr")
 
     def test_where_allows_arbitrary_queries(self, Repo):
         list(Query(TunaCasserole).where("my_attr == ?", 5))
         repo = Repo.return_value
         repo.where.assert_called_with([("my_attr == ?", 5)])
-        repo.where.return_value.select.assert_called_with(
+        order = repo.where.return_value.order_by.return_value
+        order.select.assert_called_with(
             "id", "created_at", "updated_at", "my_attr")
 
     def test_where_with_arbitrary_queries_allows_chaining(self, Repo):
@@ -85,7 +95,8 @@ class TestQuery(unittest.TestCase):
         repo = Repo.return_value
         repo.where.assert_called_with([("my_attr > ?", 5),
                                        ("my_attr < ?", 10)])
-        repo.where.return_value.select.assert_called_with(
+        order = repo.where.return_value.order_by.return_value
+        order.select.assert_called_with(
             "id", "created_at", "updated_at", "my_attr")
 
     def test_allows_ordering(self, Repo):
@@ -213,23 +224,23 @@ class TestQuery(unittest.TestCase):
         record = Query(TunaCasserole).where(my_attr=11).build(my_attr=12)
         self.assertEqual(record.my_attr, 12)
 
-    @mock.patch("query.associations.foreign_keys_for")
-    def test_unrelates_records(self, fkf, Repo):
-        fkf.return_value = {'tuna_casserole': 'tuna_casserole_id'}
-        Repo.table_name.return_value = "tuna_casseroles"
+    def test_unrelates_records(self, Repo):
         t = TunaCasserole()
         t2 = TunaCasserole(tuna_casserole_id=15)
-        Query(TunaCasserole, record=t).delete(t2)
+        with mock.patch.object(TunaCasserole.__metadata__, "foreign_keys",
+                               {'tuna_casserole': 'tuna_casserole_id'}):
+            Query(TunaCasserole, record=t).delete(t2)
         self.assertEqual(t2.tuna_casserole_id, None)
 
     def test_displays_as_empty_query(self, Repo):
-        Repo.return_value.select.return_value.fetchall.return_value = []
+        Repo.return_value.select.return_value.fetchmany.return_value = []
         self.assertEqual(repr(Query(TunaCasserole)), "<lazy_record.Query []>")
 
     def test_displays_as_query_with_records(self, Repo):
-        Repo.return_value.select.return_value.fetchall.return_value = [
+        order = Repo.return_value.order_by.return_value
+        order.select.return_value.fetchmany.return_value = [
             (1, 7, datetime.datetime(2016, 1, 1))]
-        # Recall that TunaCasserole overrides #from_dict to return
+        # Recall that TunaCasserole overrides #from_rows to return
         # 'mytestvalue' so that is what it will repr as
         self.assertEqual(repr(Query(TunaCasserole)),
                      "<lazy_record.Query [{'created_at': 7, 'id': 1, "
@@ -240,13 +251,114 @@ class TestQuery(unittest.TestCase):
 
     def tests_inclusion(self, Repo):
         repo = Repo.return_value
-        fetchall_return = [(15, 2, 33)]
-        fetchall = mock.Mock(return_value=fetchall_return)
-        select_mock = mock.Mock(fetchall=fetchall)
-        repo.select.return_value = mock.Mock(fetchall=fetchall)
+        fetchmany = mock.Mock(return_value=[(15, 2, 33)])
+        repo.order_by.return_value.select.return_value = mock.Mock(
+            fetchmany=fetchmany)
         self.assertIn({'created_at': 2, 'id': 15, 'updated_at': 33},
                       Query(TunaCasserole).all())
 
+    def test_fetches_rows_in_batches(self, Repo):
+        select = Repo.return_value.order_by.return_value.select.return_value
+        select.fetchmany.side_effect = [[(1, 2, 3), (2, 2, 3)], [(3, 2, 3)]]
+        Repo.return_value.max_id.return_value = 3
+        records = list(Query(TunaCasserole).stream(batch_size=2))
+        self.assertEqual([record["id"] for record in records], [1, 2, 3])
+        self.assertEqual(select.fetchmany.call_args_list,
+                         [mock.call(2), mock.call(2)])
+
+    def test_streaming_skips_rows_added_while_iterating(self, Repo):
+        select = Repo.return_value.order_by.return_value.select.return_value
+        select.fetchmany.side_effect = [[(1, 2, 3), (2, 2, 3)], [(3, 2, 3)]]
+        Repo.return_value.max_id.return_value = 2
+        records = list(Query(TunaCasserole).stream(batch_size=2))
+        self.assertEqual([record["id"] for record in records], [1, 2])
+
+    def test_streaming_resumes_after_cursor_is_reset(self, Repo):
+        Repo.table_name.return_value = "tuna_casseroles"
+        repo = Repo.return_value
+        first = repo.order_by.return_value.select.return_value
+        first.fetchmany.side_effect = [[(1, 2, 3), (2, 2, 3)],
+                                       query.sqlite3.InterfaceError()]
+        resumed = repo.where.return_value.order_by.return_value.select
+        resumed.return_value.fetchmany.side_effect = [[(4, 2, 3)]]
+        repo.max_id.return_value = 4
+        records = list(Query(TunaCasserole).stream(batch_size=2))
+        self.assertEqual([record["id"] for record in records], [1, 2, 4])
+        repo.where.assert_called_with([("tuna_casseroles.id > ?", 2)])
+        first.close.assert_called_once_with()
+
+    def test_reads_custom_ordered_query_at_once(self, Repo):
+        order = Repo.return_value.order_by.return_value
+        order.select.return_value.fetchall.return_value = [(2, 2, 3),
+                                                           (1, 2, 3)]
+        records = list(Query(TunaCasserole).order_by(my_attr="desc")
+                       .stream(batch_size=1))
+        self.assertEqual([record["id"] for record in records], [2, 1])
+        self.assertFalse(order.select.return_value.fetchmany.called)
+
+    def test_stream_does_not_mutate_query(self, Repo):
+        q = Query(TunaCasserole)
+        q.stream(batch_size=10)
+        self.assertEqual(q.batch_size, 500)
+
+    def test_stream_raises_if_batch_size_is_not_positive(self, Repo):
+        with self.assertRaises(query.QueryInvalid):
+            Query(TunaCasserole).stream(batch_size=0)
+
+    def test_in_batches_pages_by_id(self, Repo):
+        Repo.table_name.return_value = "tuna_casseroles"
+        repo = Repo.return_value
+        first_batch = repo.order_by.return_value.limit.return_value
+        first_batch.select.return_value.fetchall.return_value = [
+            (1, 2, 3), (2, 2, 3)]
+        where = repo.where.return_value
+        next_batch = where.order_by.return_value.limit.return_value
+        next_batch.select.return_value.fetchall.return_value = [(5, 2, 3)]
+        batches = list(Query(TunaCasserole).in_batches(batch_size=2))
+        self.assertEqual([[record["id"] for record in batch]
+                          for batch in batches], [[1, 2], [5]])
+        repo.order_by.assert_called_with(**{"tuna_casseroles.id": "asc"})
+        repo.where.assert_called_with([("tuna_casseroles.id > ?", 2)])
+        where.order_by.return_value.limit.assert_called_with(2)
+
+    def test_in_batches_stops_at_limit(self, Repo):
+        Repo.table_name.return_value = "tuna_casseroles"
+        repo = Repo.return_value
+        first_batch = repo.order_by.return_value.limit.return_value
+        first_batch.select.return_value.fetchall.return_value = [
+            (1, 2, 3), (2, 2, 3)]
+        where = repo.where.return_value
+        next_batch = where.order_by.return_value.limit.return_value
+        next_batch.select.return_value.fetchall.return_value = [(5, 2, 3)]
+        q = Query(TunaCasserole)
+        q.limit_count = 3
+        batches = list(q.in_batches(batch_size=2))
+        self.assertEqual([[record["id"] for record in batch]
+                          for batch in batches], [[1, 2], [5]])
+        repo.order_by.return_value.limit.assert_called_with(2)
+        where.order_by.return_value.limit.assert_called_with(1)
+
+    def test_in_batches_keeps_restrictions(self, Repo):
+        Repo.table_name.return_value = "tuna_casseroles"
+        list(Query(TunaCasserole).where(my_attr=5).in_batches(batch_size=2))
+        Repo.return_value.where.assert_called_with([], my_attr=5)
+
+    def test_in_batches_selects_id(self, Repo):
+        Repo.table_name.return_value = "tuna_casseroles"
+        list(Query(TunaCasserole).select("my_attr").in_batches())
+        limit = Repo.return_value.order_by.return_value.limit
+        limit.return_value.select.assert_called_with("id", "my_attr")
+
+    def test_in_batches_raises_with_custom_order(self, Repo):
+        with self.assertRaises(query.QueryInvalid):
+            list(Query(TunaCasserole).order_by(my_attr="asc").in_batches())
+
+    def test_find_each_yields_records_from_batches(self, Repo):
+        q = Query(TunaCasserole)
+        q.in_batches = mock.Mock(return_value=iter([[1, 2], [3]]))
+        self.assertEqual(list(q.find_each(batch_size=2)), [1, 2, 3])
+        q.in_batches.assert_called_with(2)
+
     def test_len_invokes_SQL_count_function(self, Repo):
         repo = Repo.return_value
         len(Query(TunaCasserole).all())
@@ -257,6 +369,98 @@ class TestQuery(unittest.TestCase):
         fetchone.return_value = (2276,)
         self.assertEqual(len(Query(TunaCasserole).all()), 2276)
 
+    def test_exists_checks_for_first_record(self, Repo):
+        repo = Repo.return_value
+        repo.where.return_value = repo
+        repo.exists.return_value = True
+        self.assertTrue(Query(TunaCasserole).where(my_attr=5).exists())
+        repo.where.assert_called_with([], my_attr=5)
+        self.assertEqual(repo.count.call_count, 0)
+        self.assertEqual(repo.select.call_count, 0)
+
+    def test_truthiness_uses_exists(self, Repo):
+        Repo.return_value.exists.return_value = False
+        self.assertFalse(Query(TunaCasserole))
+        self.assertEqual(Repo.return_value.count.call_count, 0)
+
+    def test_exists_uses_preloaded_records(self, Repo):
+        self.assertFalse(Query(TunaCasserole).preloaded([]).exists())
+        self.assertTrue(Query(TunaCasserole).preloaded([1]))
+        self.assertEqual(Repo.return_value.exists.call_count, 0)
+
+    def test_sum_aggregates_in_sql(self, Repo):
+        repo = Repo.return_value
+        repo.aggregate.return_value.fetchone.return_value = (17,)
+        self.assertEqual(Query(TunaCasserole).sum("my_attr"), 17)
+        repo.aggregate.assert_called_once_with("sum", "my_attr",
+                                               distinct=False)
+
+    def test_aggregates_ignore_order_and_limit(self, Repo):
+        repo = Repo.return_value
+        repo.order_by.return_value = repo
+        repo.limit.return_value = repo
+        repo.aggregate.return_value.fetchone.return_value = (2.5,)
+        Query(TunaCasserole).order_by(my_attr="asc").average("my_attr")
+        self.assertEqual((repo.order_clause, repo.limit_value), ("", []))
+        repo.aggregate.assert_called_once_with("avg", "my_attr",
+                                               distinct=False)
+
+    def test_minimum_and_maximum_cast_values(self, Repo):
+        aggregate = Repo.return_value.aggregate
+        aggregate.return_value.fetchone.return_value = ("4",)
+        self.assertEqual(Query(TunaCasserole).minimum("my_attr"), 4)
+        self.assertEqual(Query(TunaCasserole).maximum("my_attr"), 4)
+
+    def test_count_counts_distinct_values(self, Repo):
+        aggregate = Repo.return_value.aggregate
+        aggregate.return_value.fetchone.return_value = (3,)
+        self.assertEqual(Query(TunaCasserole).count("my_attr",
+                                                    distinct=True), 3)
+        aggregate.assert_called_once_with("count", "my_attr", distinct=True)
+
+    def test_grouped_aggregates_return_dictionary(self, Repo):
+        repo = Repo.return_value
+        repo.group_by.return_value = repo
+        repo.aggregate.return_value.fetchall.return_value = [("a", 2),
+                                                             ("b", 5)]
+        self.assertEqual(Query(TunaCasserole).group("name").count(),
+                         {"a": 2, "b": 5})
+        repo.group_by.assert_called_with("name")
+
+    def test_pluck_selects_column(self, Repo):
+        repo = Repo.return_value
+        repo.where.return_value = repo
+        repo.select.return_value.fetchall.return_value = [("1",), ("2",)]
+        with mock.patch.object(TunaCasserole, "from_rows") as from_rows:
+            self.assertEqual(
+                Query(TunaCasserole).where(id=5).pluck("my_attr"), [1, 2])
+        repo.select.assert_called_once_with("my_attr")
+        self.assertEqual(from_rows.call_count, 0)
+
+    def test_pluck_returns_tuples_for_many_columns(self, Repo):
+        fetchall = Repo.return_value.select.return_value.fetchall
+        fetchall.return_value = [(1, "7"), (2, None)]
+        self.assertEqual(Query(TunaCasserole).pluck("id", "my_attr"),
+                         [(1, 7), (2, None)])
+        Repo.return_value.select.assert_called_once_with("id", "my_attr")
+
+    def test_pluck_requires_columns(self, Repo):
+        with self.assertRaises(query.QueryInvalid):
+            Query(TunaCasserole).pluck()
+
+    def test_values_returns_dictionaries(self, Repo):
+        fetchall = Repo.return_value.select.return_value.fetchall
+        fetchall.return_value = [(1, "7")]
+        self.assertEqual(Query(TunaCasserole).values("id", "my_attr"),
+                         [{"id": 1, "my_attr": 7}])
+
+    def test_pluck_uses_preloaded_records(self, Repo):
+        records = [TunaCasserole(id=1, my_attr=5)]
+        self.assertEqual(
+            Query(TunaCasserole).preloaded(records).pluck("id", "my_attr"),
+            [(1, 5)])
+        self.assertEqual(Repo.return_value.select.call_count, 0)
+
     def test_where_with_list_uses_sql_in(self, Repo):
         repo = Repo.return_value
         list(Query(TunaCasserole).where(name=["foo", "bar", "baz"]))
@@ -296,6 +500,83 @@ class TestQuery(unittest.TestCase):
         query.build = mock.Mock(name="build", return_value=record)
         self.assertEqual(query.create(name="foo"), record)
 
+    def test_create_many_applies_restrictions(self, Repo):
+        TunaCasserole.insert_many = mock.Mock(name="insert_many")
+        try:
+            Query(TunaCasserole).where(my_attr=11).create_many(
+                [{"name": "foo"}, {"name": "bar", "my_attr": 12}])
+            TunaCasserole.insert_many.assert_called_with(
+                [{"name": "foo", "my_attr": 11},
+                 {"name": "bar", "my_attr": 12}],
+                return_ids=False, validate=False)
+        finally:
+            del TunaCasserole.insert_many
+
+    def test_create_many_raises_through_joins(self, Repo):
+        q = Query(TunaCasserole)
+        q.join_args = [{'table': 'my_relations', 'on': ['id', 'my_id']}]
+        with self.assertRaises(query.QueryInvalid):
+            q.create_many([{"name": "foo"}])
+
+    def test_update_all_updates_matching_records(self, Repo):
+        repo = Repo.return_value
+        repo.where.return_value.update.return_value = 4
+        count = Query(TunaCasserole).where(my_attr=5).update_all(my_attr="6")
+        repo.where.assert_called_with([], my_attr=5)
+        repo.where.return_value.update.assert_called_with(my_attr=6)
+        self.assertEqual(count, 4)
+
+    def test_update_all_raises_for_unknown_attributes(self, Repo):
+        with self.assertRaises(AttributeError):
+            Query(TunaCasserole).update_all(turnips=6)
+        with self.assertRaises(AttributeError):
+            Query(TunaCasserole).update_all(id=6)
+
+    def test_delete_all_deletes_matching_records(self, Repo):
+        repo = Repo.return_value
+        repo.where.return_value.delete.return_value = 2
+        count = Query(TunaCasserole).where(my_attr=5).delete_all()
+        repo.where.assert_called_with([], my_attr=5)
+        self.assertEqual(count, 2)
+
+    def test_delete_all_uses_subquery_with_joins(self, Repo):
+        repo = Repo.return_value
+        q = Query(TunaCasserole).where(my_relations={"name": "foo"})
+        q.join_args = [{'table': 'my_relations', 'on': ['id', 'my_id']}]
+        q.delete_all()
+        repo.where.assert_any_call([], my_relations={"name": "foo"})
+        subquery = repo.where.return_value.inner_join.return_value
+        repo.where.assert_called_with(id=subquery)
+        repo.where.return_value.delete.assert_called_with()
+
+    @mock.patch("query.associations.reflections_for")
+    def test_destroy_all_deletes_dependents_first(self, reflections_for, Repo):
+        reflection = mock.Mock(on_delete_cascade=False)
+        reflections_for.return_value = {"my_relations": reflection}
+        repo = Repo.return_value
+        repo.where.return_value.delete.return_value = 3
+        with mock.patch.object(TunaCasserole.__metadata__, "dependents",
+                               ("my_relations",)):
+            q = Query(TunaCasserole).where(my_attr=5)
+            self.assertEqual(q.destroy_all(), 3)
+        reflection.dependents.assert_called_with(q)
+        reflection.dependents.return_value._destroy_all.assert_called_with()
+        repo.where.return_value.delete.assert_called_with()
+
+    @mock.patch("query.associations.reflections_for")
+    def test_destroy_all_leaves_cascades_to_database(self, reflections_for,
+                                                     Repo):
+        reflection = mock.Mock(on_delete_cascade=True)
+        reflections_for.return_value = {"my_relations": reflection}
+        with mock.patch.object(TunaCasserole.__metadata__, "dependents",
+                               ("my_relations",)):
+            Query(TunaCasserole).destroy_all()
+        # Only the dependents of the dependents are destroyed
+        dependents = reflection.dependents.return_value
+        dependents._destroy_dependents.assert_called_with()
+        self.assertFalse(dependents._destroy_all.called)
+        Repo.return_value.delete.assert_called_with()
+
     def test_find_records_when_exists(self, Repo):
         repo = Repo.return_value
         fetchone_return = {"id": 5, "my_attr": 15, "created_at": 33}
@@ -342,7 +623,8 @@ class TestRepeatedQueries(unittest.TestCase):
             list(q)
             repo = Repo.return_value
             repo.where.assert_called_with([], my_attr=5)
-            repo.where.return_value.select.assert_called_with(
+            order = repo.where.return_value.order_by.return_value
+            order.select.assert_called_with(
                 "id", "created_at", "updated_at", "my_attr")
 
     def test_gets_last_record(self):
@@ -1,6 +1,11 @@
 import unittest
+import mock
 import sys
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 # This way, we pick the lazy_record local even if one is installed
 sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 sys.path.insert(0, os.path.join(
@@ -60,6 +65,26 @@ class Joiner(lazy_record.Base):
 class EndTwo(lazy_record.Base):
     pass
 
+@has_many("pages", on_delete_cascade=True)
+class Manual(lazy_record.Base):
+    pass
+
+@has_many("figures")
+@belongs_to("manual")
+class Page(lazy_record.Base):
+    pass
+
+@belongs_to("page")
+class Figure(lazy_record.Base):
+    pass
+
+@belongs_to("book")
+class Note(lazy_record.Base):
+    __compact__ = True
+    __attributes__ = {
+        "body": str,
+    }
+
 test_schema = """
 drop table if exists people;
 create table people (
@@ -121,6 +146,34 @@ create table joiners (
   end_two_id integer,
   created_at timestamp not null,
   updated_at timestamp not null
+);
+drop table if exists notes;
+create table notes (
+  id integer primary key autoincrement,
+  book_id integer,
+  body text,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+drop table if exists manuals;
+create table manuals (
+  id integer primary key autoincrement,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+drop table if exists pages;
+create table pages (
+  id integer primary key autoincrement,
+  manual_id integer references manuals (id) on delete cascade,
+  created_at timestamp not null,
+  updated_at timestamp not null
+);
+drop table if exists figures;
+create table figures (
+  id integer primary key autoincrement,
+  page_id integer,
+  created_at timestamp not null,
+  updated_at timestamp not null
 )
 """
 
@@ -366,5 +419,954 @@ class TestAddsRecords(unittest.TestCase):
         self.assertEqual(lending.person_id, self.person.id)
         self.assertEqual(lending.book_id, self.book.id)
 
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        Book.insert_many([{} for _ in range(5)])
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_streams_all_records(self):
+        ids = [book.id for book in Book.all().stream(batch_size=2)]
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_does_not_visit_records_created_while_streaming(self):
+        ids = []
+        for book in Book.all().stream(batch_size=2):
+            ids.append(book.id)
+            Book.create()
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_allows_rollback_while_streaming(self):
+        ids = []
+        for book in Book.all().stream(batch_size=2):
+            ids.append(book.id)
+            db = lazy_record.repo.Repo.db
+            db.execute("delete from books")
+            db.rollback()
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_resumes_after_rollback_when_earlier_rows_are_deleted(self):
+        Book.insert_many([{} for _ in range(3)])
+        ids = []
+        for book in Book.all().stream(batch_size=2):
+            ids.append(book.id)
+            if book.id == 3:
+                Book.find(1).destroy()
+                db = lazy_record.repo.Repo.db
+                db.execute("delete from books")
+                db.rollback()
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 6, 7, 8])
+
+    def test_reads_custom_ordered_query_at_once(self):
+        ids = []
+        for book in Book.all().order_by(id="desc").stream(batch_size=2):
+            ids.append(book.id)
+            db = lazy_record.repo.Repo.db
+            db.execute("delete from books")
+            db.rollback()
+        self.assertEqual(ids, [5, 4, 3, 2, 1])
+
+
+class TestBatches(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.person = Person.create()
+        for _ in range(5):
+            book = Book.create()
+            Lending.create(person_id=self.person.id, book_id=book.id)
+        Book.create()
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_finds_each_record(self):
+        self.assertEqual([book.id for book in Book.all().find_each(2)],
+                         [1, 2, 3, 4, 5, 6])
+
+    def test_batches_respect_query(self):
+        batches = self.person.books.where("id > ?", 1).in_batches(2)
+        self.assertEqual([[book.id for book in batch] for batch in batches],
+                         [[2, 3], [4, 5]])
+
+    def test_batches_respect_limit(self):
+        batches = Book.all().first(3).in_batches(2)
+        self.assertEqual([[book.id for book in batch] for batch in batches],
+                         [[1, 2], [3]])
+
+
+class TestEagerLoading(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.people = [Person.create(), Person.create()]
+        self.books = [Book.create(), Book.create(), Book.create()]
+        for book in self.books[:2]:
+            for person in self.people:
+                Lending.create(person_id=person.id, book_id=book.id)
+        self.thing = Thing.create(book_id=self.books[0].id)
+        self.other_thing = OtherThing.create(thing_id=self.thing.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def without_queries(self):
+        # Associations query through lazy_record.query, which uses this Repo
+        return mock.patch.object(lazy_record.repo.Repo, "db",
+                                 side_effect=AssertionError("queried"))
+
+    def test_loads_has_many(self):
+        books = list(Book.all().includes("lendings"))
+        with self.without_queries() as db:
+            self.assertEqual([len(book.lendings) for book in books],
+                             [2, 2, 0])
+            self.assertEqual([l.book_id for l in books[0].lendings],
+                             [self.books[0].id] * 2)
+        self.assertEqual(db.execute.call_count, 0)
+
+    def test_loads_has_many_through(self):
+        books = list(Book.all().includes("people"))
+        with self.without_queries() as db:
+            self.assertEqual([[p.id for p in book.people] for book in books],
+                             [[1, 2], [1, 2], []])
+        self.assertEqual(db.execute.call_count, 0)
+
+    def test_loads_belongs_to(self):
+        lendings = list(Lending.all().includes("book", "person"))
+        with self.without_queries() as db:
+            self.assertEqual([l.book.id for l in lendings], [1, 1, 2, 2])
+            self.assertEqual([l.person.id for l in lendings], [1, 2, 1, 2])
+        self.assertEqual(db.execute.call_count, 0)
+
+    def test_loads_has_one_and_has_one_through(self):
+        books = list(Book.all().includes("thing", "other_thing"))
+        with self.without_queries() as db:
+            self.assertEqual(books[0].thing, self.thing)
+            self.assertEqual(books[0].other_thing, self.other_thing)
+            self.assertEqual(books[1].thing, None)
+            self.assertEqual(books[1].other_thing, None)
+        self.assertEqual(db.execute.call_count, 0)
+
+    def test_loads_nested_associations(self):
+        person = Person.all().includes("lendings.book").first()
+        with self.without_queries() as db:
+            self.assertEqual([l.book.id for l in person.lendings], [1, 2])
+        self.assertEqual(db.execute.call_count, 0)
+
+    def test_loads_with_one_query_per_association(self):
+        with mock.patch("lazy_record.associations.query.Query._do_query",
+                        autospec=True,
+                        side_effect=lazy_record.query.Query._do_query) as q:
+            list(Book.all().includes("lendings.person"))
+        self.assertEqual(q.call_count, 2)
+
+    def test_refining_preloaded_association_queries(self):
+        book = Book.all().includes("lendings").first()
+        self.assertEqual(len(book.lendings.where(person_id=2)), 1)
+
+    def test_changing_foreign_key_ignores_preloaded_parent(self):
+        lending = Lending.all().includes("book").first()
+        lending.book_id = self.books[2].id
+        self.assertEqual(lending.book, self.books[2])
+
+    def test_raises_for_unknown_association(self):
+        with self.assertRaises(lazy_record.QueryInvalid):
+            list(Book.all().includes("turnips"))
+
+
+class TestBulkInsert(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.book = Book.create()
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_inserts_records_and_returns_ids(self):
+        ids = Thing.insert_many([{"book_id": self.book.id}, {}, {}],
+                                return_ids=True)
+        self.assertEqual(sorted(ids), [t.id for t in Thing.all()])
+        self.assertEqual(Thing.find(ids[0]).book_id, self.book.id)
+        self.assertIsNotNone(Thing.find(ids[1]).created_at)
+
+    def test_creates_many_related_records(self):
+        person = Person.create()
+        lending = Lending.create(person_id=person.id, book_id=self.book.id)
+        lending.lending_tables.create_many([{}, {}])
+        self.assertEqual(len(lending.lending_tables), 2)
+
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestMassUpdates(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.people = [Person.create(), Person.create()]
+        self.books = [Book.create(), Book.create(), Book.create()]
+        Lending.create(person_id=self.people[0].id, book_id=self.books[0].id)
+        Lending.create(person_id=self.people[0].id, book_id=self.books[1].id)
+        Lending.create(person_id=self.people[1].id, book_id=self.books[2].id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_updates_all_records_in_query(self):
+        count = Lending.where(person_id=self.people[0].id).update_all(
+            book_id=self.books[2].id)
+        self.assertEqual(count, 2)
+        self.assertEqual([l.book_id for l in Lending.all()],
+                         [self.books[2].id] * 3)
+
+    def test_deletes_all_records_in_query(self):
+        self.assertEqual(Lending.where("book_id > ?", 1).delete_all(), 2)
+        self.assertEqual([l.id for l in Lending.all()], [1])
+
+    def test_deletes_all_records_through_joins(self):
+        self.assertEqual(self.people[0].books.delete_all(), 2)
+        self.assertEqual([b.id for b in Book.all()], [self.books[2].id])
+        # Only the books are deleted
+        self.assertEqual(len(Lending.all()), 3)
+
+    def test_deletes_records_restricted_by_joined_table(self):
+        self.assertEqual(Person.joins("books").where(
+            books={"id": self.books[2].id}).delete_all(), 1)
+        self.assertEqual([p.id for p in Person.all()], [self.people[0].id])
+
+    def test_updates_all_records_in_association(self):
+        self.assertEqual(self.books[2].lendings.update_all(
+            person_id=self.people[0].id), 1)
+        self.assertEqual(len(self.people[0].books), 3)
+
+
+class TestCascadingDestroy(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db(foreign_keys=True)
+        lazy_record.load_schema(test_schema)
+        self.person = Person.create()
+        self.books = [Book.create(), Book.create()]
+        for book in self.books:
+            lending = Lending.create(person_id=self.person.id,
+                                     book_id=book.id)
+            LendingTable.create(lending_id=lending.id)
+            thing = Thing.create(book_id=book.id)
+            OtherThing.create(thing_id=thing.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_destroys_dependent_tree(self):
+        self.books[0].destroy()
+        self.assertEqual([b.id for b in Book.all()], [self.books[1].id])
+        self.assertEqual([l.book_id for l in Lending.all()],
+                         [self.books[1].id])
+        self.assertEqual(len(LendingTable.all()), 1)
+        self.assertEqual([t.book_id for t in Thing.all()],
+                         [self.books[1].id])
+        self.assertEqual(len(OtherThing.all()), 1)
+        self.assertEqual(len(Person.all()), 1)
+
+    def test_destroy_all_destroys_every_record_in_query(self):
+        self.assertEqual(Book.all().destroy_all(), 2)
+        for model in (Book, Lending, LendingTable, Thing, OtherThing):
+            self.assertEqual(len(model.all()), 0)
+        self.assertEqual(len(Person.all()), 1)
+
+    def test_deletes_one_level_per_statement(self):
+        with mock.patch.object(lazy_record.repo.Repo, "delete",
+                               autospec=True,
+                               side_effect=lazy_record.repo.Repo.delete) as d:
+            Book.all().destroy_all()
+        # Dependents are deleted through lazy_record.repo: lending_tables,
+        # lendings, other_things (through things, then again through the
+        # has_one through), and things
+        self.assertEqual(d.call_count, 5)
+
+    def test_relies_on_database_for_on_delete_cascade(self):
+        manual = Manual.create()
+        Page.create(manual_id=manual.id)
+        with mock.patch.object(lazy_record.repo.Repo, "delete",
+                               autospec=True,
+                               side_effect=lazy_record.repo.Repo.delete) as d:
+            manual.destroy()
+        # No statement was issued for the pages (only for their figures)
+        self.assertEqual([c[0][0].table_name for c in d.call_args_list],
+                         ["figures"])
+        self.assertEqual(len(Page.all()), 0)
+
+    def test_destroys_dependents_below_on_delete_cascade(self):
+        manual = Manual.create()
+        page = Page.create(manual_id=manual.id)
+        Figure.create(page_id=page.id)
+        other_page = Page.create()
+        Figure.create(page_id=other_page.id)
+        manual.destroy()
+        self.assertEqual([p.id for p in Page.all()], [other_page.id])
+        self.assertEqual([f.page_id for f in Figure.all()], [other_page.id])
+
+
+class TestCompactRecords(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.book = Book.create()
+        self.note = Note.create(body="first", book_id=self.book.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_loads_records(self):
+        note = Note.find(self.note.id)
+        self.assertEqual((note.body, note.book, note.created_at),
+                         ("first", self.book, self.note.created_at))
+
+    def test_updates_records(self):
+        note = Note.first()
+        note.body = "second"
+        note.save()
+        self.assertEqual(Note.find(self.note.id).body, "second")
+
+    def test_selects_attributes(self):
+        note = Note.all().select("id").first()
+        with self.assertRaises(lazy_record.MissingAttributeError):
+            note.body
+
+    def test_destroys_records(self):
+        Note.first().destroy()
+        self.assertEqual(len(Note.all()), 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        lazy_record.connect_db(os.path.join(self.directory, "test.db"),
+                               pool_size=2)
+        lazy_record.load_schema(test_schema)
+        lazy_record.release_db()
+
+    def tearDown(self):
+        lazy_record.close_db()
+        shutil.rmtree(self.directory)
+
+    def test_threads_use_their_own_connections(self):
+        errors = []
+
+        def create():
+            try:
+                for _ in range(5):
+                    Book.create()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                lazy_record.release_db()
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(Book.all()), 20)
+        stats = lazy_record.pool_stats()
+        self.assertLessEqual(stats["open"], 2)
+        self.assertEqual(stats["checkouts"], 6)
+
+    def test_reclaims_connections_of_threads_that_did_not_release(self):
+        errors = []
+
+        def create():
+            try:
+                Book.create()
+            except Exception as e:
+                errors.append(e)
+        for _ in range(5):
+            thread = threading.Thread(target=create)
+            thread.start()
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(Book.all()), 5)
+        stats = lazy_record.pool_stats()
+        self.assertEqual(stats["open"], 2)
+        self.assertEqual(stats["timeouts"], 0)
+        self.assertGreaterEqual(stats["reclaimed"], 3)
+
+    def test_applies_profile_to_every_connection(self):
+        lazy_record.connect_db(os.path.join(self.directory, "test.db"),
+                               profile="throughput", synchronous="OFF")
+        settings = []
+
+        def read_settings():
+            db = lazy_record.repo.Repo.db
+            settings.append((
+                db.execute("PRAGMA journal_mode").fetchone()[0],
+                db.execute("PRAGMA synchronous").fetchone()[0]))
+        threads = [threading.Thread(target=read_settings) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(settings, [("wal", 0), ("wal", 0)])
+        self.assertEqual(lazy_record.pool_stats()["open"], 2)
+
+
+class TestQueryEvents(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.events = []
+        lazy_record.on("query", self.events.append)
+
+    def tearDown(self):
+        lazy_record.off("query", self.events.append)
+        lazy_record.close_db()
+
+    def test_reports_statements_with_model(self):
+        Book.create()
+        Book.create()
+        for book in Book.all():
+            pass
+        self.assertEqual([(e.operation, e.model, e.rows)
+                          for e in self.events],
+                         [("insert", Book, 1), ("insert", Book, 1),
+                          ("select", Book, 2)])
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.logger = mock.Mock()
+        self.log = lazy_record.log_slow_queries(threshold=0,
+                                                logger=self.logger)
+
+    def tearDown(self):
+        self.log.stop()
+        lazy_record.close_db()
+
+    def test_explains_slow_statements(self):
+        Book.create()
+        Book.where(id=1).first()
+        Book.all().first()
+        self.assertEqual([entry.event.operation
+                          for entry in self.log.entries],
+                         ["insert", "select", "select"])
+        self.assertEqual([entry.full_scan for entry in self.log.entries],
+                         [False, False, True])
+        self.assertEqual(self.logger.warning.call_count, 3)
+
+
+class TestNPlusOneDetection(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        person = Person.create()
+        for _ in range(3):
+            book = Book.create()
+            Lending.create(book_id=book.id, person_id=person.id)
+            Thing.create(book_id=book.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_detects_associations_loaded_in_loop(self):
+        with lazy_record.detect_n_plus_one(logger=mock.Mock()) as detector:
+            for lending in Lending.all():
+                lending.book
+            for book in Book.all():
+                list(book.lendings)
+                book.thing
+        self.assertEqual(sorted((found.model.__name__, found.association,
+                                 found.count)
+                                for found in detector.found),
+                         [("Book", "lendings", 3), ("Book", "thing", 3),
+                          ("Lending", "book", 3)])
+
+    def test_ignores_preloaded_associations(self):
+        with lazy_record.detect_n_plus_one(strict=True):
+            for book in Book.all().includes("lendings", "thing"):
+                list(book.lendings)
+                book.thing
+
+    def test_ignores_associations_built_in_loop(self):
+        person = Person.first()
+        with lazy_record.detect_n_plus_one(strict=True):
+            for book in Book.all():
+                book.lendings.build(person_id=person.id)
+                book.lendings.where(person_id=person.id)
+
+    def test_detects_associations_counted_in_loop(self):
+        with lazy_record.detect_n_plus_one(logger=mock.Mock()) as detector:
+            for book in Book.all():
+                book.lendings.where(person_id=1).exists()
+                len(book.lendings)
+        self.assertEqual(sorted((found.association, found.count)
+                                for found in detector.found),
+                         [("lendings", 3), ("lendings", 3)])
+
+    def test_strict_mode_raises(self):
+        with self.assertRaises(lazy_record.NPlusOneQuery):
+            with lazy_record.detect_n_plus_one(strict=True):
+                for lending in Lending.all():
+                    lending.book
+
+
+class TestExistence(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.person = Person.create()
+        self.books = [Book.create(), Book.create()]
+        Lending.create(book_id=self.books[0].id, person_id=self.person.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_checks_existence_of_records(self):
+        self.assertTrue(self.books[0].lendings.exists())
+        self.assertFalse(self.books[1].lendings.exists())
+        self.assertTrue(Book.where(id=self.books[1].id))
+        self.assertFalse(Book.where(id=self.books[1].id + 1))
+
+    def test_checks_existence_through_join(self):
+        self.assertTrue(self.person.books)
+        self.assertFalse(Person.create().books)
+
+
+class TestPluck(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.person = Person.create()
+        self.books = [Book.create(), Book.create()]
+        for book in self.books:
+            Lending.create(book_id=book.id, person_id=self.person.id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_plucks_columns(self):
+        self.assertEqual(Book.all().pluck("id"),
+                         [book.id for book in self.books])
+        self.assertEqual(self.person.lendings.pluck("book_id", "person_id"),
+                         [(book.id, self.person.id) for book in self.books])
+
+    def test_plucks_through_join(self):
+        self.assertEqual(sorted(self.person.books.pluck("id")),
+                         [book.id for book in self.books])
+
+    def test_gets_values(self):
+        values = Book.where(id=self.books[0].id).values()
+        self.assertEqual(values, [{"id": self.books[0].id,
+                                   "created_at": self.books[0].created_at,
+                                   "updated_at": self.books[0].updated_at}])
+
+
+class TestAggregates(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.people = [Person.create(), Person.create()]
+        self.books = [Book.create() for _ in range(3)]
+        for person, book in [(0, 0), (0, 1), (0, 1), (1, 2)]:
+            Lending.create(person_id=self.people[person].id,
+                           book_id=self.books[book].id)
+
+    def tearDown(self):
+        lazy_record.close_db()
+
+    def test_aggregates_columns(self):
+        ids = [book.id for book in self.books]
+        self.assertEqual(Lending.all().sum("book_id"),
+                         ids[0] + 2 * ids[1] + ids[2])
+        self.assertEqual(Book.all().average("id"), sum(ids) / 3.0)
+        self.assertEqual(Book.all().minimum("id"), min(ids))
+        self.assertEqual(Book.all().maximum("id"), max(ids))
+
+    def test_counts(self):
+        self.assertEqual(Lending.all().count(), 4)
+        self.assertEqual(Lending.all().count("book_id", distinct=True), 3)
+        self.assertEqual(self.people[0].lendings.count(), 3)
+
+    def test_aggregates_groups(self):
+        self.assertEqual(Lending.all().group("person_id").count(),
+                         {self.people[0].id: 3, self.people[1].id: 1})
+        self.assertEqual(
+            Lending.all().group("person_id").having("count(*) > ?", 1)
+            .count("book_id", distinct=True), {self.people[0].id: 2})
+
+    def test_aggregates_through_join(self):
+        self.assertEqual(self.people[0].books.count("id", distinct=True), 2)
+
+    def test_aggregates_nothing(self):
+        self.assertIsNone(Book.where(id=0).sum("id"))
+        self.assertEqual(Book.where(id=0).group("id").count(), {})
+
+
+class TestIdentityMap(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.person = Person.create()
+        self.book = Book.create()
+        for _ in range(3):
+            Lending.create(person_id=self.person.id, book_id=self.book.id)
+        self.statements = []
+        lazy_record.on("query", self.statements.append)
+
+    def tearDown(self):
+        lazy_record.off("query", self.statements.append)
+        lazy_record.close_db()
+
+    def test_loads_each_record_once(self):
+        with lazy_record.identity_map():
+            book = Book.find(self.book.id)
+            books = [lending.book for lending in Lending.all()]
+            self.assertTrue(all(other is book for other in books))
+            self.assertIs(Book.first(), book)
+            self.assertIs(next(iter(self.person.books)), book)
+        # The book was found once, and no query was run for lending.book
+        self.assertEqual(len([s for s in self.statements
+                              if s.model is Book]), 3)
+
+    def test_finds_records_without_query(self):
+        with lazy_record.identity_map():
+            book = Book.find(self.book.id)
+            del self.statements[:]
+            self.assertIs(Book.find(self.book.id), book)
+        self.assertEqual(self.statements, [])
+
+    def test_maps_saved_records(self):
+        with lazy_record.identity_map():
+            book = Book.create()
+            self.assertIs(Book.find(book.id), book)
+
+    def test_forgets_deleted_records(self):
+        with lazy_record.identity_map():
+            book = Book.find(self.book.id)
+            book.delete()
+            with self.assertRaises(lazy_record.RecordNotFound):
+                Book.find(self.book.id)
+
+    def test_forgets_records_written_in_bulk(self):
+        with lazy_record.identity_map():
+            lending = Lending.first()
+            Lending.all().update_all(book_id=self.book.id + 1)
+            self.assertIsNot(Lending.first(), lending)
+            self.assertEqual(Lending.first().book_id, self.book.id + 1)
+
+    def test_maps_compact_records(self):
+        with lazy_record.identity_map():
+            note = Note.create(body="first", book_id=self.book.id)
+            self.assertIs(Note.find(note.id), note)
+            self.assertIs(Note.first(), note)
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        lazy_record.connect_db()
+        lazy_record.load_schema(test_schema)
+        self.statements = []
+        lazy_record.on("query", self.statements.append)
+
+    def tearDown(self):
+        lazy_record.off("query", self.statements.append)
+        lazy_record.close_db()
+
+    def test_inserts_parents_before_children(self):
+        with lazy_record.session():
+            lendings = []
+            for _ in range(3):
+                lending = Lending(person=Person(), book=Book())
+                lending.save()
+                lendings.append(lending)
+            self.assertTrue(all(lending.id is None for lending in lendings))
+        self.assertEqual(Lending.count(), 3)
+        for lending in lendings:
+            self.assertEqual(Lending.find(lending.id).book_id,
+                             lending.book_id)
+            self.assertEqual(lending.person.id, lending.person_id)
+
+    def test_inserts_each_model_at_once(self):
+        with lazy_record.session():
+            for _ in range(5):
+                Book().save()
+        inserts = [s for s in self.statements if s.operation == "insert"]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(inserts[0].params), 5)
+
+    def test_saves_records_built_through_associations(self):
+        book = Book.create()
+        with lazy_record.session():
+            person = Person()
+            person.books.append(book)
+            person.save()
+        self.assertEqual([b.id for b in person.books], [book.id])
+
+    def test_updates_changed_records_together(self):
+        books = [Book.create() for _ in range(3)]
+        person = Person.create()
+        lendings = [Lending.create(person_id=person.id, book_id=books[0].id)
+                    for _ in range(3)]
+        del self.statements[:]
+        with lazy_record.session():
+            for lending, book in zip(lendings, books):
+                lending.book_id = book.id
+                lending.save()
+        updates = [s for s in self.statements if s.operation == "update"]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(sorted(l.book_id for l in Lending.all()),
+                         sorted(b.id for b in books))
+
+    def test_destroys_records_when_flushed(self):
+        book = Book.create()
+        with lazy_record.session():
+            book.destroy()
+            self.assertEqual(Book.count(), 1)
+        self.assertEqual(Book.count(), 0)
+
+    def test_deletes_records_without_dependents_when_flushed(self):
+        book = Book.create()
+        Lending.create(book_id=book.id, person_id=Person.create().id)
+        with lazy_record.session():
+            book.delete()
+            self.assertEqual(Book.count(), 1)
+        self.assertEqual(Book.count(), 0)
+        self.assertEqual(Lending.count(), 1)
+
+    def test_links_saved_records_to_new_ones(self):
+        thing = Thing.create()
+        with lazy_record.session():
+            book = Book()
+            book.save()
+            thing.book = book
+            thing.save()
+        self.assertIsNotNone(book.id)
+        self.assertEqual(Thing.find(thing.id).book_id, book.id)
+
+    def test_links_saved_children_appended_to_new_parents(self):
+        lending = Lending.create(book_id=Book.create().id,
+                                 person_id=Person.create().id)
+        with lazy_record.session():
+            book = Book()
+            book.lendings.append(lending)
+            book.save()
+        self.assertEqual(Lending.find(lending.id).book_id, book.id)
+
+    def test_links_saved_children_assigned_to_new_parents(self):
+        thing = Thing.create()
+        with lazy_record.session():
+            book = Book()
+            book.thing = thing
+            book.save()
+        self.assertEqual(Thing.find(thing.id).book_id, book.id)
+
+    def test_discards_records_on_error(self):
+        book = Book()
+        with self.assertRaises(ValueError):
+            with lazy_record.session():
+                book.save()
+                raise ValueError
+        self.assertIsNone(book.id)
+        self.assertEqual(Book.count(), 0)
+
+    def test_writes_nothing_when_flush_fails(self):
+        book = Book()
+        with self.assertRaises(sqlite3.IntegrityError):
+            with lazy_record.session():
+                book.save()
+                Lending().save()
+        self.assertIsNone(book.id)
+        self.assertEqual(Book.count(), 0)
+
+
+class TestTransactions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.db")
+        lazy_record.connect_db(self.path)
+        lazy_record.load_schema(test_schema)
+
+    def tearDown(self):
+        lazy_record.close_db()
+        shutil.rmtree(self.directory)
+
+    def books_seen_by_others(self):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(
+                "select count(*) from books").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_saves_join_transaction(self):
+        with lazy_record.transaction():
+            Book.create()
+            Book.create().destroy()
+            Book.create()
+            self.assertEqual(self.books_seen_by_others(), 0)
+            self.assertEqual(Book.count(), 2)
+        self.assertEqual(self.books_seen_by_others(), 2)
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with lazy_record.transaction("IMMEDIATE"):
+                Book.create()
+                raise ValueError
+        self.assertEqual(Book.count(), 0)
+
+    def test_savepoint_rolls_back_alone(self):
+        with lazy_record.transaction():
+            Book.create()
+            with self.assertRaises(ValueError):
+                with lazy_record.transaction():
+                    Book.create()
+                    raise ValueError
+            Book.create()
+        self.assertEqual(Book.count(), 2)
+
+    def test_failed_save_does_not_abort_transaction(self):
+        person = Person.create()
+        with lazy_record.transaction():
+            Book.create()
+            with self.assertRaises(sqlite3.IntegrityError):
+                Lending.create(person_id=person.id)
+        self.assertEqual(Book.count(), 1)
+        self.assertEqual(Lending.count(), 0)
+
+    def test_exclusive_transaction_locks_out_writers(self):
+        with lazy_record.transaction("EXCLUSIVE"):
+            connection = sqlite3.connect(self.path, timeout=0)
+            try:
+                with self.assertRaises(sqlite3.OperationalError):
+                    connection.execute("insert into books (created_at, "
+                                       "updated_at) values (0, 0)")
+            finally:
+                connection.close()
+
+
+class TestLockRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.db")
+        lazy_record.connect_db(self.path, busy_timeout=10,
+                               retry_policy=lazy_record.RetryPolicy(
+                                   attempts=100, base_delay=0.01,
+                                   max_delay=0.02))
+        lazy_record.load_schema(test_schema)
+        self.other = sqlite3.connect(self.path, isolation_level=None,
+                                     check_same_thread=False)
+
+    def tearDown(self):
+        self.other.close()
+        lazy_record.close_db()
+        shutil.rmtree(self.directory)
+
+    def test_retries_writes_while_database_is_locked(self):
+        self.other.execute("BEGIN IMMEDIATE")
+        unlock = threading.Timer(0.2, lambda: self.other.execute("COMMIT"))
+        unlock.start()
+        try:
+            Book.create()
+        finally:
+            unlock.join()
+        self.assertEqual(Book.count(), 1)
+        stats = lazy_record.retry_stats()
+        self.assertGreater(stats["retries"], 0)
+        self.assertGreater(stats["lock_wait"], 0)
+
+    def test_gives_up_eventually(self):
+        lazy_record.connect_db(self.path, busy_timeout=1,
+                               retry_policy=lazy_record.RetryPolicy(
+                                   attempts=2, base_delay=0.001))
+        self.other.execute("BEGIN IMMEDIATE")
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                Book.create()
+        finally:
+            self.other.execute("ROLLBACK")
+        self.assertEqual(lazy_record.retry_stats()["failures"], 1)
+
+
+class TestReadConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.db")
+        lazy_record.connect_db(self.path, readers=2)
+        lazy_record.load_schema(test_schema)
+
+    def tearDown(self):
+        lazy_record.close_db()
+        shutil.rmtree(self.directory)
+
+    def test_reads_on_read_only_connections(self):
+        book = Book.create()
+        self.assertEqual([b.id for b in Book.all()], [book.id])
+        self.assertEqual(Book.count(), 1)
+        stats = lazy_record.pool_stats()
+        self.assertEqual(stats["readers"]["open"], 1)
+
+    def test_read_only_connections_refuse_writes(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            lazy_record.repo.Repo.read_db.execute(
+                "delete from books")
+
+    def test_uses_write_ahead_logging(self):
+        db = lazy_record.repo.Repo.db
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0],
+                         "wal")
+
+    def test_refuses_other_journal_modes(self):
+        with self.assertRaises(ValueError):
+            lazy_record.connect_db(self.path, journal_mode="DELETE",
+                                   readers=2)
+        with self.assertRaises(ValueError):
+            lazy_record.connect_db(self.path, profile="bulk_load",
+                                   readers=2)
+
+    def test_saves_while_iterating(self):
+        lazy_record.connect_db(self.path, readers=2, busy_timeout=200)
+        Book.create_many([{} for _ in range(600)])
+        for book in Book.all():
+            book.save()
+            Thing.create(book_id=book.id)
+        self.assertEqual(Thing.count(), 600)
+
+    def test_reads_on_writer_within_transaction(self):
+        with lazy_record.transaction():
+            Book.create()
+            self.assertEqual(Book.count(), 1)
+        self.assertEqual(Book.count(), 1)
+
+    def test_reads_from_replica(self):
+        replica = os.path.join(self.directory, "replica.db")
+        connection = sqlite3.connect(replica)
+        connection.executescript(test_schema)
+        connection.close()
+        lazy_record.connect_db(self.path, replica=replica)
+        Book.create()
+        self.assertEqual(Book.count(), 0)
+        with lazy_record.transaction():
+            self.assertEqual(Book.count(), 1)
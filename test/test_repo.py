@@ -21,12 +21,12 @@ class TestRepo(unittest.TestCase):
         table_name = Repo.table_name(TunaCasserole)
         self.assertEqual("tuna_casseroles", table_name)
 
-    @mock.patch("repo.sqlite3")
-    def test_connects_database(self, sqlite3, db):
-        repo.Repo.connect_db("my_db")
-        sqlite3.connect.assert_called_with("my_db",
-            detect_types=sqlite3.PARSE_DECLTYPES)
-        self.assertEqual(repo.Repo.db, sqlite3.connect.return_value)
+    @mock.patch("repo.pool.Pool")
+    def test_connects_database(self, Pool, db):
+        repo.Repo.connect_db("my_db", pool_size=3)
+        Pool.assert_called_with("my_db", size=3, timeout=30.0,
+                                statements=(), options={})
+        self.assertEqual(repo.Repo.db, Pool.return_value)
 
     def test_makes_query_for_all_records(self, db):
         Repo("tuna_casseroles").select("id", "created_at")
@@ -151,6 +151,54 @@ class TestRepo(unittest.TestCase):
         self.assertEqual(db.execute.call_count, 0,
             "expected not to execute db command, but did.")
 
+    def test_inserts_many_records_with_executemany(self, db):
+        Repo("tuna_casseroles").insert_many([{"my_attr": 7}, {"my_attr": 8}])
+        db.executemany.assert_called_once_with(
+            "insert into tuna_casseroles (my_attr) values (?)", [[7], [8]])
+
+    def test_insert_many_groups_rows_by_columns(self, db):
+        Repo("tuna_casseroles").insert_many([{"my_attr": 7},
+                                             {"my_attr": 8, "name": "a"},
+                                             {"my_attr": 9}])
+        db.executemany.assert_any_call(
+            "insert into tuna_casseroles (my_attr) values (?)", [[7], [9]])
+        db.executemany.assert_any_call(
+            "insert into tuna_casseroles (my_attr, name) values (?, ?)",
+            [[8, "a"]])
+
+    def test_insert_many_executes_in_chunks(self, db):
+        Repo("tuna_casseroles").insert_many([{"my_attr": i}
+                                             for i in range(5)],
+                                            chunk_size=2)
+        self.assertEqual(db.executemany.call_args_list, [
+            mock.call("insert into tuna_casseroles (my_attr) values (?)",
+                      [[0], [1]]),
+            mock.call("insert into tuna_casseroles (my_attr) values (?)",
+                      [[2], [3]]),
+            mock.call("insert into tuna_casseroles (my_attr) values (?)",
+                      [[4]]),
+        ])
+
+    def test_insert_many_returns_ids_in_order(self, db):
+        db.execute.return_value.fetchone.return_value = (12,)
+        ids = Repo("tuna_casseroles").insert_many([{"my_attr": 7},
+                                                   {"my_attr": 9}],
+                                                  return_ids=True)
+        db.execute.assert_called_with("select last_insert_rowid()")
+        self.assertEqual(ids, [11, 12])
+
+    def test_does_not_insert_many_records_with_where(self, db):
+        with self.assertRaises(repo.Invalid):
+            Repo("tuna_casseroles").where(x=5).insert_many([{"my_attr": 7}])
+        self.assertEqual(db.executemany.call_count, 0)
+
+    def test_update_many_matches_rows_by_id(self, db):
+        Repo("tuna_casseroles").update_many(["my_attr", "name"],
+                                            [[7, "a", 1], [8, "b", 2]])
+        db.executemany.assert_called_once_with(
+            "update tuna_casseroles set my_attr = ?, name = ? "
+            "where tuna_casseroles.id == ?", [[7, "a", 1], [8, "b", 2]])
+
     def test_updates_records(self, db):
         Repo("tuna_casseroles").update(my_attr=7)
         db.execute.assert_called_once_with(
@@ -172,6 +220,25 @@ class TestRepo(unittest.TestCase):
         db.execute.assert_called_once_with(
             "delete from tuna_casseroles where tuna_casseroles.id == ?", [11])
 
+    def test_update_returns_number_of_records_updated(self, db):
+        db.execute.return_value.rowcount = 3
+        self.assertEqual(Repo("tuna_casseroles").update(my_attr=7), 3)
+
+    def test_delete_returns_number_of_records_deleted(self, db):
+        db.execute.return_value.rowcount = 2
+        self.assertEqual(Repo("tuna_casseroles").delete(), 2)
+
+    def test_where_with_repo_uses_subquery(self, db):
+        subquery = Repo("tuna_casseroles").inner_join(
+            {'table': 'my_relations', 'on': ['tuna_casserole_id', 'id']}
+            ).where(my_relations={"name": "foo"})
+        Repo("tuna_casseroles").where(id=subquery).delete()
+        db.execute.assert_called_once_with(
+            "delete from tuna_casseroles where tuna_casseroles.id IN "
+            "(select tuna_casseroles.id from tuna_casseroles "
+            "inner join my_relations on my_relations.tuna_casserole_id == "
+            "tuna_casseroles.id where my_relations.name == ?)", ["foo"])
+
     def test_orders_records(self, db):
         Repo("tuna_casseroles").order_by(id="desc").select("id", "created_at")
         db.execute.assert_called_once_with(
@@ -238,10 +305,146 @@ class TestRepo(unittest.TestCase):
             "LIMIT ?", [87, 10]
         )
 
+    def test_aggregates_column(self, db):
+        Repo("tuna_casseroles").where(my_attr=5).aggregate("sum", "price")
+        db.execute.assert_called_once_with(
+            "select sum(tuna_casseroles.price) from tuna_casseroles "
+            "where tuna_casseroles.my_attr == ?", [5])
+
+    def test_aggregates_distinct_values(self, db):
+        Repo("tuna_casseroles").aggregate("count", "name", distinct=True)
+        db.execute.assert_called_once_with(
+            "select count(DISTINCT tuna_casseroles.name) "
+            "from tuna_casseroles", [])
+
+    def test_aggregates_expressions(self, db):
+        Repo("tuna_casseroles").aggregate("count", "*")
+        db.execute.assert_called_once_with(
+            "select count(*) from tuna_casseroles", [])
+
+    def test_aggregates_groups(self, db):
+        Repo("tuna_casseroles").group_by("name").having(
+            [("count(*) > ?", 2)]).aggregate("avg", "price")
+        db.execute.assert_called_once_with(
+            "select name, avg(tuna_casseroles.price) from tuna_casseroles "
+            "GROUP BY name HAVING count(*) > ?", [2])
+
+    def test_exists_selects_one_row(self, db):
+        db.execute.return_value.fetchone.return_value = (1,)
+        self.assertTrue(Repo("tuna_casseroles").where(my_attr=5).exists())
+        db.execute.assert_called_once_with(
+            "select 1 from tuna_casseroles "
+            "where tuna_casseroles.my_attr == ? LIMIT 1", [5])
+
+    def test_exists_is_false_without_rows(self, db):
+        db.execute.return_value.fetchone.return_value = None
+        self.assertFalse(Repo("tuna_casseroles").exists())
+
     def test_limit_errors_if_limit_is_zero(self, db):
         with self.assertRaises(repo.Invalid):
             Repo("tuna_casseroles").where(id=87
                                   ).limit(0).select("*")
 
+
+@mock.patch("repo.Repo.db")
+class TestStatementCaching(unittest.TestCase):
+
+    def setUp(self):
+        repo.statements.cache.clear()
+
+    def test_reuses_statement_for_same_shape(self, db):
+        Repo("tuna_casseroles").where(my_attr=5).select("*")
+        Repo("tuna_casseroles").where(my_attr=6).select("*")
+        self.assertEqual(repo.statements.cache.stats()["hits"], 1)
+        self.assertEqual(repo.statements.cache.stats()["misses"], 1)
+        db.execute.assert_called_with(
+            "select tuna_casseroles.* from tuna_casseroles "
+            "where tuna_casseroles.my_attr == ?", [6])
+
+    def test_compiles_statement_for_new_shape(self, db):
+        Repo("tuna_casseroles").where(my_attr=5).select("*")
+        Repo("tuna_casseroles").where(name="foo").select("*")
+        Repo("tuna_casseroles").where(name=["a", "b"]).select("*")
+        self.assertEqual(repo.statements.cache.stats()["misses"], 3)
+        db.execute.assert_called_with(
+            "select tuna_casseroles.* from tuna_casseroles "
+            "where tuna_casseroles.name IN (?, ?)", ["a", "b"])
+
+    def test_distinguishes_number_of_in_values(self, db):
+        Repo("tuna_casseroles").where(name=["a", "b"]).delete()
+        Repo("tuna_casseroles").where(name=["a", "b", "c"]).delete()
+        db.execute.assert_called_with(
+            "delete from tuna_casseroles "
+            "where tuna_casseroles.name IN (?, ?, ?)", ["a", "b", "c"])
+
+    def test_caches_update_by_columns(self, db):
+        Repo("tuna_casseroles").where(id=1).update(my_attr=5)
+        Repo("tuna_casseroles").where(id=2).update(my_attr=6)
+        self.assertEqual(repo.statements.cache.stats()["hits"], 1)
+        db.execute.assert_called_with(
+            "update tuna_casseroles set my_attr = ? "
+            "where tuna_casseroles.id == ?", [6, 2])
+
+    def test_caches_inserts(self, db):
+        Repo("tuna_casseroles").insert(my_attr=5)
+        Repo("tuna_casseroles").insert(my_attr=6)
+        self.assertEqual(repo.statements.cache.stats()["hits"], 1)
+
+    def test_caches_statements_with_subqueries(self, db):
+        for value in (1, 2):
+            subquery = Repo("tuna_casseroles").where(my_attr=value)
+            Repo("tuna_casseroles").where(id=subquery).delete()
+        self.assertEqual(repo.statements.cache.stats()["hits"], 1)
+        db.execute.assert_called_with(
+            "delete from tuna_casseroles where tuna_casseroles.id IN "
+            "(select tuna_casseroles.id from tuna_casseroles "
+            "where tuna_casseroles.my_attr == ?)", [2])
+
+
+@mock.patch("repo.Repo.read_db")
+@mock.patch("repo.Repo.db")
+class TestReadConnections(unittest.TestCase):
+
+    def test_reads_on_read_only_pool(self, db, read_db):
+        db.writing.return_value = False
+        Repo("tuna_casseroles").select("id")
+        Repo("tuna_casseroles").count()
+        self.assertEqual(read_db.execute.call_count, 2)
+        self.assertFalse(db.execute.called)
+
+    def test_writes_on_writer(self, db, read_db):
+        db.writing.return_value = False
+        Repo("tuna_casseroles").insert(my_attr=5)
+        Repo("tuna_casseroles").where(id=1).delete()
+        self.assertEqual(db.execute.call_count, 2)
+        self.assertFalse(read_db.execute.called)
+
+    def test_reads_on_writer_while_writing(self, db, read_db):
+        db.writing.return_value = True
+        Repo("tuna_casseroles").select("id")
+        self.assertEqual(db.execute.call_count, 1)
+        self.assertFalse(read_db.execute.called)
+
+    def test_reads_inserted_ids_on_writer(self, db, read_db):
+        db.writing.return_value = False
+        db.execute.return_value.fetchone.return_value = (2,)
+        Repo("tuna_casseroles").insert_many([{"my_attr": 5}],
+                                            return_ids=True)
+        db.execute.assert_called_with("select last_insert_rowid()")
+        self.assertFalse(read_db.execute.called)
+
+    @mock.patch("repo.pool.Pool")
+    def test_connects_read_only_pool(self, Pool, db, read_db):
+        repo.Repo.connect_db("my_db", statements=["PRAGMA a = 1"],
+                             readers=4, replica="replica_db")
+        Pool.assert_called_with("replica_db", size=4, timeout=30.0,
+                                options={}, statements=[
+                                    "PRAGMA a = 1", "PRAGMA query_only = ON"])
+        self.assertEqual(repo.Repo.read_db, Pool.return_value)
+
+    def test_in_memory_database_cannot_have_readers(self, db, read_db):
+        with self.assertRaises(ValueError):
+            repo.Repo.connect_db(":memory:", readers=2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import mock
+import sqlite3
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.retry as retry
+
+
+def locked():
+    return sqlite3.OperationalError("database is locked")
+
+
+@mock.patch("lazy_record.retry.time.sleep")
+@mock.patch("lazy_record.repo.Repo.db")
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = retry.RetryPolicy(attempts=3, base_delay=0.1,
+                                        max_delay=0.15)
+
+    def test_retries_until_write_succeeds(self, db, sleep):
+        db.in_transaction.return_value = False
+        write = mock.Mock(side_effect=[locked(), locked(), 7])
+        self.assertEqual(self.policy.call(write, 1, a=2), 7)
+        self.assertEqual(write.call_args_list, [mock.call(1, a=2)] * 3)
+        self.assertEqual(db.rollback.call_count, 2)
+        self.assertEqual(sleep.call_count, 2)
+        stats = self.policy.stats()
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["failures"], 0)
+        self.assertGreaterEqual(stats["lock_wait"],
+                                sum(c[0][0] for c in sleep.call_args_list))
+
+    def test_gives_up_after_last_attempt(self, db, sleep):
+        db.in_transaction.return_value = False
+        write = mock.Mock(side_effect=locked())
+        with self.assertRaises(sqlite3.OperationalError):
+            self.policy.call(write)
+        self.assertEqual(write.call_count, 3)
+        self.assertEqual(self.policy.stats()["failures"], 1)
+
+    def test_does_not_retry_other_errors(self, db, sleep):
+        write = mock.Mock(side_effect=sqlite3.OperationalError("no table"))
+        with self.assertRaises(sqlite3.OperationalError):
+            self.policy.call(write)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self.policy.stats()["failures"], 0)
+
+    def test_does_not_retry_within_transaction(self, db, sleep):
+        db.in_transaction.return_value = True
+        write = mock.Mock(side_effect=locked())
+        with self.assertRaises(sqlite3.OperationalError):
+            self.policy.call(write)
+        self.assertEqual(write.call_count, 1)
+        self.assertFalse(db.rollback.called)
+
+    def test_retries_outermost_write_only(self, db, sleep):
+        db.in_transaction.return_value = False
+        inner = mock.Mock(side_effect=[locked(), None])
+        self.policy.call(lambda: self.policy.call(inner))
+        self.assertEqual(inner.call_count, 2)
+        self.assertEqual(self.policy.stats()["retries"], 1)
+
+    def test_delay_is_jittered_and_bounded(self, db, sleep):
+        delays = [self.policy.delay(attempt) for attempt in range(5)
+                  for _ in range(20)]
+        self.assertTrue(all(0 <= delay <= 0.15 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+
+class TestIsBusy(unittest.TestCase):
+
+    def test_recognizes_lock_errors(self):
+        self.assertTrue(retry.is_busy(locked()))
+        self.assertFalse(retry.is_busy(sqlite3.OperationalError("no table")))
+        self.assertFalse(retry.is_busy(ValueError("database is locked")))
@@ -0,0 +1,84 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.slow_queries as slow_queries
+from lazy_record.events import QueryEvent
+
+
+def event(duration, operation="select", sql="select books.* from books",
+          params=[]):
+    return QueryEvent(operation, "books", sql, params, duration, 0)
+
+
+@mock.patch("lazy_record.slow_queries.explain")
+class TestSlowQueryLog(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock()
+        self.log = slow_queries.SlowQueryLog(threshold=0.5, limit=2,
+                                             interval=60, logger=self.logger)
+
+    def test_ignores_fast_statements(self, explain):
+        self.log(event(0.1))
+        self.assertEqual(self.logger.warning.call_count, 0)
+        self.assertEqual(explain.call_count, 0)
+
+    def test_logs_slow_statements_with_plan(self, explain):
+        explain.return_value = ["SEARCH books USING INDEX b (x=?)"]
+        self.log(event(0.6))
+        message = self.logger.warning.call_args[0][0]
+        self.assertIn("select books.* from books", message)
+        self.assertIn("plan: SEARCH books USING INDEX b (x=?)", message)
+        self.assertNotIn("FULL SCAN", message)
+        self.assertFalse(self.log.entries[-1].full_scan)
+
+    def test_flags_full_scans(self, explain):
+        explain.return_value = ["SCAN books"]
+        self.log(event(0.6))
+        self.assertIn("FULL SCAN", self.logger.warning.call_args[0][0])
+        self.assertTrue(self.log.entries[-1].full_scan)
+
+    def test_leaves_out_params_by_default(self, explain):
+        explain.return_value = []
+        self.log(event(0.6, params=["secret"]))
+        self.assertNotIn("secret", self.logger.warning.call_args[0][0])
+
+    def test_rate_limits_log(self, explain):
+        explain.return_value = []
+        for _ in range(5):
+            self.log(event(0.6))
+        self.assertEqual(self.logger.warning.call_count, 2)
+        self.assertEqual(explain.call_count, 2)
+        self.assertEqual(self.log.suppressed, 3)
+
+    @mock.patch("lazy_record.slow_queries.time")
+    def test_reports_suppressed_statements_in_next_interval(self, time,
+                                                            explain):
+        explain.return_value = []
+        time.time.return_value = 0
+        for _ in range(3):
+            self.log(event(0.6))
+        time.time.return_value = 61
+        self.log(event(0.6))
+        self.assertIn("1 slow statements were not logged",
+                      self.logger.warning.call_args[0][0])
+        self.assertEqual(self.log.suppressed, 0)
+
+
+class TestFullScans(unittest.TestCase):
+
+    def test_detects_table_scans(self):
+        self.assertTrue(slow_queries.is_full_scan("SCAN books"))
+        self.assertTrue(slow_queries.is_full_scan("SCAN TABLE books"))
+
+    def test_ignores_index_scans(self):
+        self.assertFalse(slow_queries.is_full_scan(
+            "SCAN books USING COVERING INDEX books_x"))
+        self.assertFalse(slow_queries.is_full_scan(
+            "SEARCH books USING INTEGER PRIMARY KEY (rowid=?)"))
+        self.assertFalse(slow_queries.is_full_scan("SCAN CONSTANT ROW"))
+
+if __name__ == '__main__':
+    unittest.main()
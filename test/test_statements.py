@@ -0,0 +1,51 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from lazy_record.statements import StatementCache
+
+
+class TestStatementCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = StatementCache(size=2)
+
+    def test_compiles_missing_statements(self):
+        compile = mock.Mock(return_value="select 1")
+        self.assertEqual(self.cache.get("a", compile), "select 1")
+        compile.assert_called_once_with()
+
+    def test_returns_cached_statements(self):
+        self.cache.get("a", lambda: "select 1")
+        compile = mock.Mock()
+        self.assertEqual(self.cache.get("a", compile), "select 1")
+        self.assertEqual(compile.call_count, 0)
+
+    def test_counts_hits_and_misses(self):
+        self.cache.get("a", lambda: "select 1")
+        self.cache.get("a", lambda: "select 1")
+        self.cache.get("b", lambda: "select 2")
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 2,
+                                              "size": 2, "max_size": 2})
+
+    def test_evicts_least_recently_used(self):
+        self.cache.get("a", lambda: "select 1")
+        self.cache.get("b", lambda: "select 2")
+        self.cache.get("a", lambda: "select 1")
+        self.cache.get("c", lambda: "select 3")
+        self.assertEqual(list(self.cache.statements), ["a", "c"])
+
+    def test_caches_nothing_with_size_zero(self):
+        cache = StatementCache(size=0)
+        cache.get("a", lambda: "select 1")
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_clear_resets_counters(self):
+        self.cache.get("a", lambda: "select 1")
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 0,
+                                              "size": 0, "max_size": 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import sys
+import os
+import threading
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from lazy_record.thread_stack import ThreadStack
+
+
+class TestThreadStack(unittest.TestCase):
+
+    def setUp(self):
+        self.stack = ThreadStack()
+
+    def in_thread(self, function):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_current_is_most_recently_pushed(self):
+        self.assertIsNone(self.stack.current())
+        first, second = object(), object()
+        self.stack.push(first)
+        self.stack.push(second)
+        self.assertIs(self.stack.current(), second)
+        self.stack.remove(second)
+        self.assertIs(self.stack.current(), first)
+
+    def test_pushes_items_once(self):
+        item = object()
+        self.stack.push(item)
+        self.stack.push(item)
+        self.assertEqual(list(self.stack.items()), [item])
+        self.assertEqual(self.stack.active, 1)
+        self.stack.remove(item)
+        self.stack.remove(item)
+        self.assertEqual(self.stack.active, 0)
+
+    def test_items_belong_to_their_thread(self):
+        self.stack.push(object())
+        self.assertEqual(self.in_thread(self.stack.items), ())
+        self.assertIsNone(self.in_thread(self.stack.current))
+        self.assertEqual(self.stack.active, 1)
+
+if __name__ == '__main__':
+    unittest.main()
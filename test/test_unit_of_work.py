@@ -0,0 +1,151 @@
+import unittest
+import mock
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+import lazy_record.unit_of_work as unit_of_work
+
+
+class Record(object):
+
+    def __init__(self, id=None):
+        self.id = id
+        self._related_records = []
+        self._delete_related_records = []
+
+
+class Author(object):
+    __attributes__ = {}
+
+
+class Post(object):
+    __attributes__ = {"author_id": int, "comment_id": int}
+
+
+class Comment(object):
+    __attributes__ = {"author_id": int, "post_id": int}
+
+
+@mock.patch("lazy_record.associations.model_from_name")
+@mock.patch("lazy_record.associations.foreign_keys_for")
+class TestDependencyOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.models = {"author": Author, "post": Post, "comment": Comment}
+
+    def test_orders_parents_first(self, foreign_keys_for, model_from_name):
+        model_from_name.side_effect = self.models.__getitem__
+        foreign_keys_for.side_effect = lambda model: {
+            Comment: {"post": "post_id", "author": "author_id"},
+            Post: {"author": "author_id"},
+            Author: {},
+        }[model]
+        self.assertEqual(unit_of_work.dependency_order([Comment, Post,
+                                                        Author]),
+                         [Author, Post, Comment])
+
+    def test_ignores_children(self, foreign_keys_for, model_from_name):
+        model_from_name.side_effect = self.models.__getitem__
+        foreign_keys_for.side_effect = lambda model: {
+            Comment: {"post": "post_id"},
+            Post: {"comments": "post_id"},
+        }[model]
+        self.assertEqual(unit_of_work.dependency_order([Comment, Post]),
+                         [Post, Comment])
+
+    def test_ignores_models_not_given(self, foreign_keys_for,
+                                      model_from_name):
+        model_from_name.side_effect = self.models.__getitem__
+        foreign_keys_for.side_effect = lambda model: {
+            Comment: {"post": "post_id"},
+            Author: {},
+        }[model]
+        self.assertEqual(unit_of_work.dependency_order([Comment, Author]),
+                         [Comment, Author])
+
+    def test_orders_linked_parents_first(self, foreign_keys_for,
+                                         model_from_name):
+        foreign_keys_for.return_value = {}
+        self.assertEqual(unit_of_work.dependency_order(
+            [Comment, Post], [(Comment, Post)]), [Post, Comment])
+
+    def test_keeps_cycles_in_order(self, foreign_keys_for, model_from_name):
+        model_from_name.side_effect = self.models.__getitem__
+        foreign_keys_for.side_effect = lambda model: {
+            Comment: {"post": "post_id"},
+            Post: {"comment": "comment_id"},
+        }[model]
+        self.assertEqual(unit_of_work.dependency_order([Post, Comment]),
+                         [Post, Comment])
+
+
+class TestSession(unittest.TestCase):
+
+    def test_adds_new_and_changed_records(self):
+        session = unit_of_work.Session()
+        new, saved = Record(), Record(1)
+        session.add(new)
+        session.add(saved)
+        session.add(new)
+        self.assertEqual(session.new, [new])
+        self.assertEqual(session.dirty, [saved])
+
+    @mock.patch("lazy_record.associations.foreign_keys_for")
+    def test_links_new_related_records(self, foreign_keys_for):
+        foreign_keys_for.return_value = {"post": "post_id"}
+        session = unit_of_work.Session()
+        post, comment = Record(), Record()
+        post.__class__ = type("Post", (Record,), {})
+        post.__class__.__metadata__ = mock.Mock(singular_name="post")
+        post._related_records.append(comment)
+        session.add(post)
+        self.assertEqual(session.new, [post, comment])
+        self.assertEqual(session.links, [(comment, "post_id", post)])
+
+    def test_deletes_saved_records(self):
+        session = unit_of_work.Session()
+        record = Record(1)
+        session.delete(record)
+        session.delete(record)
+        self.assertEqual(session.deleted, [record])
+
+    def test_deletes_records_without_dependents(self):
+        session = unit_of_work.Session()
+        record = Record(1)
+        session.delete(record, dependents=False)
+        self.assertEqual(session.deleted, [])
+        self.assertEqual(session.deleted_alone, [record])
+
+    def test_deleting_new_record_drops_it(self):
+        session = unit_of_work.Session()
+        record = Record()
+        session.add(record)
+        session.delete(record)
+        self.assertEqual(session.new, [])
+        self.assertEqual(session.deleted, [])
+
+    def test_current_is_innermost_session(self):
+        self.assertIsNone(unit_of_work.current())
+        with mock.patch.object(unit_of_work.Session, "flush"):
+            with unit_of_work.session() as outer:
+                with unit_of_work.session() as inner:
+                    self.assertIs(unit_of_work.current(), inner)
+                self.assertIs(unit_of_work.current(), outer)
+        self.assertIsNone(unit_of_work.current())
+
+    @mock.patch.object(unit_of_work.Session, "flush")
+    def test_flushes_when_stopped(self, flush):
+        with unit_of_work.session():
+            pass
+        flush.assert_called_once_with()
+
+    @mock.patch.object(unit_of_work.Session, "flush")
+    def test_discards_records_on_error(self, flush):
+        record = Record(1)
+        with self.assertRaises(ValueError):
+            with unit_of_work.session() as session:
+                session.add(record)
+                raise ValueError
+        self.assertFalse(flush.called)
+        self.assertEqual(session.dirty, [])
+        self.assertIsNone(unit_of_work.current())